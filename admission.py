@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+LM Studio への送信の受付制御（クライアントごとの公平な順番待ち）
+
+GPU 1枚の LM Studio は実質1件ずつしか生成しないため、1人が20件送ると他の全員がその後ろで
+読み取りタイムアウト（120秒）まで待たされる。ここでは上流に送るリクエストの数をバックエンドごとに
+max_active 件までに制限し、あふれたリクエストは client_ip ごとの列に並べて、列の先頭を
+クライアントの順番に1件ずつ（ラウンドロビンで）送る。1人が何件並べても、他の人は1件ごとに順番が回ってくる。
+
+リクエストには優先度のクラス（interactive: Web UI からの対話、bulk: スクリプトからの一括処理）があり、
+順番待ちはクラスごとに分かれる。空いた枠は interactive の列から先に割り当てるが、bulk が飢えないよう、
+両方が並んでいる間は割り当ての bulk_share の割合を bulk に回す（例: 0.2 なら interactive 4件ごとに bulk 1件）。
+クラスは APIキー（[ADMISSION] の api_keys で対応付け）、X-Priority ヘッダー、既定値の順で決める（classify()）。
+
+クラスごとに並んでいる件数が max_queue を超えた場合と、queue_timeout 秒待っても順番が来ない場合は
+AdmissionRejected（503 + Retry-After）で断る。順番待ちの位置と待ち時間の目安は queue_status() で返す
+（Web UI が /api/queue で表示する）。待ち時間の目安は、最近の上流の処理時間の指数移動平均から計算する。
+
+- acquire() / release(): スレッド版（web_app.py）
+- acquire_async(): asyncio版（web_app_async.py）。release() は共通
+
+設定は ipconfig.ini の [ADMISSION] セクション（enabled = false で従来どおり制限なし）。
+"""
+
+import asyncio
+import configparser
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+import request_trace
+
+# デフォルト設定
+DEFAULT_MAX_ACTIVE = 1  # バックエンドごとに同時に送るリクエスト数
+DEFAULT_MAX_QUEUE = 64  # 全体で順番待ちできる件数
+DEFAULT_QUEUE_TIMEOUT = 120  # 順番待ちの上限（秒）
+DEFAULT_SERVICE_SECONDS = 20.0  # 処理時間の実績がない間の目安（秒）
+SERVICE_EWMA_ALPHA = 0.2
+REDISPATCH_INTERVAL = 1.0  # 待っている間もこの間隔で割り当てを見直す（バックエンドの復帰などに備える）
+
+# 優先度のクラス（先に書いたクラスの列から割り当てる）
+PRIORITIES = ('interactive', 'bulk')
+INTERACTIVE, BULK = PRIORITIES
+PRIORITY_HEADER = 'X-Priority'
+DEFAULT_PRIORITY = BULK  # ヘッダーもAPIキーもないリクエスト（Web UI は interactive を付けて送る）
+DEFAULT_BULK_SHARE = 0.2  # 両方のクラスが並んでいる間に bulk へ回す割り当ての割合
+MAX_BULK_SHARE = 0.9
+
+def parse_api_keys(value):
+    """'キー:クラス, キー:クラス' 形式（改行区切りも可）を {キー: クラス} に変換する（不明なクラスは無視）"""
+    api_keys = {}
+    for item in value.replace('\n', ',').split(','):
+        key, _, priority = item.strip().rpartition(':')
+        priority = priority.strip().lower()
+        if key.strip() and priority in PRIORITIES:
+            api_keys[key.strip()] = priority
+    return api_keys
+
+def load_admission(backend_pool, config_file='ipconfig.ini'):
+    """ipconfig.ini の [ADMISSION] セクションから受付制御を作成する（無効時は制限なしで作成）"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file, encoding='utf-8')
+    except Exception as e:
+        print(f"❌ 受付制御の設定の読み込みエラー: {e}")
+    section = 'ADMISSION'
+    enabled = config.getboolean(section, 'enabled', fallback=True)
+    default_priority = config.get(section, 'default_priority', fallback=DEFAULT_PRIORITY).strip().lower()
+    if default_priority not in PRIORITIES:
+        print(f"⚠️ default_priority が不明なため {DEFAULT_PRIORITY} を使います: {default_priority}")
+        default_priority = DEFAULT_PRIORITY
+    admission = AdmissionController(
+        backend_pool,
+        max_active=config.getint(section, 'max_active_per_backend', fallback=DEFAULT_MAX_ACTIVE) if enabled else 0,
+        max_queue=config.getint(section, 'max_queue', fallback=DEFAULT_MAX_QUEUE),
+        queue_timeout=config.getfloat(section, 'queue_timeout', fallback=DEFAULT_QUEUE_TIMEOUT),
+        bulk_share=config.getfloat(section, 'bulk_share', fallback=DEFAULT_BULK_SHARE),
+        default_priority=default_priority,
+        trust_priority_header=config.getboolean(section, 'trust_priority_header', fallback=True),
+        api_keys=parse_api_keys(config.get(section, 'api_keys', fallback=''))
+    )
+    if enabled:
+        print(f"🚦 受付制御: バックエンドごとに{admission.max_active}件まで、順番待ちはクラスごとに{admission.max_queue}件まで"
+              f"（bulk の最低割合 {admission.bulk_share:.0%}）")
+    return admission
+
+class AdmissionRejected(Exception):
+    """混雑のため受け付けなかった（503 + Retry-After で返す）"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+    def to_dict(self):
+        return {"error": str(self), "retry_after": self.retry_after}
+
+class Ticket:
+    """順番待ち（または送信中）のリクエスト1件"""
+
+    __slots__ = ('client_ip', 'model', 'priority', 'enqueued', 'granted_at', 'backend', 'notify')
+
+    def __init__(self, client_ip, model, priority, notify=None):
+        self.client_ip = client_ip
+        self.model = model
+        self.priority = priority
+        self.enqueued = time.perf_counter()
+        self.granted_at = None
+        self.backend = None  # 順番が来たら送信先のバックエンドが入る
+        self.notify = notify  # 順番が来たときに（ロックの外で）呼ぶ
+
+class AdmissionController:
+    """バックエンドごとの同時送信数の制限と、優先度のクラス・client_ip ごとのラウンドロビンの順番待ち"""
+
+    def __init__(self, backend_pool, max_active=DEFAULT_MAX_ACTIVE, max_queue=DEFAULT_MAX_QUEUE,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, bulk_share=DEFAULT_BULK_SHARE,
+                 default_priority=DEFAULT_PRIORITY, trust_priority_header=True, api_keys=None):
+        self.backend_pool = backend_pool
+        self.max_active = max_active  # 0 は制限なし（並ばせない）
+        self.max_queue = max_queue  # クラスごと
+        self.queue_timeout = queue_timeout
+        self.bulk_share = min(max(bulk_share, 0.0), MAX_BULK_SHARE)
+        self.default_priority = default_priority
+        self.trust_priority_header = trust_priority_header
+        self.api_keys = api_keys or {}
+        self.lock = threading.Lock()
+        # クラス -> (client_ip -> そのクライアントの順番待ち（先頭から送る）)。辞書の順がクライアントの順番
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.waiting = {priority: 0 for priority in PRIORITIES}
+        self.active = 0
+        self.service_seconds = DEFAULT_SERVICE_SECONDS
+        # bulk が interactive の後ろで待っている間にたまる割り当ての権利（1以上で bulk を先に割り当てる）
+        self.bulk_credit = 0.0
+
+        self.stats_counter = {
+            priority: {
+                "admitted": 0, "queued": 0, "rejected": 0, "timeouts": 0,
+                "guaranteed": 0,  # 他のクラスが待っている中で、最低割合の分として割り当てた件数
+                "wait_total": 0.0, "wait_max": 0.0
+            }
+            for priority in PRIORITIES
+        }
+
+    @property
+    def enabled(self):
+        return self.max_active > 0
+
+    def classify(self, headers):
+        """リクエストヘッダーから優先度のクラスを決める（APIキーの対応付け > X-Priority ヘッダー > 既定）"""
+        key = headers.get('X-API-Key')
+        if not key:
+            authorization = headers.get('Authorization') or ''
+            if authorization.startswith('Bearer '):
+                key = authorization[7:].strip()
+        if key and key in self.api_keys:
+            return self.api_keys[key]
+        if self.trust_priority_header:
+            priority = (headers.get(PRIORITY_HEADER) or '').strip().lower()
+            if priority in PRIORITIES:
+                return priority
+        return self.default_priority
+
+    # ---- 受付 ----
+
+    def acquire(self, client_ip, model=None, priority=None):
+        """順番が来るまで待ち、送信先のバックエンドが決まった Ticket を返す（スレッド版）"""
+        event = threading.Event()
+        ticket = self.enqueue(client_ip, model, priority, notify=event.set)
+        if ticket.backend is not None:
+            return ticket
+        with request_trace.span('admission-queue'):
+            deadline = ticket.enqueued + self.queue_timeout
+            while not event.wait(min(REDISPATCH_INTERVAL, max(0.0, deadline - time.perf_counter()))):
+                if time.perf_counter() >= deadline:
+                    self.expire(ticket)
+                    if ticket.backend is not None:
+                        break
+                    raise self.timeout_error()
+                self.dispatch()
+        return ticket
+
+    async def acquire_async(self, client_ip, model=None, priority=None):
+        """順番が来るまで待ち、送信先のバックエンドが決まった Ticket を返す（asyncio版）"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+
+        ticket = self.enqueue(client_ip, model, priority, notify=notify)
+        if ticket.backend is not None:
+            return ticket
+        with request_trace.span('admission-queue'):
+            deadline = ticket.enqueued + self.queue_timeout
+            try:
+                while True:
+                    remaining = deadline - time.perf_counter()
+                    try:
+                        await asyncio.wait_for(asyncio.shield(granted), min(REDISPATCH_INTERVAL, max(0.0, remaining)))
+                        break
+                    except asyncio.TimeoutError:
+                        if time.perf_counter() >= deadline:
+                            self.expire(ticket)
+                            if ticket.backend is not None:
+                                break
+                            raise self.timeout_error()
+                        self.dispatch()
+            except asyncio.CancelledError:
+                # 待っている間にクライアントが切断した
+                self.expire(ticket)
+                if ticket.backend is not None:
+                    self.release(ticket)
+                raise
+        return ticket
+
+    def enqueue(self, client_ip, model, priority=None, notify=None):
+        """空きがあればすぐに割り当て、なければ列に並べる（クラスの列があふれている場合は AdmissionRejected）"""
+        if priority not in PRIORITIES:
+            priority = self.default_priority
+        ticket = Ticket(client_ip, model, priority, notify)
+        with self.lock:
+            counter = self.stats_counter[priority]
+            if not self.enabled or self._waiting_total() == 0:
+                backend = self.backend_pool.acquire(model, limit=self.max_active or None)
+                if backend is not None:
+                    self._grant(ticket, backend)
+                    return ticket
+            if self.waiting[priority] >= self.max_queue:
+                counter['rejected'] += 1
+                retry_after = self._estimate(self._waiting_total())
+                raise AdmissionRejected(f"混雑しています（順番待ち{self.waiting[priority]}件）。しばらくしてから再送信してください",
+                                        retry_after)
+            self.queues[priority].setdefault(client_ip, deque()).append(ticket)
+            self.waiting[priority] += 1
+            counter['queued'] += 1
+            granted = self._dispatch()
+        self._notify(granted)
+        return ticket
+
+    def release(self, ticket, failed=False):
+        """送信の完了を記録し、空いた枠を次の順番のリクエストに割り当てる"""
+        if ticket.backend is None:
+            return
+        self.backend_pool.release(ticket.backend, failed)
+        elapsed = time.perf_counter() - ticket.granted_at
+        with self.lock:
+            self.active -= 1
+            if not failed:
+                self.service_seconds += SERVICE_EWMA_ALPHA * (elapsed - self.service_seconds)
+            granted = self._dispatch()
+        ticket.backend = None
+        self._notify(granted)
+
+    def dispatch(self):
+        """空いている枠を順番待ちの先頭に割り当てる"""
+        with self.lock:
+            granted = self._dispatch()
+        self._notify(granted)
+
+    def expire(self, ticket):
+        """待つのをやめたリクエストを列から外す（その間に順番が来ていた場合は何もしない）"""
+        with self.lock:
+            if ticket.backend is not None:
+                return
+            queues = self.queues[ticket.priority]
+            queue = queues.get(ticket.client_ip)
+            if queue is None or ticket not in queue:
+                return
+            queue.remove(ticket)
+            if not queue:
+                del queues[ticket.client_ip]
+            self.waiting[ticket.priority] -= 1
+            if not self.waiting[BULK]:
+                self.bulk_credit = 0.0
+            self.stats_counter[ticket.priority]['timeouts'] += 1
+
+    def timeout_error(self):
+        with self.lock:
+            retry_after = self._estimate(self._waiting_total())
+        return AdmissionRejected(f"{self.queue_timeout:.0f}秒待っても順番が来ませんでした。しばらくしてから再送信してください",
+                                 retry_after)
+
+    def _waiting_total(self):
+        return sum(self.waiting.values())
+
+    def _service_order(self):
+        """（ロック内）列を見る順番。bulk の割り当ての権利がたまっていれば bulk から"""
+        if self.waiting[BULK] and self.bulk_credit >= 1.0 - 1e-9:
+            return (BULK, INTERACTIVE)
+        return PRIORITIES
+
+    def _dispatch(self):
+        """（ロック内）空いている枠をクラスの順・クライアントの順に割り当て、割り当てた Ticket のリストを返す"""
+        granted = []
+        while True:
+            order = self._service_order()
+            for priority in order:
+                ticket = self._dispatch_class(priority)
+                if ticket is not None:
+                    break
+            else:
+                return granted
+            granted.append(ticket)
+
+            # bulk の最低割合: interactive に割り当てるたびに bulk_share / (1 - bulk_share) ずつ権利がたまり、
+            # 権利で bulk を先に割り当てると1減る（両方が並び続けると割り当ての bulk_share が bulk になる）
+            if ticket.priority == BULK and order[0] == BULK:
+                self.bulk_credit -= 1.0
+                self.stats_counter[BULK]['guaranteed'] += 1
+            elif ticket.priority == INTERACTIVE and self.waiting[BULK]:
+                self.bulk_credit += self.bulk_share / (1.0 - self.bulk_share)
+            if not self.waiting[BULK]:
+                self.bulk_credit = 0.0
+
+    def _dispatch_class(self, priority):
+        """（ロック内）クラスの列からクライアントの順に先頭を1件割り当てる（割り当てられなければ None）"""
+        queues = self.queues[priority]
+        for client_ip, queue in queues.items():
+            ticket = queue[0]
+            backend = self.backend_pool.acquire(ticket.model, limit=self.max_active or None)
+            if backend is None:
+                continue  # このモデルを扱えるバックエンドが埋まっている。次のクライアントを見る
+            queue.popleft()
+            self.waiting[priority] -= 1
+            if queue:
+                # 割り当てたクライアントは順番の最後に回す
+                queues.move_to_end(client_ip)
+            else:
+                del queues[client_ip]
+            self._grant(ticket, backend)
+            return ticket
+        return None
+
+    def _grant(self, ticket, backend):
+        ticket.backend = backend
+        ticket.granted_at = time.perf_counter()
+        self.active += 1
+        waited = ticket.granted_at - ticket.enqueued
+        counter = self.stats_counter[ticket.priority]
+        counter['admitted'] += 1
+        counter['wait_total'] += waited
+        counter['wait_max'] = max(counter['wait_max'], waited)
+
+    def _notify(self, granted):
+        for ticket in granted:
+            if ticket.notify is not None:
+                ticket.notify()
+
+    # ---- 順番と待ち時間の目安 ----
+
+    def _capacity(self):
+        return max(1, self.max_active * self.backend_pool.healthy_count())
+
+    def _estimate(self, ahead):
+        """（ロック内）前に ahead 件並んでいる場合の待ち時間の目安（秒）"""
+        return (ahead // self._capacity() + 1) * self.service_seconds
+
+    def _position(self, ticket):
+        """（ロック内）ticket より先に送られる件数（クラスの割合とラウンドロビンの順で数える）"""
+        queues = self.queues[ticket.priority]
+        index = queues[ticket.client_ip].index(ticket)
+        ahead = index
+        before = True  # 順番が ticket のクライアントより前のクライアントか
+        for client_ip, other in queues.items():
+            if client_ip == ticket.client_ip:
+                before = False
+                continue
+            # 前のクライアントは index + 1 回、後のクライアントは index 回、先に順番が回ってくる
+            ahead += min(len(other), index + 1 if before else index)
+
+        # 同じクラスの ahead 件の間に、もう一方のクラスへ割り当てられる件数
+        share = self.bulk_share
+        if ticket.priority == INTERACTIVE:
+            interleaved = (ahead + 1) * share / (1.0 - share)
+            other_waiting = self.waiting[BULK]
+        else:
+            interleaved = (ahead + 1) * (1.0 - share) / share if share else math.inf
+            other_waiting = self.waiting[INTERACTIVE]
+        return ahead + int(min(other_waiting, interleaved))
+
+    def _oldest_wait(self, priority, now):
+        """（ロック内）クラスの中で最も長く待っているリクエストの待ち時間（秒、誰も待っていなければ 0）"""
+        heads = [queue[0].enqueued for queue in self.queues[priority].values()]
+        return now - min(heads) if heads else 0.0
+
+    def queue_status(self, client_ip):
+        """全体の混雑状況と、client_ip の順番待ちの位置・待ち時間の目安"""
+        now = time.perf_counter()
+        with self.lock:
+            mine = []
+            for priority in PRIORITIES:
+                for ticket in self.queues[priority].get(client_ip, ()):
+                    ahead = self._position(ticket)
+                    mine.append({
+                        "priority": priority,
+                        "position": ahead + 1,
+                        "estimated_wait": round(self._estimate(ahead), 1),
+                        "waited": round(now - ticket.enqueued, 1)
+                    })
+            mine.sort(key=lambda entry: entry['position'])
+            clients = set()
+            for queues in self.queues.values():
+                clients.update(queues)
+            return {
+                "enabled": self.enabled,
+                "active": self.active,
+                "waiting": self._waiting_total(),
+                "clients_waiting": len(clients),
+                "waiting_by_priority": dict(self.waiting),
+                "capacity": self._capacity() if self.enabled else None,
+                "max_queue": self.max_queue,
+                "avg_service_seconds": round(self.service_seconds, 1),
+                "mine": mine
+            }
+
+    def stats(self):
+        now = time.perf_counter()
+        with self.lock:
+            counters = {priority: dict(counter) for priority, counter in self.stats_counter.items()}
+            waiting = dict(self.waiting)
+            oldest = {priority: self._oldest_wait(priority, now) for priority in PRIORITIES}
+            clients = set()
+            for queues in self.queues.values():
+                clients.update(queues)
+            active, service = self.active, self.service_seconds
+
+        classes = {}
+        for priority, counter in counters.items():
+            admitted = counter['admitted']
+            classes[priority] = {
+                "waiting": waiting[priority],
+                "admitted": admitted,
+                "queued": counter['queued'],
+                "rejected": counter['rejected'],
+                "timeouts": counter['timeouts'],
+                "guaranteed": counter['guaranteed'],
+                "avg_wait_seconds": round(counter['wait_total'] / admitted, 3) if admitted else 0.0,
+                "max_wait_seconds": round(counter['wait_max'], 3),
+                # 今待っている中で最も長い待ち時間（飢餓の目安）
+                "oldest_wait_seconds": round(oldest[priority], 3)
+            }
+        admitted = sum(counter['admitted'] for counter in counters.values())
+        wait_total = sum(counter['wait_total'] for counter in counters.values())
+        return {
+            "enabled": self.enabled,
+            "active": active,
+            "waiting": sum(waiting.values()),
+            "clients_waiting": len(clients),
+            "admitted": admitted,
+            "queued": sum(counter['queued'] for counter in counters.values()),
+            "rejected": sum(counter['rejected'] for counter in counters.values()),
+            "timeouts": sum(counter['timeouts'] for counter in counters.values()),
+            "avg_wait_seconds": round(wait_total / admitted, 3) if admitted else 0.0,
+            "max_wait_seconds": round(max(counter['wait_max'] for counter in counters.values()), 3),
+            "avg_service_seconds": round(service, 2),
+            "bulk_share": self.bulk_share,
+            "classes": classes
+        }
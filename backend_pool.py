@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+LM Studio バックエンドプール
+
+ipconfig.ini に複数のLM Studioサーバーを登録し、リクエストごとに
+「要求されたモデルを持つバックエンドのうち、処理中リクエストが最も少ないもの」を選ぶ。
+ヘルスチェックに失敗したバックエンドは自動的に除外され、回復すると再び使われる。
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import requests
+
+# ヘルスチェックの間隔（秒）
+DEFAULT_HEALTH_CHECK_INTERVAL = 15
+
+# 連続でこの回数失敗したバックエンドを除外する
+DEFAULT_FAILURE_THRESHOLD = 2
+
+def parse_server_list(value):
+    """'host:port, host:port' 形式（改行区切りも可）をAPIのベースURLのリストに変換する"""
+    urls = []
+    for item in value.replace('\n', ',').split(','):
+        item = item.strip()
+        if not item or item.startswith('#'):
+            continue
+        if not item.startswith('http://') and not item.startswith('https://'):
+            item = f"http://{item}"
+        item = item.rstrip('/')
+        if not item.endswith('/v1'):
+            item = f"{item}/v1"
+        if item not in urls:
+            urls.append(item)
+    return urls
+
+class Backend:
+    """1台のLM Studioサーバーの状態"""
+
+    def __init__(self, url):
+        self.url = url
+        self.outstanding = 0       # 処理中のリクエスト数
+        self.healthy = True        # 初回ヘルスチェックまでは利用可能とみなす
+        self.failures = 0          # 連続失敗回数
+        self.models = {}           # モデルID -> /v1/models のエントリ
+        self.last_checked = None
+
+    def to_dict(self):
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "failures": self.failures,
+            "models": sorted(self.models),
+            "last_checked": self.last_checked
+        }
+
+class NoBackendAvailable(Exception):
+    """利用可能なバックエンドが1台もない"""
+
+class BackendPool:
+    """最小処理中数＋モデルアフィニティでバックエンドを選択するプール"""
+
+    def __init__(self, urls, health_check_interval=DEFAULT_HEALTH_CHECK_INTERVAL,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD):
+        if not urls:
+            raise ValueError("バックエンドが1台も設定されていません")
+        self.backends = [Backend(url) for url in urls]
+        self.health_check_interval = health_check_interval
+        self.failure_threshold = failure_threshold
+        self.lock = threading.Lock()
+        # ヘルスチェック専用のセッション（リクエスト処理用とは接続プールを分ける）
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=min(8, len(self.backends)),
+                                           thread_name_prefix="backend-health")
+        self.running = False
+
+    # ---- 選択 ----
+
+    def acquire(self, model=None, limit=None):
+        """リクエストを送るバックエンドを選び、処理中数を1増やして返す
+
+        limit を指定すると、処理中数が limit 未満のバックエンドだけから選ぶ（なければ None を返す）。
+        """
+        with self.lock:
+            candidates = [b for b in self.backends if b.healthy]
+            if not candidates:
+                # 全台除外中の場合は、ヘルスチェックの判定が古い可能性があるため全台を候補にする
+                candidates = self.backends
+            if model and model != "default":
+                with_model = [b for b in candidates if model in b.models]
+                # どのバックエンドも該当モデルを報告していない場合は、LM Studio側のJITロードに任せる
+                if with_model:
+                    candidates = with_model
+            backend = min(candidates, key=lambda b: b.outstanding)
+            if limit is not None and backend.outstanding >= limit:
+                return None
+            backend.outstanding += 1
+            return backend
+
+    def release(self, backend, failed=False):
+        """リクエスト完了を記録する（接続エラー時は failed=True）"""
+        with self.lock:
+            backend.outstanding = max(0, backend.outstanding - 1)
+            if failed:
+                self._record_failure(backend)
+
+    @contextmanager
+    def lease(self, model=None):
+        """with文でバックエンドを借りる。接続エラーはバックエンドの失敗として記録する"""
+        backend = self.acquire(model)
+        failed = False
+        try:
+            yield backend
+        except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout):
+            failed = True
+            raise
+        finally:
+            self.release(backend, failed)
+
+    def _record_failure(self, backend):
+        backend.failures += 1
+        if backend.healthy and backend.failures >= self.failure_threshold:
+            backend.healthy = False
+            print(f"⚠️ バックエンドを除外しました: {backend.url}")
+
+    # ---- ヘルスチェック ----
+
+    def check_backend(self, backend, timeout=5):
+        """/v1/models を取得してバックエンドの状態とモデル一覧を更新する"""
+        try:
+            response = self.session.get(f"{backend.url}/models", timeout=timeout)
+            response.raise_for_status()
+            models = {model['id']: model for model in response.json().get('data', [])}
+        except Exception:
+            with self.lock:
+                backend.last_checked = time.time()
+                self._record_failure(backend)
+            return False
+
+        with self.lock:
+            backend.models = models
+            backend.failures = 0
+            backend.last_checked = time.time()
+            if not backend.healthy:
+                backend.healthy = True
+                print(f"✅ バックエンドが復帰しました: {backend.url}")
+        return True
+
+    def check_all(self, timeout=5):
+        """全バックエンドを並列にヘルスチェックする"""
+        list(self.executor.map(lambda b: self.check_backend(b, timeout), self.backends))
+
+    def start(self):
+        """バックグラウンドのヘルスチェックスレッドを開始する"""
+        if self.running:
+            return
+        self.running = True
+
+        def health_loop():
+            while self.running:
+                self.check_all()
+                time.sleep(self.health_check_interval)
+
+        threading.Thread(target=health_loop, daemon=True, name="backend-health-loop").start()
+
+    def stop(self):
+        self.running = False
+        self.executor.shutdown(wait=False)
+        self.session.close()
+
+    # ---- 参照 ----
+
+    def models_union(self):
+        """稼働中バックエンドのモデル一覧を統合して /v1/models 形式で返す"""
+        with self.lock:
+            merged = {}
+            for backend in self.backends:
+                if not backend.healthy:
+                    continue
+                for model_id, entry in backend.models.items():
+                    merged.setdefault(model_id, entry)
+            return {"object": "list", "data": [merged[model_id] for model_id in sorted(merged)]}
+
+    def healthy_count(self):
+        """稼働中のバックエンドの台数（全台除外中は全台を数える。acquire と同じ扱い）"""
+        with self.lock:
+            return sum(1 for b in self.backends if b.healthy) or len(self.backends)
+
+    def status(self):
+        """各バックエンドの状態を返す"""
+        with self.lock:
+            return [backend.to_dict() for backend in self.backends]
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+/api/batch の入力の解析と結果の行（web_app.py・web_app_async.py で共通）
+
+評価などで多数のプロンプトを送る場合に、/api/chat を1件ずつ呼ぶ代わりに1回のリクエストでまとめて送る。
+入力は JSON（項目の配列、または {"items": [...], "concurrency": 4, ...}）か JSONL（1行1項目。
+multipart でアップロードしたファイル、または application/x-ndjson の本文）。
+
+各項目は prompt（チャットは messages も可）と、省略可能な id・api_type・model・temperature・
+max_tokens・cache を持つ。省略した値はバッチ全体の指定（JSON の外側、フォーム、クエリ文字列）、
+それもなければ /api/chat・/api/text と同じ既定値を使う。
+
+アプリは concurrency 件ずつ上流に送り、終わった順に NDJSON（1行1件）で返す。
+最初の行はバッチの概要、最後の行は集計。上流への送信は受付制御（admission.py）を通るため、
+バックエンドの同時送信数の制限と優先度（既定は bulk）に従う。履歴は HistoryWriter のキューに入れ、
+届いた分からまとめて書き込まれる。
+
+設定は ipconfig.ini の [BATCH] セクション。
+"""
+
+import configparser
+import json
+import time
+
+from response_cache import make_cache_key, is_cacheable
+
+# デフォルト設定
+DEFAULT_MAX_ITEMS = 1000
+DEFAULT_CONCURRENCY = 2
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = {'chat': 4000, 'text': 1000}
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+JSONL_MIMETYPES = ('application/x-ndjson', 'application/jsonl', 'application/x-jsonlines', 'application/jsonlines')
+
+# バッチ全体で指定でき、項目ごとに上書きできる値
+ITEM_DEFAULTS = ('api_type', 'model', 'temperature', 'max_tokens', 'cache')
+
+class BatchError(ValueError):
+    """バッチの入力が不正（400 で返す）"""
+
+class BatchSettings:
+    """[BATCH] セクションの設定"""
+
+    def __init__(self, max_items=DEFAULT_MAX_ITEMS, concurrency=DEFAULT_CONCURRENCY,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.max_items = max_items
+        self.concurrency = concurrency
+        self.max_concurrency = max(1, max_concurrency)
+
+def load_batch_settings(config_file='ipconfig.ini'):
+    """ipconfig.ini の [BATCH] セクションから /api/batch の設定を読み込む"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file, encoding='utf-8')
+    except Exception as e:
+        print(f"❌ バッチ設定の読み込みエラー: {e}")
+    section = 'BATCH'
+    return BatchSettings(
+        max_items=config.getint(section, 'max_items', fallback=DEFAULT_MAX_ITEMS),
+        concurrency=config.getint(section, 'concurrency', fallback=DEFAULT_CONCURRENCY),
+        max_concurrency=config.getint(section, 'max_concurrency', fallback=DEFAULT_MAX_CONCURRENCY)
+    )
+
+class BatchItem:
+    """バッチの1項目（上流への1リクエスト）"""
+
+    __slots__ = ('index', 'id', 'api_type', 'prompt', 'messages', 'model', 'temperature', 'max_tokens', 'cache')
+
+    def __init__(self, index, item_id, api_type, prompt, messages, model, temperature, max_tokens, cache):
+        self.index = index
+        self.id = item_id
+        self.api_type = api_type
+        self.prompt = prompt  # 履歴に保存するプロンプト
+        self.messages = messages  # チャットで messages を指定した場合のみ
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.cache = cache
+
+    @property
+    def endpoint(self):
+        return 'chat/completions' if self.api_type == 'chat' else 'completions'
+
+    def payload(self):
+        """LM Studio に送るリクエスト本文（/api/chat・/api/text と同じ形）"""
+        if self.api_type == 'chat':
+            payload = {"messages": self.messages or [{"role": "user", "content": self.prompt}]}
+        else:
+            payload = {"prompt": self.prompt}
+        payload["temperature"] = self.temperature
+        payload["max_tokens"] = self.max_tokens
+        if self.model != "default":
+            payload["model"] = self.model
+        return payload
+
+    def cache_key(self):
+        """レスポンスキャッシュのキー（キャッシュ対象でなければ None）"""
+        if not is_cacheable(self.temperature, self.cache):
+            return None
+        payload = self.payload()
+        return make_cache_key(self.api_type, self.model,
+                              payload['messages'] if self.api_type == 'chat' else self.prompt,
+                              self.temperature, self.max_tokens)
+
+def parse_jsonl(text):
+    """JSONL（1行1項目、空行は無視）を項目のリストに変換する"""
+    items = []
+    for number, line in enumerate(text.splitlines(), start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            raise BatchError(f"JSONL の{number}行目を解析できません: {e}")
+    return items
+
+def _parse_bool(value):
+    if value is None or isinstance(value, bool):
+        return value
+    text = str(value).strip().lower()
+    if text in ('1', 'true', 'yes', 'on'):
+        return True
+    if text in ('0', 'false', 'no', 'off'):
+        return False
+    if text == '':
+        return None
+    raise BatchError(f"cache には true / false を指定してください: {value}")
+
+def _last_user_message(messages):
+    for message in reversed(messages):
+        if isinstance(message, dict) and message.get('role') == 'user':
+            return str(message.get('content') or '')
+    return ''
+
+def _parse_item(index, raw, defaults):
+    if isinstance(raw, str):
+        raw = {"prompt": raw}
+    if not isinstance(raw, dict):
+        raise BatchError(f"{index}番目の項目はオブジェクトか文字列で指定してください")
+    values = dict(defaults)
+    values.update({key: raw[key] for key in ITEM_DEFAULTS if raw.get(key) is not None})
+
+    api_type = str(values.get('api_type') or 'chat').lower()
+    if api_type not in ('chat', 'text'):
+        raise BatchError(f"{index}番目の項目の api_type は chat か text を指定してください")
+
+    messages = raw.get('messages')
+    if messages is not None:
+        if api_type != 'chat' or not isinstance(messages, list) or not messages:
+            raise BatchError(f"{index}番目の項目の messages はチャットのメッセージの配列で指定してください")
+    prompt = raw.get('prompt')
+    if prompt is None and messages is not None:
+        prompt = _last_user_message(messages)
+    if not isinstance(prompt, str) or (not prompt.strip() and messages is None):
+        raise BatchError(f"{index}番目の項目に prompt がありません")
+
+    try:
+        temperature = float(values.get('temperature', DEFAULT_TEMPERATURE))
+        max_tokens = int(values.get('max_tokens', DEFAULT_MAX_TOKENS[api_type]))
+    except (TypeError, ValueError):
+        raise BatchError(f"{index}番目の項目の temperature・max_tokens は数値で指定してください")
+
+    item_id = raw.get('id', index)
+    return BatchItem(index, item_id, api_type, prompt, messages, str(values.get('model') or 'default'),
+                     temperature, max_tokens, _parse_bool(values.get('cache')))
+
+def parse_batch(data, options=None, settings=None):
+    """リクエストの内容を (BatchItem のリスト, 同時送信数) に変換する
+
+    data は項目の配列、または {"items": [...], ...}（外側の値はバッチ全体の指定）。
+    options はフォーム・クエリ文字列などで指定したバッチ全体の指定（data の外側の値が優先）。
+    """
+    settings = settings or BatchSettings()
+    options = dict(options or {})
+    if isinstance(data, dict):
+        options.update({key: value for key, value in data.items() if key != 'items'})
+        data = data.get('items')
+    if not isinstance(data, list) or not data:
+        raise BatchError("items に1件以上の項目を指定してください")
+    if len(data) > settings.max_items:
+        raise BatchError(f"1回のバッチは{settings.max_items}件までです（{len(data)}件）")
+
+    defaults = {key: options[key] for key in ITEM_DEFAULTS if options.get(key) not in (None, '')}
+    items = [_parse_item(index, raw, defaults) for index, raw in enumerate(data)]
+
+    try:
+        concurrency = int(options.get('concurrency') or settings.concurrency)
+    except (TypeError, ValueError):
+        raise BatchError("concurrency は整数で指定してください")
+    concurrency = max(1, min(concurrency, settings.max_concurrency, len(items)))
+    return items, concurrency
+
+def ndjson_line(entry):
+    """NDJSON の1行"""
+    return json.dumps(entry, ensure_ascii=False) + "\n"
+
+def item_result(item, started, response_text, usage=None, cached=False):
+    """成功した項目の結果の行"""
+    return {
+        "index": item.index, "id": item.id, "ok": True, "api_type": item.api_type, "model": item.model,
+        "response": response_text, "usage": usage, "cached": cached,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)
+    }
+
+def item_error(item, started, error):
+    """失敗した項目の結果の行（error は UpstreamError・AdmissionRejected の to_dict() と同じ形）"""
+    return dict(error, index=item.index, id=item.id, ok=False,
+                elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
+
+class BatchProgress:
+    """バッチの進み具合（概要の行と、結果の行を数えた集計の行を返す）"""
+
+    def __init__(self, items, concurrency):
+        self.total = len(items)
+        self.concurrency = concurrency
+        self.started = time.perf_counter()
+        self.succeeded = 0
+        self.failed = 0
+        self.cached = 0
+
+    def header(self):
+        return {"batch": {"items": self.total, "concurrency": self.concurrency}}
+
+    def add(self, line):
+        if line['ok']:
+            self.succeeded += 1
+            if line['cached']:
+                self.cached += 1
+        else:
+            self.failed += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            "done": True, "items": self.total, "succeeded": self.succeeded, "failed": self.failed,
+            "cached": self.cached, "elapsed_ms": round(elapsed * 1000, 1)
+        }
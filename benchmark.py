@@ -0,0 +1,558 @@
+# -*- coding: utf-8 -*-
+"""
+web_app.py（または web_app_async.py）の負荷テスト
+
+LM Studio の代わりに mock_lmstudio.py の模擬サーバーを起動し、実際の Web アプリを別プロセスで
+一時ディレクトリ（ipconfig.ini は模擬サーバー向けに書き換えたコピー、履歴DBは空）から起動して、
+/api/chat・/api/text へ一定の同時接続数でリクエストを送り続ける。
+
+結果（レイテンシの p50/p95/p99・最初のバイトまでの時間・requests/s・エラーの内訳・履歴の保存の遅れ・
+アプリのメモリ使用量・模擬サーバーの生成待ち）は JSON に保存し、compare で2回の結果を比べられる。
+
+    python benchmark.py run --concurrency 16 --requests 500 --stream
+    python benchmark.py run --app async --concurrency 64 --duration 60 --parallel 4
+    python benchmark.py compare benchmark_results/before.json benchmark_results/after.json
+
+メモリ使用量は psutil があればそれを使い、ない場合は /proc から読む（どちらもない環境では記録しない）。
+"""
+
+import argparse
+import configparser
+import importlib
+import json
+import math
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import requests
+
+import mock_lmstudio
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# デフォルト設定
+DEFAULT_CONCURRENCY = 8
+DEFAULT_REQUESTS = 200
+DEFAULT_PROMPT_CHARS = 400
+DEFAULT_MAX_TOKENS = 64
+DEFAULT_TIMEOUT = 120
+DEFAULT_RESULTS_DIR = 'benchmark_results'
+READY_TIMEOUT = 30
+SAMPLE_INTERVAL = 0.25  # メモリ・履歴キューを記録する間隔（秒）
+DRAIN_TIMEOUT = 60  # 負荷の終了後、履歴の保存が追いつくまで待つ上限（秒）
+
+APPS = {'flask': 'web_app', 'async': 'web_app_async'}
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_VERSION = 1
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def percentiles(values):
+    """ミリ秒の値の p50/p95/p99・平均・最大（値がなければ None）"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def rank(p):
+        return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+    return {
+        "p50": round(rank(50), 2), "p95": round(rank(95), 2), "p99": round(rank(99), 2),
+        "mean": round(sum(values) / len(values), 2), "max": round(values[-1], 2)
+    }
+
+def process_rss_mb(pid):
+    """プロセスの常駐メモリ（MB）。取得できない環境では None"""
+    try:
+        if psutil is not None:
+            return psutil.Process(pid).memory_info().rss / 1024 / 1024
+        with open(f'/proc/{pid}/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except Exception:
+        pass
+    return None
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+def write_app_config(source, path, mock_port):
+    """ipconfig.ini のコピーを模擬サーバー向けに書き換えて作業ディレクトリに置く"""
+    config = configparser.ConfigParser()
+    config.read(source, encoding='utf-8')
+    if not config.has_section('API_SERVER'):
+        config.add_section('API_SERVER')
+    config.remove_option('API_SERVER', 'servers')
+    config.set('API_SERVER', 'ip', '127.0.0.1')
+    config.set('API_SERVER', 'port', str(mock_port))
+    with open(path, 'w', encoding='utf-8') as f:
+        config.write(f)
+
+def client_address(worker, clients):
+    """worker 番目の接続が名乗るクライアントのIPアドレス（clients が1以下なら None で名乗らない）"""
+    if clients <= 1:
+        return None
+    index = worker % clients
+    return f"10.0.{index // 250}.{index % 250 + 1}"
+
+def worker_priority(worker, interactive):
+    """worker 番目の接続の優先度のクラス（先頭の interactive 本が interactive、残りが bulk。0 なら指定しない）"""
+    if interactive <= 0:
+        return None
+    return 'interactive' if worker < interactive else 'bulk'
+
+def mock_command(args, port):
+    """模擬サーバーの起動コマンド（add_mock_arguments の引数をそのまま渡す）"""
+    return [sys.executable, os.path.join(REPO_DIR, 'mock_lmstudio.py'), '--port', str(port),
+            '--latency-ms', str(args.latency_ms), '--tokens-per-sec', str(args.tokens_per_sec),
+            '--response-tokens', str(args.response_tokens), '--parallel', str(args.parallel),
+            '--error-rate', str(args.error_rate), '--error-status', str(args.error_status),
+            '--disconnect-rate', str(args.disconnect_rate), '--models', args.models] + \
+           (['--seed', str(args.seed)] if args.seed is not None else [])
+
+class LoadRun:
+    """1回の負荷テスト（模擬サーバーとアプリを起動し、同時接続数を保ってリクエストを送る）"""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = None
+        self.mock_process = None
+        self.app_process = None
+        self.app_url = None
+        self.mock_url = None
+        self.monitor = requests.Session()  # 準備・統計の取得用（負荷とは別の接続）
+
+        self.lock = threading.Lock()
+        self.issued = 0
+        self.deadline = None
+        self.samples = []  # (レイテンシ秒, 最初のバイトまでの秒 or None, エラー or None, 優先度のクラス or None)
+        self.memory = []
+        self.max_queue_depth = 0
+        self.sampling = threading.Event()
+
+    # ---- 起動・停止 ----
+
+    def start(self):
+        args = self.args
+        self.workdir = tempfile.mkdtemp(prefix='lmstudio-bench-')
+        mock_port, app_port = free_port(), free_port()
+        self.mock_url = f"http://127.0.0.1:{mock_port}"
+        self.app_url = f"http://127.0.0.1:{app_port}"
+        write_app_config(args.config, os.path.join(self.workdir, 'ipconfig.ini'), mock_port)
+
+        log = open(os.path.join(self.workdir, 'server.log'), 'w', encoding='utf-8')
+        env = dict(os.environ, PYTHONIOENCODING='utf-8')
+        self.mock_process = subprocess.Popen(mock_command(args, mock_port), stdout=log, stderr=subprocess.STDOUT,
+                                             cwd=self.workdir, env=env)
+        self.wait_ready(self.mock_url + '/v1/models')
+        self.app_process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'serve', '--app', args.app, '--port', str(app_port)],
+            stdout=log, stderr=subprocess.STDOUT, cwd=self.workdir, env=env)
+        self.wait_ready(self.app_url + '/api/history-writer')
+        log.close()
+
+    def wait_ready(self, url):
+        deadline = time.monotonic() + READY_TIMEOUT
+        while time.monotonic() < deadline:
+            for process in (self.mock_process, self.app_process):
+                if process is not None and process.poll() is not None:
+                    raise RuntimeError(f"サーバーが起動できませんでした（{self.workdir}/server.log を確認してください）")
+            try:
+                if self.monitor.get(url, timeout=2).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"サーバーが {READY_TIMEOUT} 秒以内に応答しませんでした: {url}")
+
+    def stop(self):
+        self.sampling.set()
+        for process in (self.app_process, self.mock_process):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        self.monitor.close()
+        if self.workdir and not self.args.keep_workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # ---- 負荷 ----
+
+    def payload(self, index):
+        args = self.args
+        # 毎回異なるプロンプトにしてキャッシュ・相乗りに当たらないようにする
+        head = f"ベンチマーク {index}: "
+        return {
+            "prompt": head + 'あ' * max(0, args.prompt_chars - len(head)),
+            "model": args.model,
+            "temperature": args.temperature,
+            "max_tokens": args.max_tokens,
+            "stream": args.stream
+        }
+
+    def endpoint(self, index):
+        api = self.args.api
+        if api == 'mix':
+            api = 'chat' if index % 2 == 0 else 'text'
+        return f"{self.app_url}/api/{api}"
+
+    def next_index(self):
+        with self.lock:
+            if self.deadline is not None:
+                if time.monotonic() >= self.deadline:
+                    return None
+            elif self.issued >= self.args.requests:
+                return None
+            self.issued += 1
+            return self.issued
+
+    def send(self, session, index):
+        """1リクエストを送って最後まで受信する（ストリーミングは最初のデータまでの時間も測る）"""
+        started = time.perf_counter()
+        first_byte = None
+        error = None
+        try:
+            with session.post(self.endpoint(index), json=self.payload(index), stream=True,
+                              timeout=self.args.timeout) as response:
+                for chunk in response.iter_content(chunk_size=None):
+                    if first_byte is None and chunk:
+                        first_byte = time.perf_counter() - started
+                    if self.args.stream and b'event: error' in chunk:
+                        error = 'stream_error'
+                if response.status_code != 200:
+                    error = f'http_{response.status_code}'
+        except requests.Timeout:
+            error = 'timeout'
+        except requests.RequestException:
+            error = 'connection'
+        return time.perf_counter() - started, first_byte, error
+
+    def worker(self, record, client_ip=None, priority=None):
+        with requests.Session() as session:
+            if client_ip is not None:
+                # 受付制御（[ADMISSION]）の順番待ちはIPアドレスごとのため、別のクライアントとして送る
+                session.headers['X-Forwarded-For'] = client_ip
+            if priority is not None:
+                session.headers['X-Priority'] = priority
+            while True:
+                index = self.next_index()
+                if index is None:
+                    return
+                sample = self.send(session, index)
+                if record:
+                    self.samples.append(sample + (priority,))
+
+    def drive(self, record=True):
+        """同時接続数ぶんのスレッドでリクエストを送り続け、経過秒数を返す"""
+        threads = [threading.Thread(target=self.worker, daemon=True,
+                                    args=(record, client_address(i, self.args.clients),
+                                          worker_priority(i, self.args.interactive)))
+                   for i in range(self.args.concurrency)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    # ---- 記録 ----
+
+    def history_stats(self):
+        return self.monitor.get(self.app_url + '/api/history-writer', timeout=10).json()
+
+    def sample(self):
+        """アプリのメモリと履歴キューの長さを定期的に記録する"""
+        while not self.sampling.wait(SAMPLE_INTERVAL):
+            rss = process_rss_mb(self.app_process.pid)
+            if rss is not None:
+                self.memory.append(rss)
+            try:
+                self.max_queue_depth = max(self.max_queue_depth, self.history_stats()['queue_depth'])
+            except (requests.RequestException, ValueError, KeyError):
+                pass
+
+    def wait_history(self, expected):
+        """負荷の終了から、履歴の保存が expected 件に追いつくまでの秒数（追いつかなければ None）"""
+        started = time.perf_counter()
+        while time.perf_counter() - started < DRAIN_TIMEOUT:
+            stats = self.history_stats()
+            if stats['queue_depth'] == 0 and stats['written'] + stats['failed'] >= expected:
+                return time.perf_counter() - started
+            time.sleep(0.05)
+        return None
+
+    def run(self):
+        args = self.args
+        if args.warmup:
+            print(f"🔥 ウォームアップ: {args.warmup}件")
+            warmup_requests, args.requests = args.requests, args.warmup
+            self.drive(record=False)
+            args.requests, self.issued = warmup_requests, 0
+            self.wait_history(0)  # ウォームアップの履歴を保存し終えてから計測を始める
+        before = self.history_stats()
+        rss_start = process_rss_mb(self.app_process.pid)
+
+        sampler = threading.Thread(target=self.sample, daemon=True)
+        sampler.start()
+        if args.duration:
+            self.deadline = time.monotonic() + args.duration
+        print(f"🚀 負荷テスト: {args.app} 同時接続 {args.concurrency} "
+              f"({f'{args.duration:g}秒' if args.duration else f'{args.requests}件'}, "
+              f"{'ストリーミング' if args.stream else '一括'}, /api/{args.api})")
+        elapsed = self.drive()
+
+        ok = sum(1 for _, _, error, _ in self.samples if error is None)
+        drain = self.wait_history(before['written'] + before['failed'] + ok)
+        self.sampling.set()
+        sampler.join()
+        after = self.history_stats()
+        mock_stats = self.monitor.get(self.mock_url + '/mock/stats', timeout=10).json()
+        return self.result(elapsed, before, after, drain, rss_start, mock_stats)
+
+    def priority_summary(self):
+        """優先度のクラスごとの件数・エラー数・レイテンシ"""
+        summary = {}
+        for priority in ('interactive', 'bulk'):
+            samples = [sample for sample in self.samples if sample[3] == priority]
+            summary[priority] = {
+                "requests": len(samples),
+                "errors": sum(1 for _, _, error, _ in samples if error is not None),
+                "latency_ms": percentiles([latency * 1000 for latency, _, _, _ in samples]),
+                "ttfb_ms": percentiles([first * 1000 for _, first, error, _ in samples
+                                        if first is not None and error is None])
+            }
+        return summary
+
+    def result(self, elapsed, before, after, drain, rss_start, mock_stats):
+        args = self.args
+        errors = {}
+        for _, _, error, _ in self.samples:
+            if error is not None:
+                errors[error] = errors.get(error, 0) + 1
+        ok = len(self.samples) - sum(errors.values())
+        rss_end = process_rss_mb(self.app_process.pid)
+        return {
+            "version": RESULT_VERSION,
+            "name": args.name,
+            "started_at": datetime.now().isoformat(timespec='seconds'),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": {
+                "app": args.app, "api": args.api, "stream": args.stream, "concurrency": args.concurrency,
+                "clients": args.clients, "interactive": args.interactive, "requests": None if args.duration else args.requests, "duration": args.duration,
+                "warmup": args.warmup, "prompt_chars": args.prompt_chars, "max_tokens": args.max_tokens,
+                "temperature": args.temperature,
+                "mock": {
+                    "latency_ms": args.latency_ms, "tokens_per_sec": args.tokens_per_sec,
+                    "response_tokens": args.response_tokens, "parallel": args.parallel,
+                    "error_rate": args.error_rate, "error_status": args.error_status,
+                    "disconnect_rate": args.disconnect_rate
+                }
+            },
+            "summary": {
+                "requests": len(self.samples),
+                "ok": ok,
+                "errors": errors,
+                "duration_s": round(elapsed, 3),
+                "requests_per_sec": round(len(self.samples) / elapsed, 2) if elapsed else 0.0,
+                "latency_ms": percentiles([latency * 1000 for latency, _, _, _ in self.samples]),
+                # ストリーミングでは最初のデータ、一括では本文の最初のバイトまで
+                "ttfb_ms": percentiles([first * 1000 for _, first, error, _ in self.samples
+                                        if first is not None and error is None]),
+                "by_priority": self.priority_summary() if args.interactive else None
+            },
+            "history": {
+                "written": after['written'] - before['written'],
+                "failed": after['failed'] - before['failed'],
+                "max_queue_depth": self.max_queue_depth,
+                # 負荷の終了後、キューが空になるまでの時間（None は DRAIN_TIMEOUT 内に追いつかなかった）
+                "drain_ms": round(drain * 1000, 2) if drain is not None else None,
+                "avg_wait_ms": after['avg_wait_ms'],
+                "avg_batch_size": after['avg_batch_size']
+            },
+            "memory_mb": {
+                "start": round(rss_start, 1) if rss_start is not None else None,
+                "peak": round(max(self.memory), 1) if self.memory else None,
+                "end": round(rss_end, 1) if rss_end is not None else None
+            },
+            "upstream": mock_stats
+        }
+
+def print_result(result):
+    summary = result['summary']
+    latency = summary['latency_ms'] or {}
+    ttfb = summary['ttfb_ms'] or {}
+    history = result['history']
+    memory = result['memory_mb']
+    print(f"📊 {summary['requests']}件 / {summary['duration_s']:.1f}秒 = {summary['requests_per_sec']} req/s "
+          f"(成功 {summary['ok']}件, エラー {summary['errors'] or 'なし'})")
+    print(f"⏱️ レイテンシ p50 {latency.get('p50')}ms / p95 {latency.get('p95')}ms / p99 {latency.get('p99')}ms"
+          f"（最初のバイト p50 {ttfb.get('p50')}ms / p95 {ttfb.get('p95')}ms）")
+    for priority, stats in (summary.get('by_priority') or {}).items():
+        latency = stats['latency_ms'] or {}
+        print(f"   {priority}: {stats['requests']}件 (エラー {stats['errors']}件) "
+              f"p50 {latency.get('p50')}ms / p95 {latency.get('p95')}ms / p99 {latency.get('p99')}ms")
+    print(f"💾 履歴 {history['written']}件保存, キュー最大 {history['max_queue_depth']}, "
+          f"追いつくまで {history['drain_ms']}ms, 平均保存待ち {history['avg_wait_ms']}ms")
+    print(f"🧠 メモリ {memory['start']} → 最大 {memory['peak']} → {memory['end']} MB, "
+          f"上流の生成待ち 最大 {result['upstream']['max_waiting']}件 / 平均 {result['upstream']['avg_queue_wait_ms']}ms")
+
+def default_output(args):
+    name = f"{datetime.now():%Y%m%d-%H%M%S}-{args.app}-c{args.concurrency}{'-stream' if args.stream else ''}.json"
+    return os.path.join(DEFAULT_RESULTS_DIR, name)
+
+# compare で並べる指標（結果の JSON 内のパス、表示名、大きい方が良いか）
+COMPARE_METRICS = (
+    (('summary', 'requests_per_sec'), 'requests/s', True),
+    (('summary', 'latency_ms', 'p50'), 'latency p50 ms', False),
+    (('summary', 'latency_ms', 'p95'), 'latency p95 ms', False),
+    (('summary', 'latency_ms', 'p99'), 'latency p99 ms', False),
+    (('summary', 'ttfb_ms', 'p50'), 'ttfb p50 ms', False),
+    (('summary', 'ttfb_ms', 'p95'), 'ttfb p95 ms', False),
+    (('summary', 'by_priority', 'interactive', 'latency_ms', 'p95'), 'interactive p95 ms', False),
+    (('summary', 'by_priority', 'bulk', 'latency_ms', 'p95'), 'bulk p95 ms', False),
+    (('history', 'drain_ms'), 'history drain ms', False),
+    (('history', 'avg_wait_ms'), 'history wait ms', False),
+    (('history', 'max_queue_depth'), 'history queue max', False),
+    (('memory_mb', 'peak'), 'memory peak MB', False),
+)
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+def compare(base_file, new_file):
+    """2回の結果の主な指標を並べて表示する"""
+    results = []
+    for path in (base_file, new_file):
+        with open(path, encoding='utf-8') as f:
+            results.append(json.load(f))
+    base, new = results
+    if base.get('config') != new.get('config'):
+        print("⚠️ 2つの結果は設定が異なります")
+    print(f"{'':<20}{os.path.basename(base_file):>24} {os.path.basename(new_file):>24}  変化")
+    for path, label, higher_is_better in COMPARE_METRICS:
+        before, after = lookup(base, path), lookup(new, path)
+        change = ''
+        if isinstance(before, (int, float)) and isinstance(after, (int, float)) and before:
+            ratio = (after - before) / before * 100
+            better = ratio > 0 if higher_is_better else ratio < 0
+            change = f"{ratio:+.1f}%{' ✅' if better and abs(ratio) >= 5 else ' ⚠️' if abs(ratio) >= 5 else ''}"
+        print(f"{label:<20}{str(before):>24} {str(after):>24}  {change}")
+
+def serve(app_name, port):
+    """作業ディレクトリ（カレント）の ipconfig.ini でアプリを起動する（run が子プロセスとして呼ぶ）"""
+    sys.path.insert(0, REPO_DIR)
+    module = importlib.import_module(APPS[app_name])
+    if app_name == 'flask':
+        from werkzeug.serving import make_server
+        # app.run と同じ threaded のサーバー
+        server = make_server('127.0.0.1', port, module.app, threaded=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            module.shutdown_handler()
+    else:
+        import asyncio
+        from hypercorn.asyncio import serve as hypercorn_serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = [f"127.0.0.1:{port}"]
+        config.keep_alive_timeout = 130
+        config.accesslog = None
+        try:
+            asyncio.run(hypercorn_serve(module.app, config))
+        except KeyboardInterrupt:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description="LM Studio 模擬サーバーを使った Web アプリの負荷テスト")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="負荷テストを実行して結果を JSON に保存する")
+    run_parser.add_argument('--app', choices=sorted(APPS), default='flask',
+                            help="flask: web_app.py / async: web_app_async.py")
+    run_parser.add_argument('--api', choices=['chat', 'text', 'mix'], default='chat')
+    run_parser.add_argument('--stream', action='store_true', help="ストリーミング（SSE）で受信する")
+    run_parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, help="同時接続数")
+    run_parser.add_argument('--clients', type=int, default=1,
+                            help="接続を振り分けるクライアント（X-Forwarded-For のIPアドレス）の数")
+    run_parser.add_argument('--interactive', type=int, default=0,
+                            help="X-Priority: interactive で送る接続の数（残りは bulk。0 はヘッダーなし）")
+    run_parser.add_argument('--requests', type=int, default=DEFAULT_REQUESTS, help="送信する件数")
+    run_parser.add_argument('--duration', type=float, default=0, help="件数の代わりに秒数で実行する")
+    run_parser.add_argument('--warmup', type=int, default=0, help="計測前に送る件数")
+    run_parser.add_argument('--prompt-chars', type=int, default=DEFAULT_PROMPT_CHARS)
+    run_parser.add_argument('--max-tokens', type=int, default=DEFAULT_MAX_TOKENS)
+    run_parser.add_argument('--temperature', type=float, default=0.7,
+                            help="0 にするとレスポンスキャッシュの対象になる（プロンプトは毎回異なる）")
+    run_parser.add_argument('--model', default=mock_lmstudio.DEFAULT_MODELS[0])
+    run_parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    run_parser.add_argument('--config', default=os.path.join(REPO_DIR, 'ipconfig.ini'),
+                            help="アプリに渡す ipconfig.ini（[API_SERVER] は模擬サーバーに置き換える）")
+    run_parser.add_argument('--name', default=None, help="結果に付ける名前")
+    run_parser.add_argument('--output', default=None, help=f"結果の JSON（既定は {DEFAULT_RESULTS_DIR}/ に日時付きで保存）")
+    run_parser.add_argument('--keep-workdir', action='store_true', help="作業ディレクトリ（server.log・履歴DB）を残す")
+    mock_lmstudio.add_mock_arguments(run_parser)
+
+    compare_parser = commands.add_parser('compare', help="2回の結果を比べる")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+
+    serve_parser = commands.add_parser('serve', help=argparse.SUPPRESS)
+    serve_parser.add_argument('--app', choices=sorted(APPS), default='flask')
+    serve_parser.add_argument('--port', type=int, required=True)
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve(args.app, args.port)
+        return
+    if args.command == 'compare':
+        compare(args.base, args.new)
+        return
+
+    load = LoadRun(args)
+    try:
+        load.start()
+        result = load.run()
+    finally:
+        load.stop()
+        if args.keep_workdir and load.workdir:
+            print(f"📁 作業ディレクトリ: {load.workdir}")
+    print_result(result)
+    output = args.output or default_output(args)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"✅ 結果を保存しました: {output}")
+
+if __name__ == '__main__':
+    main()
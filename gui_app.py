@@ -11,15 +11,110 @@ import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, simpledialog
 import requests
 import json
-import sqlite3
 import threading
 import time
-from datetime import datetime
 import configparser
 import os
 import sys
-from queue import Queue, Empty as queue_Empty
+import html
+from collections import OrderedDict
 import pyperclip  # クリップボード操作用
+import similarity_index
+from model_catalog import ModelCatalog, model_ids
+from history_writer import HistoryWriter
+from history_retention import load_history_retention
+import history_db
+import history_search
+
+# ストリーミング表示の描画間隔（約1フレーム）
+STREAM_FLUSH_INTERVAL_MS = 16
+
+# 検索結果として表示する件数
+HISTORY_LIST_SIZE = 50
+
+# 履歴一覧の仮想スクロール（表示中の行だけをツリーに置き、ページ単位でSQLiteから読む）
+HISTORY_PAGE_SIZE = 100
+HISTORY_CACHE_PAGES = 8
+HISTORY_ROW_HEIGHT = 22
+HISTORY_HEADING_HEIGHT = 26
+HISTORY_WHEEL_ROWS = 3
+
+# 履歴の保存が続いた場合に一覧の更新をまとめる間隔
+HISTORY_REFRESH_INTERVAL_MS = 250
+
+# 履歴一覧で読む列（idx_prompt_history_client の索引だけで返せる列に限る）
+HISTORY_LIST_COLUMNS = (
+    "id, api_type, prompt_preview, "
+    "IFNULL(strftime('%m/%d %H:%M', created_at, 'unixepoch', 'localtime'), '') AS time_str"
+)
+
+def snippet_text(snippet):
+    """検索結果のHTMLスニペットを、一致箇所を【】で囲んだ1行のテキストにする"""
+    text = snippet.replace('<mark>', '【').replace('</mark>', '】')
+    return html.unescape(text).replace('\n', ' ')
+
+class HistoryPageCache:
+    """履歴一覧のページキャッシュ（新しい順の位置で行を返し、最近使ったページだけを保持する）"""
+
+    def __init__(self, pool, client_ip, page_size=HISTORY_PAGE_SIZE, max_pages=HISTORY_CACHE_PAGES):
+        self.pool = pool
+        self.client_ip = client_ip
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.total = 0
+        self.newest_id = 0
+
+    def reset(self):
+        """件数と最新IDを数え直し、キャッシュを捨てる"""
+        with self.pool.connection() as conn:
+            self.total = history_db.history_count(conn, self.client_ip)
+            newest = history_db.recent_history(conn, self.client_ip, 1, columns='id')
+        self.newest_id = newest[0]['id'] if newest else 0
+        self.pages.clear()
+
+    def refresh(self):
+        """newest_id より新しい履歴の件数を返す（あればキャッシュを捨てる。位置がずれるため）"""
+        with self.pool.connection() as conn:
+            added = history_db.history_count(conn, self.client_ip, after_id=self.newest_id)
+            if added:
+                self.newest_id = history_db.recent_history(conn, self.client_ip, 1, columns='id')[0]['id']
+        if added:
+            self.total += added
+            self.pages.clear()
+        return added
+
+    def rows(self, offset, count):
+        """offset 件目から count 件の行を返す"""
+        end = min(offset + count, self.total)
+        rows = []
+        if end <= offset:
+            return rows
+        for index in range(offset // self.page_size, (end - 1) // self.page_size + 1):
+            page = self.page(index)
+            start = index * self.page_size
+            rows.extend(page[max(offset - start, 0):end - start])
+        return rows
+
+    def page(self, index):
+        page = self.pages.get(index)
+        if page is not None:
+            self.pages.move_to_end(index)
+            return page
+
+        previous = self.pages.get(index - 1)
+        with self.pool.connection() as conn:
+            if previous:
+                # 直前のページがあれば、その最後のIDから続きを索引の範囲検索で読む
+                page = history_db.recent_history(conn, self.client_ip, self.page_size,
+                                                 columns=HISTORY_LIST_COLUMNS, before_id=previous[-1]['id'])
+            else:
+                page = history_db.history_window(conn, self.client_ip, index * self.page_size,
+                                                 self.page_size, columns=HISTORY_LIST_COLUMNS, total=self.total)
+        self.pages[index] = page
+        if len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        return page
 
 # ツールチップクラス
 class ToolTip:
@@ -73,9 +168,36 @@ class LMStudioGUI:
         self.session = requests.Session()
         self.session.timeout = (5, 120)
         
-        # 非同期履歴保存用
-        self.history_queue = Queue()
-        self.history_thread_running = True
+        # モデル一覧のキャッシュ（前回取得した一覧を model_catalog.json から読み込む）
+        self.model_catalog = ModelCatalog(self.fetch_model_catalog)
+        
+        # 履歴の読み取り・削除用の接続プール（WALモード、Web版と同じファイルを共有しても待たされない）
+        self.db_pool = history_db.ConnectionPool('prompt_history.db', max_connections=2)
+        
+        # 非同期履歴保存用（まとめて書き込み、一覧には新しい行だけを追加する）
+        self.history_writer = HistoryWriter(
+            'prompt_history.db', on_batch=lambda batch: self.schedule_history_refresh())
+        
+        # 古い履歴のアーカイブへの移動（無効時は None。移した後は一覧を読み直す）
+        self.retention = load_history_retention(
+            db_path='prompt_history.db', on_archive=lambda archived: self.root.after(0, self.load_history))
+        
+        # 履歴一覧（仮想スクロール。検索中は history_results に検索結果を持つ）
+        self.history_pages = HistoryPageCache(self.db_pool, "localhost")
+        self.history_results = None
+        self.history_offset = 0
+        self.history_visible_rows = 18
+        self.history_render_scheduled = False
+        
+        # 履歴一覧の差分更新の予約状態
+        self.history_refresh_lock = threading.Lock()
+        self.history_refresh_scheduled = False
+        
+        # ストリーミング表示用（ワーカースレッドが追記し、メインスレッドがまとめて描画）
+        self.stream_lock = threading.Lock()
+        self.stream_buffer = []
+        self.stream_flush_scheduled = False
+        self.stream_stats = None
         
         # テーマとスタイルを設定
         self.setup_theme_and_styles()
@@ -209,6 +331,7 @@ class LMStudioGUI:
                        background=colors['white'],
                        foreground=colors['dark'],
                        fieldbackground=colors['white'],
+                       rowheight=HISTORY_ROW_HEIGHT,
                        font=('Segoe UI', 9))
         style.configure('Custom.Treeview.Heading',
                        background=colors['light'],
@@ -246,28 +369,12 @@ class LMStudioGUI:
     
     def init_db(self):
         """データベースを初期化"""
-        conn = sqlite3.connect('prompt_history.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS prompt_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            prompt TEXT NOT NULL,
-            response TEXT,
-            api_type TEXT NOT NULL,
-            timestamp TEXT NOT NULL,
-            client_ip TEXT
-        )
-        ''')
+        conn = history_db.connect('prompt_history.db', isolation_level=None)
+        history_db.migrate(conn)
         
-        # 既存のテーブルに columns がない場合は追加
-        cursor.execute("PRAGMA table_info(prompt_history)")
-        columns = [column[1] for column in cursor.fetchall()]
-        if 'response' not in columns:
-            cursor.execute('ALTER TABLE prompt_history ADD COLUMN response TEXT')
-        if 'client_ip' not in columns:
-            cursor.execute('ALTER TABLE prompt_history ADD COLUMN client_ip TEXT')
+        # 類似プロンプト検索用の索引テーブル（Web版と共有）
+        similarity_index.init_similarity_tables(conn)
         
-        conn.commit()
         conn.close()
     
     def create_widgets(self):
@@ -351,6 +458,23 @@ class LMStudioGUI:
         self.history_count_label = ttk.Label(button_frame, text="", style='Status.TLabel')
         self.history_count_label.pack(side=tk.RIGHT)
         
+        # 履歴検索（空欄のときは最新の履歴を表示）
+        search_frame = ttk.Frame(history_frame, style='Panel.TFrame')
+        search_frame.pack(fill=tk.X, pady=(0, 10))
+        
+        self.history_search_var = tk.StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.history_search_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 8))
+        search_entry.bind("<Return>", lambda event: self.load_history())
+        ToolTip(search_entry, "プロンプト・回答を検索します（Enterで検索、空白区切りですべての語を含む履歴）")
+        
+        search_btn = ttk.Button(search_frame, text="🔍 検索", command=self.load_history)
+        search_btn.pack(side=tk.LEFT, padx=(0, 8))
+        
+        reset_btn = ttk.Button(search_frame, text="✖", width=3, command=self.reset_history_search)
+        reset_btn.pack(side=tk.LEFT)
+        ToolTip(reset_btn, "検索をやめて最新の履歴を表示します")
+        
         # 履歴リスト
         tree_frame = ttk.Frame(history_frame, style='Panel.TFrame')
         tree_frame.pack(fill=tk.BOTH, expand=True)
@@ -369,13 +493,19 @@ class LMStudioGUI:
         self.history_tree.column("api", width=70, anchor='center')
         self.history_tree.column("prompt", width=250)
         
-        # スクロールバー
-        history_scroll = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, 
-                                     command=self.history_tree.yview)
-        self.history_tree.configure(yscrollcommand=history_scroll.set)
+        # スクロールバー（ツリーには表示中の行しかないため、履歴全体での位置を示す）
+        self.history_scroll = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, 
+                                          command=self.on_history_scroll)
         
         self.history_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
-        history_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        self.history_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        self.history_tree.bind("<Configure>", self.on_history_resize)
+        self.history_tree.bind("<MouseWheel>", self.on_history_wheel)
+        self.history_tree.bind("<Button-4>", self.on_history_wheel)
+        self.history_tree.bind("<Button-5>", self.on_history_wheel)
+        self.history_tree.bind("<Up>", self.on_history_key)
+        self.history_tree.bind("<Down>", self.on_history_key)
         
         # 履歴のコンテキストメニュー
         self.history_context_menu = tk.Menu(self.root, tearoff=0, 
@@ -437,6 +567,12 @@ class LMStudioGUI:
         text_radio.pack(side=tk.LEFT)
         ToolTip(text_radio, "テキスト補完API")
         
+        self.stream_var = tk.BooleanVar(value=True)
+        stream_check = ttk.Checkbutton(api_buttons_frame, text="⚡ ストリーミング",
+                                       variable=self.stream_var)
+        stream_check.pack(side=tk.LEFT, padx=(15, 0))
+        ToolTip(stream_check, "生成されたトークンを逐次表示します")
+        
         # 第2行：パラメータ
         row2 = ttk.Frame(settings_frame, style='Panel.TFrame')
         row2.pack(fill=tk.X)
@@ -591,28 +727,35 @@ class LMStudioGUI:
             self.progress.stop()
             self.progress.pack_forget()
     
+    def fetch_model_catalog(self):
+        """LM Studioからモデル一覧（/v1/models 形式）を取得"""
+        response = self.session.get(f"{self.api_url}/models", timeout=10)
+        if response.status_code != 200:
+            raise RuntimeError(f"{response.status_code}")
+        return response.json()
+    
     def load_models(self):
-        """利用可能なモデルを読み込み"""
+        """利用可能なモデルを読み込み（前回の一覧をすぐに表示し、最新の一覧はバックグラウンドで取得）"""
+        catalog, _ = self.model_catalog.get(revalidate=False)
+        if catalog is not None:
+            self.update_models_ui(model_ids(catalog), cached=True)
+        
         def fetch_models():
-            try:
-                response = self.session.get(f"{self.api_url}/models", timeout=10)
-                if response.status_code == 200:
-                    models_data = response.json()
-                    model_names = [model['id'] for model in models_data.get('data', [])]
-                    
-                    # UIを更新（メインスレッドで実行）
-                    self.root.after(0, lambda: self.update_models_ui(model_names))
-                else:
-                    self.root.after(0, lambda: self.show_error(f"モデル取得エラー: {response.status_code}"))
-            except Exception as e:
-                self.root.after(0, lambda: self.show_error(f"モデル取得エラー: {str(e)}"))
+            if self.model_catalog.refresh():
+                model_names = model_ids(self.model_catalog.get(revalidate=False)[0])
+                # UIを更新（メインスレッドで実行）
+                self.root.after(0, lambda: self.update_models_ui(model_names))
+            elif self.model_catalog.get(revalidate=False)[0] is None:
+                error = self.model_catalog.status()['last_error']
+                self.root.after(0, lambda: self.show_error(f"モデル取得エラー: {error}"))
         
         threading.Thread(target=fetch_models, daemon=True).start()
     
-    def update_models_ui(self, model_names):
-        """モデル一覧UIを更新"""
+    def update_models_ui(self, model_names, cached=False):
+        """モデル一覧UIを更新（選択中のモデルは維持する）"""
+        current = self.model_var.get()
         self.model_combo['values'] = model_names
-        if model_names:
+        if model_names and current not in model_names:
             self.model_combo.set(model_names[0])
         
         status_text = f"📡 API Server: {self.api_url}"
@@ -620,6 +763,8 @@ class LMStudioGUI:
             status_text += f" ({len(model_names)} models available)"
         else:
             status_text += " (no models)"
+        if cached:
+            status_text += " - 前回取得した一覧を表示中"
         
         self.status_label.config(text=status_text)
     
@@ -648,35 +793,41 @@ class LMStudioGUI:
                 temperature = self.temperature_var.get()
                 max_tokens = self.max_tokens_var.get()
                 api_type = self.api_type_var.get()
+                stream = self.stream_var.get()
                 
                 if api_type == "chat":
+                    url = f"{self.api_url}/chat/completions"
                     payload = {
                         "messages": [{"role": "user", "content": prompt}],
                         "temperature": temperature,
                         "max_tokens": max_tokens
                     }
-                    if model != "default":
-                        payload["model"] = model
-                    
-                    response = self.session.post(
-                        f"{self.api_url}/chat/completions",
-                        json=payload,
-                        timeout=(5, 120)
-                    )
                 else:  # text completion
+                    url = f"{self.api_url}/completions"
                     payload = {
                         "prompt": prompt,
                         "temperature": temperature,
                         "max_tokens": max_tokens
                     }
-                    if model != "default":
-                        payload["model"] = model
+                if model != "default":
+                    payload["model"] = model
+                
+                # ストリーミングモード：チャンクを逐次受信してバッファ経由で描画
+                if stream:
+                    response_text = self.stream_completion(url, payload, api_type, start_time)
+                    if response_text is None:
+                        return
+                    response_time = (time.time() - start_time) * 1000
                     
-                    response = self.session.post(
-                        f"{self.api_url}/completions",
-                        json=payload,
-                        timeout=(5, 120)
-                    )
+                    self.save_prompt_history_async(prompt, response_text, api_type, "localhost")
+                    self.root.after(0, lambda: self.finish_stream_ui(response_text, response_time))
+                    return
+                
+                response = self.session.post(
+                    url,
+                    json=payload,
+                    timeout=(5, 120)
+                )
                 
                 end_time = time.time()
                 response_time = (end_time - start_time) * 1000  # ミリ秒
@@ -722,19 +873,141 @@ class LMStudioGUI:
         
         threading.Thread(target=send_async, daemon=True).start()
     
-    def update_response_ui(self, response_text, response_time, is_success):
+    def stream_completion(self, url, payload, api_type, start_time):
+        """stream: true で送信し、SSEチャンクを読みながら表示バッファに追記する（ワーカースレッド）"""
+        with self.stream_lock:
+            self.stream_buffer = []
+            self.stream_stats = {
+                'start': start_time,
+                'first_token': None,
+                'tokens': 0,
+                'active': True
+            }
+        
+        response = self.session.post(
+            url,
+            json=dict(payload, stream=True),
+            timeout=(5, 120),
+            stream=True
+        )
+        
+        if response.status_code != 200:
+            response_time = (time.time() - start_time) * 1000
+            error_msg = f"❌ API エラー {response.status_code}\n\n{response.text}"
+            response.close()
+            self.root.after(0, lambda: self.update_response_ui(error_msg, response_time, False))
+            return None
+        
+        parts = []
+        try:
+            for line in response.iter_lines():
+                if not line or not line.startswith(b'data:'):
+                    continue
+                data = line[5:].strip().decode('utf-8')
+                if data == '[DONE]':
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                
+                choices = chunk.get('choices') or []
+                if not choices:
+                    continue
+                if api_type == "chat":
+                    delta = choices[0].get('delta', {}).get('content') or ""
+                else:
+                    delta = choices[0].get('text') or ""
+                if not delta:
+                    continue
+                
+                parts.append(delta)
+                with self.stream_lock:
+                    stats = self.stream_stats
+                    if stats['first_token'] is None:
+                        stats['first_token'] = time.time()
+                    stats['tokens'] += 1  # LM Studio は1チャンクあたり概ね1トークン
+                    self.stream_buffer.append(delta)
+                    # 描画は1フレームに1回までにまとめる
+                    if not self.stream_flush_scheduled:
+                        self.stream_flush_scheduled = True
+                        self.root.after(STREAM_FLUSH_INTERVAL_MS, self.flush_stream_buffer)
+        finally:
+            response.close()
+        
+        return "".join(parts)
+    
+    def flush_stream_buffer(self):
+        """バッファに溜まったトークンをレスポンス欄に追記（メインスレッド）"""
+        with self.stream_lock:
+            self.stream_flush_scheduled = False
+            stats = self.stream_stats
+            if not stats or not stats['active']:
+                return
+            text = "".join(self.stream_buffer)
+            self.stream_buffer = []
+            first_flush = not stats.get('rendered')
+            stats['rendered'] = True
+            first_token = stats['first_token']
+            tokens = stats['tokens']
+        
+        if text:
+            self.response_text.config(state=tk.NORMAL)
+            if first_flush:
+                # 「思考中」のプレースホルダーを消してから追記を開始
+                self.response_text.delete(1.0, tk.END)
+            self.response_text.insert(tk.END, text)
+            self.response_text.see(tk.END)
+            self.response_text.config(state=tk.DISABLED)
+        
+        if first_token is not None:
+            self.response_time_label.config(text=self.format_stream_stats(stats['start'], first_token, tokens),
+                                            foreground=self.colors['secondary'])
+    
+    def format_stream_stats(self, start, first_token, tokens, end=None):
+        """TTFT とトークン/秒の表示文字列を作成"""
+        ttft = (first_token - start) * 1000
+        elapsed = (end or time.time()) - first_token
+        rate = tokens / elapsed if elapsed > 0 else 0.0
+        return f"TTFT {ttft:.0f}ms ・ {rate:.1f} tok/s"
+    
+    def finish_stream_ui(self, response_text, response_time):
+        """ストリーミング完了時の後処理"""
+        self.flush_stream_buffer()
+        with self.stream_lock:
+            stats = self.stream_stats
+            stats['active'] = False
+            self.stream_buffer = []
+        
+        stream_info = None
+        if stats['first_token'] is not None:
+            stream_info = self.format_stream_stats(stats['start'], stats['first_token'],
+                                                   stats['tokens'], end=stats['start'] + response_time / 1000)
+        self.update_response_ui(response_text, response_time, True,
+                                streamed=bool(stats.get('rendered')), stream_info=stream_info)
+    
+    def update_response_ui(self, response_text, response_time, is_success, streamed=False, stream_info=None):
         """レスポンスUIを更新"""
         # プログレスバーを非表示
         self.show_progress(False)
         
+        # ストリーミング中の描画を停止
+        with self.stream_lock:
+            if self.stream_stats:
+                self.stream_stats['active'] = False
+        
         # レスポンス表示を更新
         self.response_text.config(state=tk.NORMAL)
-        self.response_text.delete(1.0, tk.END)
         
-        if is_success:
+        if is_success and streamed:
+            # ストリーミング済みの場合は表示済みのテキストをそのまま残す
+            pass
+        elif is_success:
             # 成功時は普通のテキスト
+            self.response_text.delete(1.0, tk.END)
             self.response_text.insert(tk.END, response_text)
         else:
+            self.response_text.delete(1.0, tk.END)
             # エラー時は強調表示
             self.response_text.insert(tk.END, response_text)
             # エラーテキストを赤色に（簡易的）
@@ -760,6 +1033,9 @@ class LMStudioGUI:
         else:
             time_text = f"❌ {response_time:.0f}ms"
             time_color = self.colors['accent']
+        
+        if stream_info:
+            time_text = f"{time_text} ({stream_info})"
             
         self.response_time_label.config(text=time_text, foreground=time_color)
     
@@ -781,80 +1057,171 @@ class LMStudioGUI:
     
     def start_history_worker(self):
         """履歴保存ワーカーを開始"""
-        def history_worker():
-            while self.history_thread_running:
-                try:
-                    history_data = self.history_queue.get(timeout=1)
-                    if history_data is None:
-                        break
-                    
-                    prompt, response, api_type, client_ip = history_data
-                    
-                    conn = sqlite3.connect('prompt_history.db')
-                    cursor = conn.cursor()
-                    timestamp = datetime.now().isoformat()
-                    cursor.execute(
-                        'INSERT INTO prompt_history (prompt, response, api_type, timestamp, client_ip) VALUES (?, ?, ?, ?, ?)',
-                        (prompt, response, api_type, timestamp, client_ip)
-                    )
-                    conn.commit()
-                    conn.close()
-                    
-                    # 履歴保存完了後にUIを更新
-                    self.root.after(0, self.load_history)
-                    
-                    self.history_queue.task_done()
-                    
-                except queue_Empty:
-                    continue
-                except Exception as e:
-                    print(f"❌ 履歴保存エラー: {e}")
-        
-        threading.Thread(target=history_worker, daemon=True).start()
+        self.history_writer.start()
+        if self.retention is not None:
+            self.retention.start()
     
     def save_prompt_history_async(self, prompt, response, api_type, client_ip):
-        """履歴を非同期で保存"""
+        """履歴を非同期で保存（保存完了を待つための PendingWrite を返す）"""
         try:
-            self.history_queue.put((prompt, response, api_type, client_ip), timeout=1)
+            return self.history_writer.submit(prompt, response, api_type, client_ip)
         except Exception as e:
             print(f"❌ 履歴キューエラー: {e}")
+            return None
     
     def load_history(self):
-        """履歴を読み込み"""
+        """履歴を読み込み（検索語がある場合は検索結果を表示）"""
+        query = self.history_search_var.get().strip()
         try:
-            conn = sqlite3.connect('prompt_history.db')
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            
-            cursor.execute(
-                'SELECT * FROM prompt_history WHERE client_ip = ? OR client_ip IS NULL ORDER BY id DESC LIMIT 50',
-                ("localhost",)
-            )
-            history = [dict(row) for row in cursor.fetchall()]
-            conn.close()
-            
-            # 履歴ツリーをクリア
-            for item in self.history_tree.get_children():
-                self.history_tree.delete(item)
-            
-            # 履歴項目を追加
-            for item in history:
-                # タイムスタンプをフォーマット
-                timestamp = datetime.fromisoformat(item['timestamp'])
-                time_str = timestamp.strftime("%m/%d %H:%M")
-                
-                # プロンプトを短縮
-                prompt_preview = item['prompt'][:50] + "..." if len(item['prompt']) > 50 else item['prompt']
-                
-                self.history_tree.insert("", "end", iid=item['id'],
-                                       text=str(item['id']),
-                                       values=(time_str, item['api_type'], prompt_preview))
+            if query:
+                with self.db_pool.connection() as conn:
+                    results = history_search.search(conn, "localhost", query, HISTORY_LIST_SIZE)
+                # 一致箇所を【】で囲んだスニペットを表示する（時刻は ISO 形式から MM/DD HH:MM を切り出す）
+                self.history_results = [{
+                    'id': item['id'],
+                    'api_type': item['api_type'],
+                    'time_str': item['timestamp'][5:16].replace('-', '/').replace('T', ' '),
+                    'prompt_preview': snippet_text(item['prompt_snippet'])
+                } for item in results]
+                self.history_offset = 0
+                self.history_count_label.config(text=f"検索結果: {len(results)}件")
+            else:
+                # 件数だけを数え、行は表示する分だけページ単位で読む
+                self.history_results = None
+                self.history_pages.reset()
+                self.history_count_label.config(text=f"履歴: {self.history_pages.total}件")
             
-            self.history_count_label.config(text=f"履歴: {len(history)}件")
+            self.history_offset = self.clamp_history_offset(self.history_offset)
+            self.render_history()
             
         except Exception as e:
             self.show_error(f"履歴読み込みエラー: {str(e)}")
     
+    def history_total(self):
+        """一覧の全体の件数"""
+        if self.history_results is not None:
+            return len(self.history_results)
+        return self.history_pages.total
+    
+    def clamp_history_offset(self, offset):
+        return min(max(0, offset), max(0, self.history_total() - self.history_visible_rows))
+    
+    def scroll_history_to(self, offset):
+        """一覧の先頭に表示する位置を変え、描画を予約（ドラッグ中の連続した移動は1回の描画にまとめる）"""
+        self.history_offset = self.clamp_history_offset(offset)
+        if not self.history_render_scheduled:
+            self.history_render_scheduled = True
+            self.root.after_idle(self.render_history)
+    
+    def render_history(self):
+        """表示中の位置の行だけをツリーに置く"""
+        self.history_render_scheduled = False
+        try:
+            if self.history_results is not None:
+                rows = self.history_results[self.history_offset:self.history_offset + self.history_visible_rows]
+            else:
+                rows = self.history_pages.rows(self.history_offset, self.history_visible_rows)
+        except Exception as e:
+            self.show_error(f"履歴読み込みエラー: {str(e)}")
+            return
+        
+        selected = self.history_tree.selection()
+        children = self.history_tree.get_children()
+        if children:
+            self.history_tree.delete(*children)
+        for item in rows:
+            self.history_tree.insert("", "end", iid=item['id'],
+                                   text=str(item['id']),
+                                   values=(item['time_str'], item['api_type'], item['prompt_preview']))
+        # 選択中の行がまだ表示範囲にあれば選択を保つ
+        kept = [iid for iid in selected if self.history_tree.exists(iid)]
+        if kept:
+            self.history_tree.selection_set(kept)
+        
+        total = self.history_total()
+        if total:
+            self.history_scroll.set(self.history_offset / total,
+                                    min(1.0, (self.history_offset + len(rows)) / total))
+        else:
+            self.history_scroll.set(0.0, 1.0)
+    
+    def on_history_scroll(self, action, amount, unit=None):
+        """スクロールバーの操作（moveto: ドラッグ、scroll: 矢印・空き部分のクリック）"""
+        if action == 'moveto':
+            self.scroll_history_to(int(float(amount) * self.history_total()))
+        elif action == 'scroll':
+            step = self.history_visible_rows if unit == 'pages' else 1
+            self.scroll_history_to(self.history_offset + int(amount) * step)
+    
+    def on_history_wheel(self, event):
+        """マウスホイールで一覧をスクロール（Windows/macOS は delta、Linux は Button-4/5）"""
+        direction = -1 if event.num == 4 or event.delta > 0 else 1
+        self.scroll_history_to(self.history_offset + direction * HISTORY_WHEEL_ROWS)
+        return "break"
+    
+    def on_history_resize(self, event):
+        """ツリーの高さに合わせて表示する行数を変える"""
+        visible = max(1, (event.height - HISTORY_HEADING_HEIGHT) // HISTORY_ROW_HEIGHT)
+        if visible != self.history_visible_rows:
+            self.history_visible_rows = visible
+            self.scroll_history_to(self.history_offset)
+    
+    def on_history_key(self, event):
+        """表示範囲の端で上下キーを押したら、1行スクロールして選択を移す"""
+        children = self.history_tree.get_children()
+        focus = self.history_tree.focus()
+        if event.keysym == 'Up':
+            if not children or focus != children[0] or self.history_offset == 0:
+                return None
+            self.history_offset = self.clamp_history_offset(self.history_offset - 1)
+        else:
+            if not children or focus != children[-1] or \
+                    self.history_offset + len(children) >= self.history_total():
+                return None
+            self.history_offset = self.clamp_history_offset(self.history_offset + 1)
+        self.render_history()
+        children = self.history_tree.get_children()
+        if children:
+            target = children[0] if event.keysym == 'Up' else children[-1]
+            self.history_tree.selection_set(target)
+            self.history_tree.focus(target)
+        return "break"
+    
+    def schedule_history_refresh(self):
+        """履歴一覧の差分更新を予約（書き込みスレッドから呼ばれる。予約済みなら何もしない）"""
+        with self.history_refresh_lock:
+            if self.history_refresh_scheduled:
+                return
+            self.history_refresh_scheduled = True
+        self.root.after(HISTORY_REFRESH_INTERVAL_MS, self.refresh_history)
+    
+    def refresh_history(self):
+        """表示中の最新IDより新しい履歴があれば件数を更新して描画し直す（メインスレッド）"""
+        with self.history_refresh_lock:
+            self.history_refresh_scheduled = False
+        # 検索結果の表示中は一覧を変えない（検索をやめたときに読み直す）
+        if self.history_results is not None:
+            return
+        try:
+            added = self.history_pages.refresh()
+        except Exception as e:
+            self.show_error(f"履歴読み込みエラー: {str(e)}")
+            return
+        if not added:
+            return
+        
+        # 先頭を表示中なら新しい履歴を見せ、スクロール中なら表示中の行がずれないようにする
+        if self.history_offset > 0:
+            self.history_offset += added
+        self.history_count_label.config(text=f"履歴: {self.history_pages.total}件")
+        self.render_history()
+    
+    def reset_history_search(self):
+        """検索語を消して最新の履歴を表示"""
+        self.history_search_var.set("")
+        self.history_offset = 0
+        self.load_history()
+    
     def show_history_context_menu(self, event):
         """履歴のコンテキストメニューを表示"""
         item = self.history_tree.selection()[0] if self.history_tree.selection() else None
@@ -946,14 +1313,9 @@ class LMStudioGUI:
                               "この履歴項目を削除しますか？\n\nこの操作は取り消せません。",
                               icon="warning"):
             try:
-                conn = sqlite3.connect('prompt_history.db')
-                cursor = conn.cursor()
-                cursor.execute(
-                    'DELETE FROM prompt_history WHERE id = ? AND (client_ip = ? OR client_ip IS NULL)',
-                    (item_id, "localhost")
-                )
-                conn.commit()
-                conn.close()
+                with self.db_pool.connection() as conn:
+                    history_db.delete_history(conn, "localhost", item_id)
+                    conn.commit()
                 
                 self.load_history()
                 self.status_label.config(text="🗑️ 履歴項目を削除しました")
@@ -968,15 +1330,9 @@ class LMStudioGUI:
                               "すべての履歴を削除しますか？\n\n⚠️ この操作は取り消せません。",
                               icon="warning"):
             try:
-                conn = sqlite3.connect('prompt_history.db')
-                cursor = conn.cursor()
-                cursor.execute(
-                    'DELETE FROM prompt_history WHERE client_ip = ? OR client_ip IS NULL',
-                    ("localhost",)
-                )
-                deleted_count = cursor.rowcount
-                conn.commit()
-                conn.close()
+                with self.db_pool.connection() as conn:
+                    deleted_count = history_db.clear_history(conn, "localhost")
+                    conn.commit()
                 
                 self.load_history()
                 self.status_label.config(text=f"🗑️ {deleted_count}件の履歴を削除しました")
@@ -988,15 +1344,11 @@ class LMStudioGUI:
     def get_history_item_data(self, item_id):
         """履歴項目のデータを取得"""
         try:
-            conn = sqlite3.connect('prompt_history.db')
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT * FROM prompt_history WHERE id = ? AND (client_ip = ? OR client_ip IS NULL)',
-                (item_id, "localhost")
-            )
-            result = cursor.fetchone()
-            conn.close()
+            with self.db_pool.connection() as conn:
+                result = conn.execute(
+                    'SELECT * FROM history_entries WHERE id = ? AND (client_ip = ? OR client_ip IS NULL)',
+                    (item_id, "localhost")
+                ).fetchone()
             return dict(result) if result else None
         except Exception as e:
             self.show_error(f"履歴取得エラー: {str(e)}")
@@ -1011,9 +1363,11 @@ class LMStudioGUI:
         """アプリケーション終了時の処理"""
         print("🛑 アプリケーションを終了中...")
         
-        # 履歴保存スレッドを停止
-        self.history_thread_running = False
-        self.history_queue.put(None)
+        # キューに残っている履歴を書き込んでから履歴保存スレッドを停止
+        self.history_writer.stop()
+        if self.retention is not None:
+            self.retention.stop()
+        self.db_pool.close()
         
         # セッションを閉じる
         self.session.close()
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""
+prompt_history.db の書き込み・読み出しのマイクロベンチマーク
+
+日本語と英語が混ざった、実際に近い長さの分布のプロンプトと回答を、多数の client_ip（件数は偏らせる）で
+10k〜10M 件生成し、その上でアプリと同じ関数の所要時間を測る。
+
+- insert_sequential / insert_burst: HistoryWriter（1件ずつ保存を待つ場合と、まとめて投入した場合）
+- list_first_page / list_deep_page: Web版の履歴一覧（history_db.history_page。先頭と途中のページ）
+- gui_window: GUI版の履歴一覧（history_count と任意の位置の history_window）
+- delete_single / clear_client: 1件の削除とクライアントごとの全削除（history_db.delete_history / clear_history）
+
+結果（件数/秒・p50/p95/p99・DBファイルのサイズ）は JSON に保存し、compare でコミット間の差を確認できる。
+
+    python history_benchmark.py run --sizes 10k,100k
+    python history_benchmark.py run --sizes 1m --data-dir history_benchmark_data
+    python history_benchmark.py compare benchmark_results/history-before.json benchmark_results/history-after.json
+
+生成したDBは --data-dir を指定すると残し、次回は同じ件数・乱数の種のものを再利用する
+（計測は毎回そのコピーに対して行う）。1M件以上は生成に時間がかかるため --data-dir の指定を推奨。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+from itertools import accumulate
+
+import history_db
+import history_store
+from benchmark import DEFAULT_RESULTS_DIR, git_commit, lookup, percentiles
+from history_writer import HistoryWriter, PendingWrite
+
+# デフォルト設定
+DEFAULT_SIZES = '10k,100k'
+DEFAULT_CLIENTS = 1000
+DEFAULT_OPS = 500
+DEFAULT_BURST = 2000
+DEFAULT_CLEARS = 5
+DEFAULT_DAYS = 365
+SEED_BATCH_SIZE = 2000  # 生成時は HistoryWriter と同じ write_batch を大きなトランザクションで呼ぶ
+
+JAPANESE_RATIO = 0.6
+SHARED_RATIO = 0.005  # client_ip が NULL（共有）の履歴の割合
+TEMPLATE_RATIO = 0.1  # 定型プロンプト（同じ本文）の割合
+TEMPLATE_COUNT = 200
+CHAT_RATIO = 0.8
+CLIENT_SKEW = 1.1  # client_ip ごとの件数の偏り（Zipf の指数）
+
+# 本文の長さ（文字数）の対数正規分布: (中央値, σ, 上限)
+PROMPT_LENGTH = (120, 1.0, 8000)
+RESPONSE_LENGTH = (700, 0.9, 20000)
+
+JA_WORDS = (
+    'この', 'コード', 'を', 'レビュー', 'して', 'ください', '関数', 'の', '処理', 'が', '遅い', '理由', 'は',
+    '何', 'ですか', 'データベース', 'に', '保存', 'する', '方法', '設定', 'ファイル', '読み込み', 'エラー',
+    '発生', 'しました', '次', '手順', '説明', '例', '示し', 'ます', 'まず', 'また', 'ただし', '場合',
+    '注意', '必要', 'あります', '結果', '以下', 'とおり', 'です', '日本語', '翻訳', '要約', '文章',
+    '会議', '議事録', 'メール', '返信', '丁寧', '表現', '改善', '提案', '性能', 'テスト', '追加'
+)
+EN_WORDS = (
+    'please', 'explain', 'the', 'difference', 'between', 'a', 'list', 'and', 'tuple', 'in', 'python',
+    'how', 'do', 'I', 'write', 'function', 'that', 'returns', 'sorted', 'values', 'from', 'database',
+    'query', 'is', 'slow', 'when', 'table', 'has', 'many', 'rows', 'index', 'on', 'column', 'here',
+    'example', 'you', 'can', 'use', 'following', 'code', 'this', 'will', 'print', 'result', 'note',
+    'should', 'also', 'consider', 'memory', 'usage', 'performance', 'error', 'message', 'summary',
+    'meeting', 'notes', 'translate', 'into', 'english', 'step', 'first', 'then', 'finally'
+)
+SENTENCE_POOL = 3000  # 言語ごとに用意する文の数（本文は文を並べて作る）
+
+class SyntheticHistory:
+    """合成した履歴の行を作る（乱数の種が同じなら同じ内容になる）"""
+
+    def __init__(self, seed=0, clients=DEFAULT_CLIENTS):
+        self.random = random.Random(seed)
+        self.clients = [f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}" for i in range(1, clients + 1)]
+        # 件数の多いクライアントと少ないクライアントを作る（i 番目の重み 1 / i^CLIENT_SKEW）
+        weights = [1 / (rank ** CLIENT_SKEW) for rank in range(1, clients + 1)]
+        self.client_weights = list(accumulate(weights))
+        self.sentences = {
+            'ja': [self.sentence(JA_WORDS, '', '。') for _ in range(SENTENCE_POOL)],
+            'en': [self.sentence(EN_WORDS, ' ', '.') for _ in range(SENTENCE_POOL)]
+        }
+        self.templates = [self.text(PROMPT_LENGTH) for _ in range(TEMPLATE_COUNT)]
+
+    def sentence(self, words, separator, end):
+        return separator.join(self.random.choice(words) for _ in range(self.random.randint(4, 14))) + end
+
+    def text(self, distribution, language=None):
+        median, sigma, limit = distribution
+        length = max(1, min(limit, int(self.random.lognormvariate(math.log(median), sigma))))
+        if language is None:
+            language = 'ja' if self.random.random() < JAPANESE_RATIO else 'en'
+        pool = self.sentences[language]
+        separator = '' if language == 'ja' else ' '
+        parts = []
+        total = 0
+        while total < length:
+            sentence = self.random.choice(pool)
+            parts.append(sentence)
+            total += len(sentence) + len(separator)
+            if self.random.random() < 0.15:
+                parts.append('\n')
+        return separator.join(parts)[:length]
+
+    def client(self):
+        """履歴の client_ip（件数の偏りに従って選ぶ。SHARED_RATIO の割合で None）"""
+        if self.random.random() < SHARED_RATIO:
+            return None
+        return self.random.choices(self.clients, cum_weights=self.client_weights)[0]
+
+    def row(self):
+        """(prompt, response, api_type, client_ip)"""
+        if self.random.random() < TEMPLATE_RATIO:
+            prompt = self.random.choice(self.templates)
+        else:
+            prompt = self.text(PROMPT_LENGTH)
+        api_type = 'chat' if self.random.random() < CHAT_RATIO else 'text'
+        return prompt, self.text(RESPONSE_LENGTH), api_type, self.client()
+
+def parse_size(label):
+    """'10k' / '1m' / '10000' を件数にする"""
+    label = label.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(label[-1:], 1)
+    return int(float(label.rstrip('km')) * scale)
+
+def size_label(rows):
+    if rows >= 1000000 and rows % 1000000 == 0:
+        return f"{rows // 1000000}m"
+    if rows >= 1000 and rows % 1000 == 0:
+        return f"{rows // 1000}k"
+    return str(rows)
+
+@contextlib.contextmanager
+def quiet():
+    """HistoryWriter などのバッチごとのログを出さない"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def measure(operation, inputs):
+    """inputs の各要素で operation を呼び、件数/秒とレイテンシ（ミリ秒）を返す"""
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        began = time.perf_counter()
+        operation(item)
+        latencies.append((time.perf_counter() - began) * 1000)
+    elapsed = time.perf_counter() - started
+    return {"ops": len(latencies), "ops_per_sec": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "latency_ms": percentiles(latencies)}
+
+def file_stats(db_path, rows):
+    """チェックポイント後のDBファイル（と WAL）のサイズ"""
+    conn = history_db.connect(db_path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    finally:
+        conn.close()
+    size = os.path.getsize(db_path)
+    wal = db_path + '-wal'
+    return {
+        "db_mb": round(size / 1024 / 1024, 2),
+        "wal_mb": round(os.path.getsize(wal) / 1024 / 1024, 2) if os.path.exists(wal) else 0.0,
+        "bytes_per_row": round(size / rows, 1) if rows else None,
+        "free_mb": round(freelist * page_size / 1024 / 1024, 2)
+    }
+
+class HistoryBenchmark:
+    """1つの件数での計測（生成したDBのコピーに対して行う）"""
+
+    def __init__(self, args, rows, data_dir):
+        self.args = args
+        self.rows = rows
+        self.data_dir = data_dir
+        self.synthetic = SyntheticHistory(args.seed, args.clients)
+        self.pick = random.Random(args.seed + 1)  # 計測対象の選択用（生成とは別の乱数）
+        self.seed_path = os.path.join(data_dir, f"history_{size_label(rows)}_seed{args.seed}_c{args.clients}.db")
+        self.db_path = os.path.join(data_dir, 'work.db')
+
+    # ---- 生成 ----
+
+    def seed(self):
+        """合成した履歴のDBを作る（作成済みなら再利用）。生成の統計を返す"""
+        if os.path.exists(self.seed_path):
+            print(f"♻️ 生成済みのDBを使います: {self.seed_path}")
+            return None
+        history_store.reset_dictionary_cache()
+        path = self.seed_path + '.partial'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        conn = history_db.connect(path, isolation_level=None)
+        history_db.migrate(conn)
+        writer = HistoryWriter(path)
+        start_time = time.time() - self.args.days * 86400
+        step = self.args.days * 86400 / self.rows
+        written = 0
+        started = time.perf_counter()
+        trained = not self.args.dictionary
+        try:
+            while written < self.rows:
+                batch = []
+                for index in range(written, min(self.rows, written + SEED_BATCH_SIZE)):
+                    item = PendingWrite(*self.synthetic.row())
+                    item.requested_at = start_time + index * step
+                    batch.append(item)
+                with quiet():
+                    writer.write_batch(conn, batch)
+                if any(item.error for item in batch):
+                    raise RuntimeError(batch[0].error)
+                written += len(batch)
+                if not trained and written >= min(self.rows, history_store.TRAIN_SAMPLE_ROWS):
+                    # history_store.py migrate と同じく、最初の履歴から圧縮辞書を学習する
+                    conn.isolation_level = ''
+                    history_store.train(conn)
+                    conn.isolation_level = None
+                    trained = True
+                if written % (SEED_BATCH_SIZE * 10) == 0:
+                    rate = written / (time.perf_counter() - started)
+                    print(f"  … {written:,}/{self.rows:,}件（{rate:.0f}件/秒、残り約{(self.rows - written) / rate / 60:.0f}分）")
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            conn.close()
+        elapsed = time.perf_counter() - started
+        os.replace(path, self.seed_path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        return {"rows": self.rows, "seconds": round(elapsed, 1), "rows_per_sec": round(self.rows / elapsed, 1)}
+
+    def prepare(self):
+        """生成したDBを作業用にコピーする（削除・追加の計測で生成したDBを変えないため）"""
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+        shutil.copyfile(self.seed_path, self.db_path)
+        history_store.reset_dictionary_cache()
+
+    # ---- 計測対象の選択 ----
+
+    def random_rows(self, conn, count):
+        """ランダムな既存の行の (id, client_ip)"""
+        low, high = conn.execute('SELECT MIN(id), MAX(id) FROM prompt_history').fetchone()
+        rows = []
+        while len(rows) < count:
+            row = conn.execute('SELECT id, client_ip FROM prompt_history WHERE id >= ? ORDER BY id LIMIT 1',
+                               (self.pick.randint(low, high),)).fetchone()
+            if row is not None:
+                rows.append((row[0], row[1]))
+        return rows
+
+    def busy_client(self):
+        """アクセスの多いクライアントほど選ばれやすい"""
+        return self.pick.choices(self.synthetic.clients, cum_weights=self.synthetic.client_weights)[0]
+
+    # ---- 計測 ----
+
+    def run(self):
+        args = self.args
+        seed_stats = self.seed()
+        self.prepare()
+        result = {"rows": self.rows, "seed": seed_stats, "file": file_stats(self.db_path, self.rows)}
+        pool = history_db.ConnectionPool(self.db_path)
+        try:
+            with pool.connection() as conn:
+                targets = self.random_rows(conn, args.ops)
+                clients = [self.busy_client() for _ in range(args.ops)]
+                deep = [(client_ip or self.busy_client(), row_id) for row_id, client_ip in targets]
+                totals = {client: history_db.history_count(conn, client) for client in set(clients)}
+
+                result["list_first_page"] = measure(
+                    lambda client: history_db.history_page(conn, client, history_db.PAGE_SIZE), clients)
+                result["list_deep_page"] = measure(
+                    lambda item: history_db.history_page(conn, item[0], history_db.PAGE_SIZE, before_id=item[1]),
+                    deep)
+                result["gui_window"] = measure(lambda client: (
+                    history_db.history_count(conn, client),
+                    history_db.history_window(conn, client, self.pick.randrange(max(1, totals[client])),
+                                              GUI_PAGE_SIZE, columns=GUI_LIST_COLUMNS, total=totals[client])
+                ), clients)
+
+            result["insert_sequential"] = self.insert_sequential(min(args.ops, 200))
+            result["insert_burst"] = self.insert_burst(args.burst)
+
+            with pool.connection() as conn:
+                targets = self.random_rows(conn, args.ops)
+
+                def delete(item):
+                    history_db.delete_history(conn, item[1], item[0])
+                    conn.commit()
+
+                result["delete_single"] = measure(delete, targets)
+                result["clear_client"] = self.clear_clients(conn)
+        finally:
+            pool.close()
+        result["file_after"] = file_stats(self.db_path, self.rows)
+        return result
+
+    def insert_sequential(self, count):
+        """1件ずつ保存を待つ（応答のたびに1件の履歴が届く場合。batch_wait_ms の待ちを含む）"""
+        writer = HistoryWriter(self.db_path)
+        writer.start()
+        try:
+            with quiet():
+                return measure(lambda row: writer.submit(*row).wait(30), [self.synthetic.row() for _ in range(count)])
+        finally:
+            with quiet():
+                writer.stop()
+
+    def insert_burst(self, count):
+        """count 件を一度に投入し、すべての保存が終わるまで（保存までの時間は1件ごと）"""
+        completed = {}
+
+        def on_batch(batch):
+            finished = time.perf_counter()
+            for item in batch:
+                completed[item] = finished
+
+        writer = HistoryWriter(self.db_path, on_batch=on_batch)
+        rows = [self.synthetic.row() for _ in range(count)]
+        writer.start()
+        try:
+            with quiet():
+                started = time.perf_counter()
+                items = [writer.submit(*row) for row in rows]
+                for item in items:
+                    item.wait(60)
+                elapsed = time.perf_counter() - started
+                batches = writer.stats()['batches']
+        finally:
+            with quiet():
+                writer.stop()
+        latencies = [(completed[item] - item.submitted) * 1000 for item in items if item in completed]
+        return {"ops": count, "ops_per_sec": round(count / elapsed, 1), "batches": batches,
+                "latency_ms": percentiles(latencies)}
+
+    def clear_clients(self, conn):
+        """件数が中くらいのクライアントの履歴をすべて削除する（削除した件数/秒も返す）"""
+        ranks = range(10, 10 + self.args.clears)
+        clients = [self.synthetic.clients[rank] for rank in ranks if rank < len(self.synthetic.clients)]
+        deleted = []
+
+        def clear(client):
+            deleted.append(history_db.clear_history(conn, client))
+            conn.commit()
+
+        started = time.perf_counter()
+        result = measure(clear, clients)
+        elapsed = time.perf_counter() - started
+        result["rows_deleted"] = sum(deleted)
+        result["rows_per_sec"] = round(sum(deleted) / elapsed, 1) if elapsed else None
+        return result
+
+# GUI版の一覧と同じ読み方（gui_app は tkinter を読み込むため、列と件数はここに写す）
+GUI_PAGE_SIZE = 100
+GUI_LIST_COLUMNS = (
+    "id, api_type, prompt_preview, "
+    "IFNULL(strftime('%m/%d %H:%M', created_at, 'unixepoch', 'localtime'), '') AS time_str"
+)
+
+def print_size_result(label, result):
+    print(f"📊 {label}件: DB {result['file']['db_mb']}MB（{result['file']['bytes_per_row']}バイト/件）")
+    for name in ('insert_sequential', 'insert_burst', 'list_first_page', 'list_deep_page', 'gui_window',
+                 'delete_single', 'clear_client'):
+        item = result[name]
+        latency = item['latency_ms'] or {}
+        print(f"  {name:<18}{item['ops_per_sec']!s:>10} ops/s  p50 {latency.get('p50')}ms  "
+              f"p95 {latency.get('p95')}ms  p99 {latency.get('p99')}ms")
+
+def flatten(value, prefix=()):
+    """結果の数値を (パス, 値) の列にする"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from flatten(item, prefix + (key,))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+# 比較する指標の末尾の名前（True は大きい方が良い）
+COMPARE_KEYS = {'ops_per_sec': True, 'rows_per_sec': True, 'p50': False, 'p95': False, 'p99': False,
+                'db_mb': False, 'bytes_per_row': False}
+
+def compare(base_file, new_file, threshold):
+    """2回の結果を件数ごとに比べ、threshold % 以上変わった指標に印を付ける"""
+    results = []
+    for path in (base_file, new_file):
+        with open(path, encoding='utf-8') as f:
+            results.append(json.load(f))
+    base, new = results
+    if base.get('config') != new.get('config'):
+        print("⚠️ 2つの結果は設定が異なります")
+    print(f"{base.get('git_commit')} → {new.get('git_commit')}")
+    for path, before in flatten(base.get('sizes', {})):
+        if path[-1] not in COMPARE_KEYS or path[1] in ('seed', 'file_after'):
+            continue
+        after = lookup(new.get('sizes', {}), path)
+        if not isinstance(after, (int, float)) or not before:
+            continue
+        ratio = (after - before) / before * 100
+        mark = ''
+        if abs(ratio) >= threshold:
+            mark = '✅' if (ratio > 0) == COMPARE_KEYS[path[-1]] else '⚠️ 劣化'
+        print(f"{'.'.join(path):<44}{before:>12}{after:>12} {ratio:+7.1f}% {mark}")
+
+def main():
+    parser = argparse.ArgumentParser(description="prompt_history.db の書き込み・読み出しのベンチマーク")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="合成した履歴で計測して結果を JSON に保存する")
+    run_parser.add_argument('--sizes', default=DEFAULT_SIZES, help="件数（カンマ区切り。例: 10k,100k,1m,10m）")
+    run_parser.add_argument('--clients', type=int, default=DEFAULT_CLIENTS, help="client_ip の数")
+    run_parser.add_argument('--ops', type=int, default=DEFAULT_OPS, help="読み出し・削除の計測回数")
+    run_parser.add_argument('--burst', type=int, default=DEFAULT_BURST, help="insert_burst で投入する件数")
+    run_parser.add_argument('--clears', type=int, default=DEFAULT_CLEARS, help="全削除するクライアントの数")
+    run_parser.add_argument('--days', type=float, default=DEFAULT_DAYS, help="生成する履歴の期間（日）")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--no-dictionary', dest='dictionary', action='store_false',
+                            help="圧縮辞書を学習しない（history_store.py migrate を実行していないDBと同じ）")
+    run_parser.add_argument('--data-dir', default=None, help="生成したDBを残して再利用するディレクトリ")
+    run_parser.add_argument('--output', default=None, help=f"結果の JSON（既定は {DEFAULT_RESULTS_DIR}/ に日時付きで保存）")
+
+    compare_parser = commands.add_parser('compare', help="2回の結果を比べる")
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=10.0, help="印を付ける変化の大きさ（%）")
+
+    args = parser.parse_args()
+    if args.command == 'compare':
+        compare(args.base, args.new, args.threshold)
+        return
+
+    sizes = [parse_size(label) for label in args.sizes.split(',') if label.strip()]
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='history-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    result = {
+        "version": 1,
+        "started_at": datetime.now().isoformat(timespec='seconds'),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "config": {"clients": args.clients, "ops": args.ops, "burst": args.burst, "clears": args.clears,
+                   "days": args.days, "seed": args.seed, "dictionary": args.dictionary},
+        "sizes": {}
+    }
+    try:
+        for rows in sizes:
+            label = size_label(rows)
+            print(f"🏗️ {label}件の履歴で計測します")
+            benchmark = HistoryBenchmark(args, rows, data_dir)
+            result["sizes"][label] = benchmark.run()
+            print_size_result(label, result["sizes"][label])
+    finally:
+        history_store.reset_dictionary_cache()
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        else:
+            for suffix in ('', '-wal', '-shm'):
+                path = os.path.join(data_dir, 'work.db' + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    output = args.output or os.path.join(DEFAULT_RESULTS_DIR, f"history-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"✅ 結果を保存しました: {output}")
+
+if __name__ == '__main__':
+    main()
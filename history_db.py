@@ -0,0 +1,460 @@
+# -*- coding: utf-8 -*-
+"""
+prompt_history.db への接続層
+
+すべての接続を WAL モードで開き、busy_timeout・synchronous・cache_size を揃える。
+WAL では読み取りが書き込みスレッドのコミットを待たないため、Web版とGUI版が同じファイルを
+使っても "database is locked" になりにくい。
+
+読み取り・削除は ConnectionPool から接続を借りて行う。接続は使い回すため、
+sqlite3 の接続ごとのステートメントキャッシュにより同じSQLの準備（prepare）が省略される。
+
+本文（prompt / response）は history_store の圧縮ストアに保存し、読み出しは history_entries ビューから行う。
+
+スキーマの変更は MIGRATIONS に順番に並べ、適用済みの番号を PRAGMA user_version に記録する。
+Web版・GUI版とも起動時に migrate() を呼び、未適用のものだけを1つずつトランザクションで適用する。
+"""
+
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from queue import LifoQueue, Empty as queue_Empty
+
+import history_store
+
+# デフォルト設定
+DEFAULT_DB_PATH = 'prompt_history.db'
+DEFAULT_POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KB = 16 * 1024
+STATEMENT_CACHE_SIZE = 256
+PREVIEW_LENGTH = 50  # 履歴一覧に表示するプロンプトの文字数
+PAGE_SIZE = 20  # 履歴APIの1ページの件数
+MAX_PAGE_SIZE = 100
+
+# 全文検索の分かち書き。trigram（SQLite 3.34以降）は日本語でも分かち書きなしで部分一致を検索できる
+FTS_TOKENIZER = 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61'
+
+INSERT_HISTORY_SQL = (
+    'INSERT INTO prompt_history (prompt, response, api_type, timestamp, client_ip, cached, created_at, prompt_preview, '
+    'prompt_blob, response_blob) '
+    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+)
+
+# 本文の列（これを読む場合だけ history_entries ビューで展開する）
+BODY_COLUMNS_RE = re.compile(r'\*|\b(prompt|response)\b')
+
+def configure_connection(conn):
+    """接続に共通の PRAGMA を設定する"""
+    # 削除で空いたページを history_retention が少しずつ返却できるようにする。
+    # ファイルの作成前（journal_mode の変更より前）に設定した場合だけ有効（既存のDBは VACUUM で切り替える）
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    # WAL では NORMAL でもコミット済みのデータは壊れない（電源断時に直近のコミットを失う可能性のみ）
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    # history_entries ビューで本文を展開する関数
+    history_store.register_functions(conn)
+    return conn
+
+def connect(db_path=DEFAULT_DB_PATH, **kwargs):
+    """設定済みの接続を開く（書き込みスレッドや起動時の処理など、専用の接続が必要な場合）"""
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=STATEMENT_CACHE_SIZE, **kwargs)
+    return configure_connection(conn)
+
+def connect_readonly(db_path):
+    """読み取り専用の接続を開く（履歴のアーカイブなど、書き込まないファイル用）"""
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, timeout=BUSY_TIMEOUT_MS / 1000,
+                           check_same_thread=False)
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    history_store.register_functions(conn)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def prompt_preview(prompt):
+    """履歴一覧用に短縮したプロンプト"""
+    return prompt[:PREVIEW_LENGTH] + "..." if len(prompt) > PREVIEW_LENGTH else prompt
+
+def history_params(prompt, response, api_type, client_ip, cached=False, now=None,
+                   prompt_blob=None, response_blob=None):
+    """INSERT_HISTORY_SQL のパラメーターを作成する（本文を圧縮ストアに保存した場合は行に本文を持たない）"""
+    now = time.time() if now is None else now
+    timestamp = datetime.fromtimestamp(now).isoformat()
+    preview = prompt_preview(prompt)
+    if prompt_blob is not None:
+        prompt, response = '', None
+    return (prompt, response, api_type, timestamp, client_ip, int(cached), int(now), preview,
+            prompt_blob, response_blob)
+
+def insert_history(conn, prompt, response, api_type, client_ip, cached=False, now=None):
+    """本文を圧縮ストアに保存してから履歴の行を追加し、その ID を返す（呼び出し側のトランザクション内で実行）"""
+    prompt_blob = history_store.store_text(conn, prompt)
+    response_blob = history_store.store_text(conn, response)
+    params = history_params(prompt, response, api_type, client_ip, cached, now, prompt_blob, response_blob)
+    return conn.execute(INSERT_HISTORY_SQL, params).lastrowid
+
+def recent_history(conn, client_ip, limit, columns='*', before_id=None, after_id=None):
+    """client_ip の履歴と共有の履歴（client_ip が NULL）を新しい順に limit 件返す
+
+    "client_ip = ? OR client_ip IS NULL" のままでは索引順に読めず、該当する全行を並べ替えることになる。
+    そこで (client_ip, id) の索引をそれぞれ新しい順に limit 件だけ読み、最後に合わせて並べ替える。
+    before_id を指定するとそれより古い履歴を返す（索引の範囲検索になるため、何ページ目でも同じ速さ）。
+    after_id を指定するとそれより新しい履歴だけを返す（表示中の一覧に差分を追加する場合）。
+    columns に本文（prompt / response）を含む場合は history_entries ビューで展開して読み、
+    含まない場合はテーブルから直接読む（一覧用の列は索引だけで返せる）。
+    columns には id を含めること。
+    """
+    source = 'history_entries' if BODY_COLUMNS_RE.search(columns) else 'prompt_history'
+    condition = ''
+    cursor_params = ()
+    if before_id is not None:
+        condition += ' AND id < ?'
+        cursor_params += (before_id,)
+    if after_id is not None:
+        condition += ' AND id > ?'
+        cursor_params += (after_id,)
+    cursor = conn.execute(
+        f'SELECT * FROM (SELECT {columns} FROM {source} WHERE client_ip = ?{condition} ORDER BY id DESC LIMIT ?) '
+        f'UNION ALL '
+        f'SELECT * FROM (SELECT {columns} FROM {source} WHERE client_ip IS NULL{condition} ORDER BY id DESC LIMIT ?) '
+        f'ORDER BY id DESC LIMIT ?',
+        (client_ip, *cursor_params, limit, *cursor_params, limit, limit)
+    )
+    return cursor.fetchall()
+
+def history_count(conn, client_ip, after_id=None):
+    """client_ip の履歴と共有の履歴の件数（after_id を指定するとそれより新しいものだけ）"""
+    condition = '' if after_id is None else ' AND id > ?'
+    cursor_params = () if after_id is None else (after_id,)
+    return conn.execute(
+        f'SELECT (SELECT count(*) FROM prompt_history WHERE client_ip = ?{condition}) + '
+        f'(SELECT count(*) FROM prompt_history WHERE client_ip IS NULL{condition})',
+        (client_ip, *cursor_params, *cursor_params)
+    ).fetchone()[0]
+
+def history_window(conn, client_ip, offset, limit, columns='*', total=None):
+    """新しい順で offset 件目から limit 件を返す（スクロールバーで任意の位置に移動する場合）
+
+    OFFSET は ID だけを索引順に数えて先頭の行を決め（2つの範囲を並べ替えずにマージする）、
+    その行からは recent_history の範囲検索で読む。続きのページは before_id で読むこと。
+    total（件数）を渡すと、後半の位置は古い方から数える。
+    """
+    if offset <= 0:
+        return recent_history(conn, client_ip, limit, columns)
+    order = 'DESC'
+    if total is not None and offset > total // 2:
+        order, offset = 'ASC', total - 1 - offset
+    row = conn.execute(
+        f'SELECT id FROM prompt_history WHERE client_ip = ? '
+        f'UNION ALL SELECT id FROM prompt_history WHERE client_ip IS NULL '
+        f'ORDER BY id {order} LIMIT 1 OFFSET ?',
+        (client_ip, max(offset, 0))
+    ).fetchone()
+    if row is None:
+        return []
+    return recent_history(conn, client_ip, limit, columns, before_id=row[0] + 1)
+
+def history_page(conn, client_ip, limit, before_id=None):
+    """履歴を1ページ分返す（履歴のリスト, 次のページの before_id または None）"""
+    limit = max(1, limit)
+    rows = [dict(row) for row in recent_history(conn, client_ip, limit + 1, before_id=before_id)]
+    if len(rows) > limit:
+        return rows[:limit], rows[limit - 1]['id']
+    return rows, None
+
+def delete_history(conn, client_ip, prompt_id):
+    """client_ip の履歴（または共有の履歴）を1件削除し、削除した件数を返す（コミットは呼び出し側）"""
+    return conn.execute('DELETE FROM prompt_history WHERE id = ? AND (client_ip = ? OR client_ip IS NULL)',
+                        (prompt_id, client_ip)).rowcount
+
+def clear_history(conn, client_ip):
+    """client_ip の履歴と共有の履歴をすべて削除し、削除した件数を返す（コミットは呼び出し側）"""
+    return conn.execute('DELETE FROM prompt_history WHERE client_ip = ? OR client_ip IS NULL',
+                        (client_ip,)).rowcount
+
+# ---- マイグレーション ----
+
+def migration_base_schema(conn):
+    """履歴テーブルを作成し、以前のバージョンで後から追加していた列を揃える"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS prompt_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        prompt TEXT NOT NULL,
+        response TEXT,
+        api_type TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        client_ip TEXT
+    )
+    ''')
+    columns = [column[1] for column in conn.execute("PRAGMA table_info(prompt_history)")]
+    if 'response' not in columns:
+        conn.execute('ALTER TABLE prompt_history ADD COLUMN response TEXT')
+    if 'client_ip' not in columns:
+        conn.execute('ALTER TABLE prompt_history ADD COLUMN client_ip TEXT')
+    if 'cached' not in columns:
+        conn.execute('ALTER TABLE prompt_history ADD COLUMN cached INTEGER NOT NULL DEFAULT 0')
+
+def migration_list_columns(conn):
+    """一覧表示用に、エポック秒の作成時刻と短縮済みのプロンプトを保存する列を追加する"""
+    conn.execute('ALTER TABLE prompt_history ADD COLUMN created_at INTEGER')
+    conn.execute('ALTER TABLE prompt_history ADD COLUMN prompt_preview TEXT')
+    # timestamp はローカル時刻の ISO 形式なので、'utc' 修飾子でUTCに直してからエポック秒にする
+    conn.execute(
+        "UPDATE prompt_history SET "
+        "created_at = CAST(strftime('%s', timestamp, 'utc') AS INTEGER), "
+        "prompt_preview = CASE WHEN length(prompt) > ? THEN substr(prompt, 1, ?) || '...' ELSE prompt END",
+        (PREVIEW_LENGTH, PREVIEW_LENGTH)
+    )
+
+def migration_client_index(conn):
+    """履歴一覧の取得で使う (client_ip, id) の索引を作成する
+
+    一覧に表示する列も含めておき、GUI版の一覧はテーブル本体を読まずに索引だけで返せるようにする。
+    """
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_prompt_history_client '
+        'ON prompt_history (client_ip, id, created_at, api_type, prompt_preview)'
+    )
+
+def migration_fulltext_index(conn):
+    """プロンプトと回答の全文検索用に FTS5 の索引 prompt_history_fts を作成する
+
+    本文は prompt_history から読む外部コンテンツ方式とし、索引だけを持つ。
+    索引の更新はトリガーで行うため、書き込み側（HistoryWriter など）の変更は不要。
+    """
+    conn.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS prompt_history_fts USING fts5('
+        f"prompt, response, content='prompt_history', content_rowid='id', tokenize='{FTS_TOKENIZER}')"
+    )
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS prompt_history_fts_insert AFTER INSERT ON prompt_history
+    BEGIN
+        INSERT INTO prompt_history_fts (rowid, prompt, response) VALUES (new.id, new.prompt, new.response);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS prompt_history_fts_delete AFTER DELETE ON prompt_history
+    BEGIN
+        INSERT INTO prompt_history_fts (prompt_history_fts, rowid, prompt, response)
+        VALUES ('delete', old.id, old.prompt, old.response);
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER IF NOT EXISTS prompt_history_fts_update AFTER UPDATE OF prompt, response ON prompt_history
+    BEGIN
+        INSERT INTO prompt_history_fts (prompt_history_fts, rowid, prompt, response)
+        VALUES ('delete', old.id, old.prompt, old.response);
+        INSERT INTO prompt_history_fts (rowid, prompt, response) VALUES (new.id, new.prompt, new.response);
+    END
+    ''')
+    # 既存の履歴をまとめて索引に登録
+    conn.execute("INSERT INTO prompt_history_fts (prompt_history_fts) VALUES ('rebuild')")
+
+def migration_blob_store(conn):
+    """本文を重複排除・圧縮して保存する history_blobs と、本文を展開して返す history_entries ビューを作成する
+
+    全文検索の索引もビューを参照するように作り直す（圧縮ストアに移した行は prompt 列が空のため）。
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS history_dicts (
+        id INTEGER PRIMARY KEY,
+        data BLOB NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS history_blobs (
+        id INTEGER PRIMARY KEY,
+        hash BLOB NOT NULL UNIQUE,
+        codec INTEGER NOT NULL,
+        dict_id INTEGER,
+        size INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )
+    ''')
+    conn.execute('ALTER TABLE prompt_history ADD COLUMN prompt_blob INTEGER')
+    conn.execute('ALTER TABLE prompt_history ADD COLUMN response_blob INTEGER')
+    conn.execute('''
+    CREATE VIEW IF NOT EXISTS history_entries AS
+    SELECT h.id,
+           CASE WHEN h.prompt_blob IS NULL THEN h.prompt ELSE history_text(p.codec, p.dict_id, p.data) END AS prompt,
+           CASE WHEN h.prompt_blob IS NULL THEN h.response ELSE history_text(r.codec, r.dict_id, r.data) END AS response,
+           h.api_type, h.timestamp, h.client_ip, h.cached, h.created_at, h.prompt_preview
+    FROM prompt_history h
+    LEFT JOIN history_blobs p ON p.id = h.prompt_blob
+    LEFT JOIN history_blobs r ON r.id = h.response_blob
+    ''')
+
+    for trigger in ('prompt_history_fts_insert', 'prompt_history_fts_delete', 'prompt_history_fts_update'):
+        conn.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    conn.execute('DROP TABLE IF EXISTS prompt_history_fts')
+    conn.execute(
+        'CREATE VIRTUAL TABLE prompt_history_fts USING fts5('
+        f"prompt, response, content='history_entries', content_rowid='id', tokenize='{FTS_TOKENIZER}')"
+    )
+    # 索引から消す本文は行を削除する前にビューから読む
+    conn.execute('''
+    CREATE TRIGGER prompt_history_fts_insert AFTER INSERT ON prompt_history
+    BEGIN
+        INSERT INTO prompt_history_fts (rowid, prompt, response)
+        SELECT id, prompt, response FROM history_entries WHERE id = new.id;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER prompt_history_fts_delete BEFORE DELETE ON prompt_history
+    BEGIN
+        INSERT INTO prompt_history_fts (prompt_history_fts, rowid, prompt, response)
+        SELECT 'delete', id, prompt, response FROM history_entries WHERE id = old.id;
+    END
+    ''')
+    # 本文を圧縮ストアへ移すだけの更新（history_store.migrate_rows）は内容が変わらないため索引を更新しない
+    conn.execute('''
+    CREATE TRIGGER prompt_history_fts_update_before BEFORE UPDATE OF prompt, response, prompt_blob, response_blob
+    ON prompt_history WHEN NOT (old.prompt_blob IS NULL AND new.prompt_blob IS NOT NULL)
+    BEGIN
+        INSERT INTO prompt_history_fts (prompt_history_fts, rowid, prompt, response)
+        SELECT 'delete', id, prompt, response FROM history_entries WHERE id = old.id;
+    END
+    ''')
+    conn.execute('''
+    CREATE TRIGGER prompt_history_fts_update_after AFTER UPDATE OF prompt, response, prompt_blob, response_blob
+    ON prompt_history WHEN NOT (old.prompt_blob IS NULL AND new.prompt_blob IS NOT NULL)
+    BEGIN
+        INSERT INTO prompt_history_fts (rowid, prompt, response)
+        SELECT id, prompt, response FROM history_entries WHERE id = new.id;
+    END
+    ''')
+    conn.execute("INSERT INTO prompt_history_fts (prompt_history_fts) VALUES ('rebuild')")
+
+def migration_blob_reference_index(conn):
+    """本文（history_blobs）を参照している履歴を探すための prompt_blob・response_blob の索引を作成する
+
+    不要になった本文の削除（history_store.collect_garbage）が、本文ごとに参照の有無を索引で確かめられるようにする。
+    """
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_prompt_history_prompt_blob '
+                 'ON prompt_history (prompt_blob) WHERE prompt_blob IS NOT NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_prompt_history_response_blob '
+                 'ON prompt_history (response_blob) WHERE response_blob IS NOT NULL')
+
+# 適用順に並べる（n番目を適用すると user_version が n になる）。既存の項目は変更・削除しないこと
+MIGRATIONS = [
+    migration_base_schema,
+    migration_list_columns,
+    migration_client_index,
+    migration_fulltext_index,
+    migration_blob_store,
+    migration_blob_reference_index,
+]
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn):
+    """未適用のマイグレーションを順番に適用し、適用後のバージョンを返す
+
+    conn は isolation_level=None で開いた接続を渡す。Web版とGUI版が同時に起動しても
+    BEGIN IMMEDIATE で順番に実行され、同じマイグレーションが二重に適用されることはない。
+    """
+    for version, migration in enumerate(MIGRATIONS, start=1):
+        if schema_version(conn) >= version:
+            continue
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # ロックを取る間に他のプロセスが適用した可能性があるため、もう一度確認する
+            if schema_version(conn) < version:
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {version}')
+                print(f"🛠️ データベースを更新しました: v{version} {migration.__doc__.splitlines()[0]}")
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    version = schema_version(conn)
+    if version > len(MIGRATIONS):
+        print(f"⚠️ データベースのバージョン (v{version}) がこのアプリ (v{len(MIGRATIONS)}) より新しいです")
+    return version
+
+class ConnectionPool:
+    """接続数に上限のある接続プール（同じスレッド内で入れ子に借りた場合は同じ接続を返す）"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_connections=DEFAULT_POOL_SIZE, timeout=10):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.idle = LifoQueue()  # 直前に使った接続（ページキャッシュが温まっている）から再利用する
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.created = 0
+        self.closed = False
+
+    @contextmanager
+    def connection(self):
+        """with文で接続を借りる。終了時に未コミットのトランザクションはロールバックされる"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._release(conn)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue_Empty:
+            pass
+        with self.lock:
+            if self.created < self.max_connections:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                conn = connect(self.db_path, check_same_thread=False)
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+            conn.row_factory = sqlite3.Row
+            return conn
+        # 上限に達している場合は返却を待つ
+        try:
+            return self.idle.get(timeout=self.timeout)
+        except queue_Empty:
+            raise RuntimeError("データベース接続の空きがありません") from None
+
+    def _release(self, conn):
+        if self.closed:
+            conn.close()
+            return
+        self.idle.put(conn)
+
+    def stats(self):
+        """接続プールの状態を返す"""
+        with self.lock:
+            return {"connections": self.created, "idle": self.idle.qsize(), "max_connections": self.max_connections}
+
+    def close(self):
+        """使われていない接続をすべて閉じる（使用中の接続は返却時に閉じる）"""
+        self.closed = True
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue_Empty:
+                break
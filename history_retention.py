@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプト履歴の保持期間（ホットテーブルとアーカイブ）
+
+prompt_history.db（ホット）には client_ip ごとに直近 keep_days 日・keep_rows 件の履歴だけを残し、
+それより古い履歴を batch_size 件ずつ月ごとのアーカイブ（history_archive/prompt_history_YYYY-MM.db）へ移す。
+アーカイブはホットと同じスキーマで、本文は圧縮ストアのまま（辞書も同じ ID で）コピーするため、
+history_db.connect_readonly() で開けば history_entries ビューや history_page() でそのまま読める。
+
+削除で空いたページは PRAGMA incremental_vacuum で vacuum_pages ページずつ、間を空けて返却する
+（1回の処理で書き込みを長く止めないため）。incremental_vacuum は auto_vacuum=INCREMENTAL の
+DBでのみ有効なので、それ以前に作成したDBは `python history_retention.py vacuum` で一度だけ切り替える。
+
+設定は ipconfig.ini の [HISTORY_RETENTION] セクション（既定では無効）。
+"""
+
+import argparse
+import configparser
+import os
+import re
+import threading
+import time
+
+import history_db
+import history_store
+
+# デフォルト設定
+DEFAULT_ARCHIVE_DIR = 'history_archive'
+DEFAULT_KEEP_DAYS = 180  # 0 は日数で制限しない
+DEFAULT_KEEP_ROWS = 10000  # client_ip ごと。0 は件数で制限しない
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_INTERVAL_SECONDS = 3600
+DEFAULT_VACUUM_PAGES = 256  # 1回の incremental_vacuum で返却するページ数
+DEFAULT_VACUUM_PAUSE = 0.05  # バッチ・incremental_vacuum の間に空ける秒数（書き込みスレッドに譲る）
+
+AUTO_VACUUM_INCREMENTAL = 2
+ARCHIVE_NAME_RE = re.compile(r'^prompt_history_(\d{4}-\d{2})\.db$')
+MONTH_RE = re.compile(r'^\d{4}-\d{2}$')
+
+ARCHIVE_COLUMNS = ('id', 'prompt', 'response', 'api_type', 'timestamp', 'client_ip', 'cached',
+                   'created_at', 'prompt_preview', 'prompt_blob', 'response_blob')
+BLOB_COLUMNS = ('hash', 'codec', 'dict_id', 'size', 'data')
+
+def load_history_retention(config_file='ipconfig.ini', db_path=history_db.DEFAULT_DB_PATH, on_archive=None):
+    """ipconfig.ini の [HISTORY_RETENTION] セクションから保持設定を作成する（無効時は None）"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file, encoding='utf-8')
+    except Exception as e:
+        print(f"❌ 履歴の保持設定の読み込みエラー: {e}")
+    section = 'HISTORY_RETENTION'
+    if not config.getboolean(section, 'enabled', fallback=False):
+        return None
+    retention = HistoryRetention(
+        db_path=db_path,
+        archive_dir=config.get(section, 'archive_dir', fallback=DEFAULT_ARCHIVE_DIR),
+        keep_days=config.getfloat(section, 'keep_days', fallback=DEFAULT_KEEP_DAYS),
+        keep_rows=config.getint(section, 'keep_rows', fallback=DEFAULT_KEEP_ROWS),
+        batch_size=config.getint(section, 'batch_size', fallback=DEFAULT_BATCH_SIZE),
+        interval_seconds=config.getfloat(section, 'interval_minutes', fallback=DEFAULT_INTERVAL_SECONDS / 60) * 60,
+        vacuum_pages=config.getint(section, 'vacuum_pages', fallback=DEFAULT_VACUUM_PAGES),
+        on_archive=on_archive
+    )
+    print(f"🗄️ 履歴の保持: {retention.keep_days:g}日 / {retention.keep_rows}件（client_ip ごと）"
+          f" → {retention.archive_dir}")
+    return retention
+
+def archive_path(archive_dir, month):
+    return os.path.join(archive_dir, f'prompt_history_{month}.db')
+
+def list_archives(archive_dir=DEFAULT_ARCHIVE_DIR):
+    """アーカイブの一覧を新しい月から返す"""
+    if not os.path.isdir(archive_dir):
+        return []
+    archives = []
+    for name in os.listdir(archive_dir):
+        match = ARCHIVE_NAME_RE.match(name)
+        if match:
+            archives.append({"month": match.group(1),
+                             "size": os.path.getsize(os.path.join(archive_dir, name))})
+    return sorted(archives, key=lambda archive: archive['month'], reverse=True)
+
+def archive_page(archive_dir, month, client_ip, limit, before_id=None):
+    """アーカイブの履歴を読み取り専用で開き、history_page() と同じ形式で返す（アーカイブがなければ None）"""
+    if not MONTH_RE.match(month or ''):
+        raise ValueError("月は YYYY-MM の形式で指定してください")
+    path = archive_path(archive_dir, month)
+    if not os.path.exists(path):
+        return None
+    conn = history_db.connect_readonly(path)
+    try:
+        return history_db.history_page(conn, client_ip, limit, before_id)
+    finally:
+        conn.close()
+
+def month_of(created_at):
+    return time.strftime('%Y-%m', time.localtime(created_at or 0))
+
+def incremental_vacuum(conn, pages=DEFAULT_VACUUM_PAGES, pause=DEFAULT_VACUUM_PAUSE, stop_event=None):
+    """空きページを pages ページずつ返却する（返却したページ数を返す。auto_vacuum=INCREMENTAL でなければ 0）"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return 0
+    released = 0
+    while stop_event is None or not stop_event.is_set():
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if free == 0:
+            break
+        # execute() では1ページ分しか進まないため、最後まで実行する executescript() を使う
+        conn.executescript(f'PRAGMA incremental_vacuum({pages})')
+        released += min(free, pages)
+        time.sleep(pause)
+    # WAL に書かれた返却をファイルに反映する（読み取り中の接続は待たない）
+    conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+    return released
+
+class HistoryRetention:
+    """古い履歴をアーカイブへ移し、空いたページを少しずつ返却するバックグラウンド処理"""
+
+    def __init__(self, db_path=history_db.DEFAULT_DB_PATH, archive_dir=DEFAULT_ARCHIVE_DIR,
+                 keep_days=DEFAULT_KEEP_DAYS, keep_rows=DEFAULT_KEEP_ROWS, batch_size=DEFAULT_BATCH_SIZE,
+                 interval_seconds=DEFAULT_INTERVAL_SECONDS, vacuum_pages=DEFAULT_VACUUM_PAGES,
+                 vacuum_pause=DEFAULT_VACUUM_PAUSE, on_archive=None):
+        self.db_path = db_path
+        self.archive_dir = archive_dir
+        self.keep_days = keep_days
+        self.keep_rows = keep_rows
+        self.batch_size = batch_size
+        self.interval_seconds = interval_seconds
+        self.vacuum_pages = vacuum_pages
+        self.vacuum_pause = vacuum_pause
+        self.on_archive = on_archive  # 履歴を移した後に on_archive(移した件数) を呼ぶ
+
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats_counter = {"runs": 0, "archived": 0, "released_pages": 0, "last_run": None}
+
+    # ---- バックグラウンド実行 ----
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True, name="history-retention")
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"❌ 履歴のアーカイブエラー: {e}")
+            self.stop_event.wait(self.interval_seconds)
+
+    def stats(self):
+        return dict(self.stats_counter, keep_days=self.keep_days, keep_rows=self.keep_rows,
+                    archive_dir=self.archive_dir)
+
+    def run_once(self):
+        """古い履歴をすべてアーカイブへ移し、空いたページを返却する（移した件数を返す）"""
+        conn = history_db.connect(self.db_path, isolation_level=None)
+        archives = {}
+        try:
+            archived = 0
+            while not self.stop_event.is_set():
+                ids = self.expired_ids(conn)
+                if not ids:
+                    break
+                archived += self.archive_batch(conn, ids, archives)
+                time.sleep(self.vacuum_pause)
+            if archived:
+                history_store.collect_garbage(conn, self.batch_size, self.vacuum_pause, self.stop_event)
+                print(f"🗄️ 履歴をアーカイブへ移動: {archived}件")
+                if self.on_archive is not None:
+                    self.on_archive(archived)
+            released = incremental_vacuum(conn, self.vacuum_pages, self.vacuum_pause, self.stop_event)
+        finally:
+            for archive in archives.values():
+                archive.close()
+            conn.close()
+        self.stats_counter['runs'] += 1
+        self.stats_counter['archived'] += archived
+        self.stats_counter['released_pages'] += released
+        self.stats_counter['last_run'] = time.time()
+        return archived
+
+    # ---- アーカイブ ----
+
+    def expired_ids(self, conn):
+        """保持期間・件数を超えた履歴の ID を古い順に最大 batch_size 件返す"""
+        ids = set()
+        if self.keep_days > 0:
+            cutoff = time.time() - self.keep_days * 86400
+            ids.update(row[0] for row in conn.execute(
+                'SELECT id FROM prompt_history WHERE created_at < ? ORDER BY id LIMIT ?',
+                (cutoff, self.batch_size)
+            ))
+        if self.keep_rows > 0:
+            clients = [row[0] for row in conn.execute('SELECT DISTINCT client_ip FROM prompt_history')]
+            for client_ip in clients:
+                condition = 'client_ip IS NULL' if client_ip is None else 'client_ip = ?'
+                params = () if client_ip is None else (client_ip,)
+                # 新しい方から keep_rows 件目の次の ID（索引 (client_ip, id) を逆順にたどる）
+                boundary = conn.execute(
+                    f'SELECT id FROM prompt_history WHERE {condition} ORDER BY id DESC LIMIT 1 OFFSET ?',
+                    params + (self.keep_rows,)
+                ).fetchone()
+                if boundary is None:
+                    continue
+                ids.update(row[0] for row in conn.execute(
+                    f'SELECT id FROM prompt_history WHERE {condition} AND id <= ? ORDER BY id LIMIT ?',
+                    params + (boundary[0], self.batch_size)
+                ))
+        return sorted(ids)[:self.batch_size]
+
+    def open_archive(self, conn, month, archives):
+        """月のアーカイブを開く（なければ作成）。本文の展開に必要な辞書をホットからコピーしておく"""
+        archive = archives.get(month)
+        if archive is None:
+            os.makedirs(self.archive_dir, exist_ok=True)
+            archive = history_db.connect(archive_path(self.archive_dir, month), isolation_level=None)
+            # 読み取り専用でも開けるよう、-wal / -shm を残さないジャーナルにする
+            archive.execute('PRAGMA journal_mode=DELETE')
+            history_db.migrate(archive)
+            archives[month] = archive
+        last_dict_id = archive.execute('SELECT IFNULL(MAX(id), 0) FROM history_dicts').fetchone()[0]
+        for row in conn.execute('SELECT id, data, created_at FROM history_dicts WHERE id > ? ORDER BY id',
+                                (last_dict_id,)):
+            archive.execute('INSERT INTO history_dicts (id, data, created_at) VALUES (?, ?, ?)', tuple(row))
+        return archive
+
+    def copy_blob(self, conn, archive, blob_id):
+        """本文を圧縮したままアーカイブへコピーし、アーカイブでの ID を返す"""
+        if blob_id is None:
+            return None
+        row = conn.execute(f'SELECT {", ".join(BLOB_COLUMNS)} FROM history_blobs WHERE id = ?',
+                           (blob_id,)).fetchone()
+        if row is None:
+            # 参照先の本文がない行は本文なしでアーカイブし、他の行の移動は続ける
+            print(f"⚠️ 履歴の本文が見つかりません（history_blobs.id = {blob_id}）")
+            return None
+        archive.execute(
+            f'INSERT OR IGNORE INTO history_blobs ({", ".join(BLOB_COLUMNS)}) VALUES (?, ?, ?, ?, ?)', tuple(row)
+        )
+        return archive.execute('SELECT id FROM history_blobs WHERE hash = ?', (row[0],)).fetchone()[0]
+
+    def archive_batch(self, conn, ids, archives):
+        """ids の履歴を月ごとのアーカイブへ書き込んでから、ホットから削除する（移した件数を返す）"""
+        placeholders = ','.join('?' * len(ids))
+        rows = conn.execute(
+            f'SELECT {", ".join(ARCHIVE_COLUMNS)} FROM prompt_history WHERE id IN ({placeholders}) ORDER BY id',
+            ids
+        ).fetchall()
+        by_month = {}
+        for row in rows:
+            by_month.setdefault(month_of(row[7]), []).append(row)
+
+        # アーカイブへの書き込みを確定させてから削除する（途中で止まっても履歴は失われない。
+        # 同じ ID は INSERT OR IGNORE で読み飛ばすため、次回に同じ行を移し直しても重複しない）
+        for month, month_rows in by_month.items():
+            archive = self.open_archive(conn, month, archives)
+            archive.execute('BEGIN')
+            try:
+                for row in month_rows:
+                    values = list(row)
+                    values[9] = self.copy_blob(conn, archive, row[9])
+                    values[10] = self.copy_blob(conn, archive, row[10])
+                    archive.execute(
+                        f'INSERT OR IGNORE INTO prompt_history ({", ".join(ARCHIVE_COLUMNS)}) '
+                        f'VALUES ({", ".join("?" * len(ARCHIVE_COLUMNS))})',
+                        values
+                    )
+                archive.execute('COMMIT')
+            except Exception:
+                archive.execute('ROLLBACK')
+                raise
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(f'DELETE FROM prompt_history WHERE id IN ({placeholders})', ids)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description="履歴の保持期間とアーカイブの管理")
+    parser.add_argument('command', choices=['run', 'list', 'vacuum'],
+                        help="run: 古い履歴をアーカイブへ移す / list: アーカイブの一覧 / "
+                             "vacuum: incremental_vacuum を有効にして VACUUM する（既存のDB向けに一度だけ）")
+    parser.add_argument('--db', default=history_db.DEFAULT_DB_PATH)
+    parser.add_argument('--config', default='ipconfig.ini')
+    args = parser.parse_args()
+
+    retention = load_history_retention(args.config, args.db) or HistoryRetention(db_path=args.db)
+    if args.command == 'run':
+        conn = history_db.connect(args.db, isolation_level=None)
+        history_db.migrate(conn)
+        conn.close()
+        print(f"✅ {retention.run_once()}件をアーカイブへ移しました")
+    elif args.command == 'list':
+        for archive in list_archives(retention.archive_dir):
+            print(f"  {archive['month']}: {archive['size'] / 1024 / 1024:.1f}MB")
+    elif args.command == 'vacuum':
+        conn = history_db.connect(args.db, isolation_level=None)
+        try:
+            # configure_connection で auto_vacuum=INCREMENTAL を設定済み。既存のDBには VACUUM で反映される
+            conn.execute('VACUUM')
+            mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+            print("✅ incremental_vacuum を有効にしました" if mode == AUTO_VACUUM_INCREMENTAL
+                  else "⚠️ incremental_vacuum を有効にできませんでした")
+        finally:
+            conn.close()
+
+if __name__ == '__main__':
+    main()
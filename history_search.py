@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプト履歴の全文検索（SQLite FTS5）
+
+履歴の prompt と response（history_entries ビュー）の索引 prompt_history_fts（history_db のマイグレーションで作成し、
+トリガーで同期）を使い、空白で区切った語をすべて含む履歴を関連度（bm25）の高い順に返す。
+
+候補の上限（MAX_CANDIDATES）は検索したクライアントの履歴に絞ってから適用する（他のクライアントの
+履歴が多くても自分の履歴が候補から漏れないように）。このクライアントの一致する履歴が MAX_CANDIDATES 件を
+超える語を含む場合は、関連度ではなく新しい順に返す。
+trigram の索引は3文字以上の語しか引けないため、2文字以下の語は索引で絞り込んだ結果に
+LIKE で条件を追加する。すべての語が2文字以下の場合だけ、このクライアントの新しい履歴
+FALLBACK_SCAN_ROWS 件を LIKE で走査する（関連度ではなく新しい順）。
+"""
+
+import html
+import re
+
+# 索引で検索できる語の最小文字数（trigram）
+MIN_MATCH_LENGTH = 3
+
+# 1回の検索で使う語の上限
+MAX_TERMS = 8
+
+# 短い語だけで検索する場合に走査する、クライアントごとの新しい履歴の件数
+FALLBACK_SCAN_ROWS = 20000
+
+# 関連度を計算する候補の上限（多くの履歴に含まれる語の場合は新しいものを優先）
+MAX_CANDIDATES = 5000
+
+# スニペットの文字数
+SNIPPET_LENGTH = 120
+
+# プロンプトの一致を回答の一致より重く評価する（bm25 の列ごとの重み）
+RANK_SQL = 'bm25(prompt_history_fts, 2.0, 1.0)'
+
+def parse_terms(query):
+    """検索文字列を空白で区切った語のリストにする（重複は除く）"""
+    terms = []
+    for term in (query or '').split():
+        if term not in terms:
+            terms.append(term)
+    return terms[:MAX_TERMS]
+
+def match_expression(terms):
+    """語をフレーズとして引用符で囲み、FTS5 の構文として解釈されないようにする"""
+    return ' AND '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+def like_pattern(term):
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f'%{escaped}%'
+
+def make_snippet(text, terms, length=SNIPPET_LENGTH):
+    """最初に一致した箇所の前後を切り出し、HTMLエスケープしたうえで一致部分を <mark> で囲む"""
+    if not text:
+        return ''
+    pattern = re.compile('|'.join(re.escape(term) for term in sorted(terms, key=len, reverse=True)),
+                         re.IGNORECASE)
+    first = pattern.search(text)
+    start = max(0, first.start() - length // 4) if first else 0
+    end = min(len(text), start + length)
+
+    parts = []
+    position = start
+    for match in pattern.finditer(text, start, end):
+        parts.append(html.escape(text[position:match.start()]))
+        parts.append(f'<mark>{html.escape(match.group())}</mark>')
+        position = match.end()
+    parts.append(html.escape(text[position:end]))
+    return ('…' if start > 0 else '') + ''.join(parts) + ('…' if end < len(text) else '')
+
+def _client_filters(client_ip, api_type, table='prompt_history'):
+    """クライアント（と api_type）で絞り込む WHERE 条件とパラメーター"""
+    clauses = [f'({table}.client_ip = ? OR {table}.client_ip IS NULL)']
+    params = [client_ip]
+    if api_type:
+        clauses.append(f'{table}.api_type = ?')
+        params.append(api_type)
+    return clauses, params
+
+def _like_filters(like_terms, table='history_entries'):
+    """短い語を LIKE で探す WHERE 条件とパラメーター（本文を読むため、候補を絞り込んだ後に使う）"""
+    clauses = []
+    params = []
+    for term in like_terms:
+        clauses.append(f"({table}.prompt LIKE ? ESCAPE '\\' OR {table}.response LIKE ? ESCAPE '\\')")
+        params.extend([like_pattern(term)] * 2)
+    return clauses, params
+
+def _is_common(conn, client_ip, term, api_type=None):
+    """このクライアントの履歴のうち、語を含むものが MAX_CANDIDATES 件を超えるか"""
+    clauses, params = _client_filters(client_ip, api_type)
+    count = conn.execute(
+        f'SELECT count(*) FROM (SELECT prompt_history_fts.rowid FROM prompt_history_fts '
+        f'JOIN prompt_history ON prompt_history.id = prompt_history_fts.rowid '
+        f'WHERE prompt_history_fts MATCH ? AND {" AND ".join(clauses)} LIMIT ?)',
+        [match_expression([term])] + params + [MAX_CANDIDATES + 1]
+    ).fetchone()[0]
+    return count > MAX_CANDIDATES
+
+def _ranked_ids(conn, client_ip, match_terms, like_terms, api_type, limit):
+    """索引で検索し、関連度の高い順に (ID, スコア) を返す"""
+    client_clauses, client_params = _client_filters(client_ip, api_type)
+    like_clauses, like_params = _like_filters(like_terms)
+    # bm25 は語ごとに一致する全行を数えるため、ありふれた語では件数に比例して遅くなる。
+    # そうした語は関連度への寄与もほぼないので、このクライアントの履歴に多く含まれる場合は新しい順に並べる
+    use_rank = not any(_is_common(conn, client_ip, term, api_type) for term in match_terms)
+    rank = RANK_SQL if use_rank else 'NULL'
+    order = 'candidates.rank' if use_rank else 'candidates.rowid DESC'
+    # このクライアントの一致した行を新しい順に MAX_CANDIDATES 件まで取り、その中で並べ替える。
+    # 本文はここでは読まない（並べ替えの前に候補すべての本文を保持することになるため）
+    query = (
+        f'SELECT history_entries.id, candidates.rank FROM ('
+        f'SELECT prompt_history_fts.rowid AS rowid, {rank} AS rank FROM prompt_history_fts '
+        f'JOIN prompt_history ON prompt_history.id = prompt_history_fts.rowid '
+        f'WHERE prompt_history_fts MATCH ? AND {" AND ".join(client_clauses)} '
+        f'ORDER BY prompt_history_fts.rowid DESC LIMIT ?'
+        f') AS candidates '
+        f'JOIN history_entries ON history_entries.id = candidates.rowid '
+        f'{"WHERE " + " AND ".join(like_clauses) if like_clauses else ""} '
+        f'ORDER BY {order} LIMIT ?'
+    )
+    params = [match_expression(match_terms)] + client_params + [MAX_CANDIDATES] + like_params + [limit]
+    return [(row[0], -row[1] if use_rank else None) for row in conn.execute(query, params)]
+
+def _scanned_ids(conn, client_ip, like_terms, api_type, limit):
+    """このクライアントの新しい履歴 FALLBACK_SCAN_ROWS 件を LIKE で走査し、新しい順に (ID, None) を返す"""
+    like_clauses, like_params = _like_filters(like_terms)
+    # client_ip の索引（client_ip, id, ...）を新しい順にたどり、走査する行数を自分の履歴の件数で区切る。
+    # client_ip のない古い履歴は別に同じ件数まで含める
+    api_clause = ' AND api_type = ?' if api_type else ''
+    api_params = [api_type] if api_type else []
+    query = (
+        f'SELECT id FROM history_entries WHERE id IN ('
+        f'SELECT id FROM (SELECT id FROM prompt_history WHERE client_ip = ?{api_clause} ORDER BY id DESC LIMIT ?) '
+        f'UNION ALL '
+        f'SELECT id FROM (SELECT id FROM prompt_history WHERE client_ip IS NULL{api_clause} ORDER BY id DESC LIMIT ?)'
+        f') AND {" AND ".join(like_clauses)} '
+        f'ORDER BY id DESC LIMIT ?'
+    )
+    params = ([client_ip] + api_params + [FALLBACK_SCAN_ROWS] + api_params + [FALLBACK_SCAN_ROWS]
+              + like_params + [limit])
+    return [(row[0], None) for row in conn.execute(query, params)]
+
+def search(conn, client_ip, query, limit=20, api_type=None):
+    """query のすべての語を含む履歴を、ハイライト付きのスニペットとともに関連度の高い順に返す"""
+    terms = parse_terms(query)
+    if not terms:
+        return []
+    match_terms = [term for term in terms if len(term) >= MIN_MATCH_LENGTH]
+    like_terms = [term for term in terms if len(term) < MIN_MATCH_LENGTH]
+
+    if match_terms:
+        ranked = _ranked_ids(conn, client_ip, match_terms, like_terms, api_type, limit)
+    else:
+        ranked = _scanned_ids(conn, client_ip, like_terms, api_type, limit)
+    if not ranked:
+        return []
+
+    # 表示する件数分だけ本文を読む
+    placeholders = ','.join('?' * len(ranked))
+    rows = {row[0]: row for row in conn.execute(
+        f'SELECT id, prompt, response, api_type, timestamp, cached FROM history_entries WHERE id IN ({placeholders})',
+        [history_id for history_id, _ in ranked]
+    )}
+
+    results = []
+    for history_id, score in ranked:
+        row = rows.get(history_id)
+        if row is None:
+            continue
+        results.append({
+            "id": row[0],
+            "prompt": row[1],
+            "response": row[2],
+            "api_type": row[3],
+            "timestamp": row[4],
+            "cached": row[5],
+            "prompt_snippet": make_snippet(row[1], terms),
+            "response_snippet": make_snippet(row[2], terms),
+            "score": score
+        })
+    return results
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+履歴本文の圧縮ストア
+
+prompt_history の prompt / response の本文を SHA-256 で重複排除し、zlib（履歴から学習した辞書付き）で
+圧縮して history_blobs テーブルに保存する。履歴の行は prompt_blob / response_blob で本文を参照するだけになる。
+
+- history_blobs: 本文1件（hash で一意。同じ定型プロンプトや回答は1件だけ保存される）
+- history_dicts: zlib の辞書（一度保存した辞書は変更しない。本文ごとにどの辞書で圧縮したかを記録する）
+
+本文は history_entries ビュー（history_db のマイグレーションで作成）から読む。ビューは SQL 関数
+history_text() で展開するため、読み出し側は prompt_history と同じ列名のまま使える。
+圧縮前に保存された行（prompt_blob が NULL）は prompt / response 列の本文をそのまま返す。
+
+既存のデータベースの変換: python history_store.py migrate
+"""
+
+import argparse
+import hashlib
+import time
+import zlib
+from collections import Counter
+
+CODEC_RAW = 0   # 圧縮しても小さくならない短い本文（UTF-8 のまま保存）
+CODEC_ZLIB = 1  # zlib（dict_id があればその辞書を使用）
+
+ZLIB_LEVEL = 9
+MIN_COMPRESS_SIZE = 32  # これより短い本文は圧縮しない（バイト）
+
+# zlib が参照できるのは直前の32KBまでなので、辞書もそれ以上は大きくしない
+DICT_SIZE = 32 * 1024
+TRAIN_SAMPLE_ROWS = 5000
+MIN_SEGMENT_SIZE = 8  # 辞書の候補にする断片の最小サイズ（バイト）
+
+MIGRATE_BATCH_SIZE = 500
+GC_BATCH_SIZE = 500  # 不要な本文を1回の書き込みで削除する件数
+
+# 辞書のキャッシュ（dict_id -> bytes）。辞書は変更されないのでプロセス内で使い回す
+_dictionaries = {}
+# 新しい本文の圧縮に使う辞書（(dict_id, bytes)、辞書がない場合は (None, None)）
+_current_dictionary = None
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+def compress(text, dictionary=None):
+    """本文を (codec, data) に変換する"""
+    raw = text.encode('utf-8')
+    if len(raw) >= MIN_COMPRESS_SIZE:
+        compressor = zlib.compressobj(ZLIB_LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(ZLIB_LEVEL)
+        data = compressor.compress(raw) + compressor.flush()
+        if len(data) < len(raw):
+            return CODEC_ZLIB, data
+    return CODEC_RAW, raw
+
+def decompress(codec, data, dictionary=None):
+    if codec == CODEC_RAW:
+        return bytes(data).decode('utf-8')
+    decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+    return (decompressor.decompress(data) + decompressor.flush()).decode('utf-8')
+
+def load_dictionary(conn, dict_id):
+    """辞書を読み込む（キャッシュ済みならそれを返す）"""
+    dictionary = _dictionaries.get(dict_id)
+    if dictionary is None:
+        row = conn.execute('SELECT data FROM history_dicts WHERE id = ?', (dict_id,)).fetchone()
+        if row is None:
+            raise ValueError(f"圧縮辞書 {dict_id} が見つかりません")
+        dictionary = _dictionaries[dict_id] = bytes(row[0])
+    return dictionary
+
+def current_dictionary(conn):
+    """新しい本文の圧縮に使う辞書（最後に学習したもの）を (dict_id, bytes) で返す"""
+    global _current_dictionary
+    if _current_dictionary is None:
+        row = conn.execute('SELECT id, data FROM history_dicts ORDER BY id DESC LIMIT 1').fetchone()
+        if row is None:
+            return None, None
+        _dictionaries[row[0]] = bytes(row[1])
+        _current_dictionary = (row[0], _dictionaries[row[0]])
+    return _current_dictionary
+
+def reset_dictionary_cache():
+    """辞書のキャッシュを捨てる（同じプロセスで別のデータベースを開く場合。ベンチマークなど）"""
+    global _current_dictionary
+    _dictionaries.clear()
+    _current_dictionary = None
+
+def register_functions(conn):
+    """history_text(codec, dict_id, data) を接続に登録する（history_entries ビューが使用）"""
+    def history_text(codec, dict_id, data):
+        if data is None:
+            return None
+        dictionary = load_dictionary(conn, dict_id) if dict_id is not None else None
+        return decompress(codec, data, dictionary)
+
+    conn.create_function('history_text', 3, history_text)
+
+def store_text(conn, text):
+    """本文を保存して history_blobs の ID を返す（同じ本文があればそのIDを返す。None は None）"""
+    if text is None:
+        return None
+    digest = text_hash(text)
+    row = conn.execute('SELECT id FROM history_blobs WHERE hash = ?', (digest,)).fetchone()
+    if row is not None:
+        return row[0]
+    dict_id, dictionary = current_dictionary(conn)
+    codec, data = compress(text, dictionary)
+    cursor = conn.execute(
+        'INSERT INTO history_blobs (hash, codec, dict_id, size, data) VALUES (?, ?, ?, ?, ?)',
+        (digest, codec, dict_id if codec == CODEC_ZLIB else None, len(text.encode('utf-8')), data)
+    )
+    return cursor.lastrowid
+
+# ---- 辞書の学習 ----
+
+def segments(text):
+    """本文を行・文に分ける（定型文の単位）"""
+    for line in text.splitlines(keepends=True):
+        for sentence in line.split('。'):
+            if sentence:
+                yield sentence
+
+def train_dictionary(samples, size=DICT_SIZE):
+    """複数の本文に繰り返し現れる行・文を集めて zlib の辞書を作る
+
+    (出現回数 - 1) × 長さ が大きい断片ほど圧縮に効くとみなし、効果の大きいものを辞書の末尾に置く
+    （zlib は近くの一致ほど短い符号で参照できる）。繰り返しがなければ空のバイト列を返す。
+    """
+    counts = Counter()
+    for text in samples:
+        if text:
+            # 1つの本文の中での繰り返しは zlib 自身が縮めるので、本文ごとに1回だけ数える
+            counts.update(set(segments(text)))
+
+    candidates = []
+    for segment, count in counts.items():
+        encoded = segment.encode('utf-8')
+        if count > 1 and len(encoded) >= MIN_SEGMENT_SIZE:
+            candidates.append(((count - 1) * len(encoded), encoded))
+    candidates.sort(reverse=True)
+
+    chosen = []
+    total = 0
+    for _, encoded in candidates:
+        if total + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(chosen))
+
+def train(conn, sample_rows=TRAIN_SAMPLE_ROWS):
+    """新しい履歴から辞書を学習して保存し、以降の圧縮に使う（辞書の ID を返す。作れなかった場合は None）"""
+    global _current_dictionary
+    samples = []
+    for prompt, response in conn.execute(
+            'SELECT prompt, response FROM history_entries ORDER BY id DESC LIMIT ?', (sample_rows,)):
+        samples.append(prompt)
+        samples.append(response)
+    dictionary = train_dictionary(samples)
+    if not dictionary:
+        return None
+    cursor = conn.execute('INSERT INTO history_dicts (data, created_at) VALUES (?, ?)',
+                          (dictionary, int(time.time())))
+    conn.commit()
+    _dictionaries[cursor.lastrowid] = dictionary
+    _current_dictionary = (cursor.lastrowid, dictionary)
+    return cursor.lastrowid
+
+# ---- 既存データの変換・統計 ----
+
+def migrate_rows(conn, batch_size=MIGRATE_BATCH_SIZE):
+    """本文を行に直接持っている履歴を圧縮ストアへ移す（変換した件数を返す）"""
+    total = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            'SELECT id, prompt, response FROM prompt_history WHERE id > ? AND prompt_blob IS NULL ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            break
+        for history_id, prompt, response in rows:
+            conn.execute(
+                "UPDATE prompt_history SET prompt = '', response = NULL, prompt_blob = ?, response_blob = ? WHERE id = ?",
+                (store_text(conn, prompt), store_text(conn, response), history_id)
+            )
+        conn.commit()
+        last_id = rows[-1][0]
+        total += len(rows)
+        print(f"🗜️ {total}件を変換しました")
+    return total
+
+# 本文を参照している履歴がない（参照の確認は prompt_blob / response_blob の索引を使う）
+UNREFERENCED_BLOB = '''
+NOT EXISTS (SELECT 1 FROM prompt_history WHERE prompt_blob = history_blobs.id)
+AND NOT EXISTS (SELECT 1 FROM prompt_history WHERE response_blob = history_blobs.id)
+'''
+
+def collect_garbage(conn, batch_size=GC_BATCH_SIZE, pause=0.0, stop_event=None):
+    """どの履歴からも参照されなくなった本文を削除する（削除した件数を返す）
+
+    ID順に batch_size 件ずつ削除してコミットするため、書き込みのロックを長く保持しない。
+    削除の直前にも参照がないことを確かめる（候補を選んだ後に同じ本文が再利用された場合は残す）。
+    """
+    total = 0
+    last_id = 0
+    while stop_event is None or not stop_event.is_set():
+        ids = [row[0] for row in conn.execute(
+            f'SELECT id FROM history_blobs WHERE id > ? AND {UNREFERENCED_BLOB} ORDER BY id LIMIT ?',
+            (last_id, batch_size)
+        )]
+        if not ids:
+            break
+        placeholders = ','.join('?' * len(ids))
+        total += conn.execute(
+            f'DELETE FROM history_blobs WHERE id IN ({placeholders}) AND {UNREFERENCED_BLOB}', ids
+        ).rowcount
+        conn.commit()
+        last_id = ids[-1]
+        if pause:
+            time.sleep(pause)
+    return total
+
+def stats(conn):
+    """圧縮率（元の本文の合計 / 保存したサイズ）と重複排除の効果を返す"""
+    logical = conn.execute('''
+    SELECT IFNULL(SUM(b.size), 0) FROM prompt_history h JOIN history_blobs b ON b.id = h.prompt_blob
+    ''').fetchone()[0] + conn.execute('''
+    SELECT IFNULL(SUM(b.size), 0) FROM prompt_history h JOIN history_blobs b ON b.id = h.response_blob
+    ''').fetchone()[0]
+    blobs, unique_bytes, stored_bytes = conn.execute(
+        'SELECT COUNT(*), IFNULL(SUM(size), 0), IFNULL(SUM(length(data)), 0) FROM history_blobs'
+    ).fetchone()
+    inline = conn.execute(
+        'SELECT COUNT(*) FROM prompt_history WHERE prompt_blob IS NULL'
+    ).fetchone()[0]
+    return {
+        "blobs": blobs,
+        "inline_rows": inline,
+        "logical_bytes": logical,
+        "unique_bytes": unique_bytes,
+        "stored_bytes": stored_bytes,
+        "dedup_ratio": logical / unique_bytes if unique_bytes else None,
+        "compression_ratio": logical / stored_bytes if stored_bytes else None
+    }
+
+def read_overhead(conn, rows=1000):
+    """新しい履歴 rows 件の読み出し時間を、展開あり・なしで計測する（ミリ秒）"""
+    started = time.perf_counter()
+    conn.execute('SELECT prompt, response FROM history_entries ORDER BY id DESC LIMIT ?', (rows,)).fetchall()
+    decoded_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    conn.execute('''
+    SELECT p.data, r.data FROM prompt_history h
+    LEFT JOIN history_blobs p ON p.id = h.prompt_blob LEFT JOIN history_blobs r ON r.id = h.response_blob
+    ORDER BY h.id DESC LIMIT ?
+    ''', (rows,)).fetchall()
+    raw_ms = (time.perf_counter() - started) * 1000
+    return {"rows": rows, "decoded_ms": decoded_ms, "raw_ms": raw_ms}
+
+def print_stats(conn):
+    result = stats(conn)
+    overhead = read_overhead(conn)
+    print(f"📦 本文: {result['blobs']}件 / 未変換の履歴: {result['inline_rows']}件")
+    print(f"   元のサイズ {result['logical_bytes']:,} B → 重複排除後 {result['unique_bytes']:,} B "
+          f"→ 保存サイズ {result['stored_bytes']:,} B")
+    if result['compression_ratio']:
+        print(f"   重複排除 {result['dedup_ratio']:.2f}倍 / 全体の圧縮率 {result['compression_ratio']:.2f}倍")
+    print(f"⏱️ 最新{overhead['rows']}件の読み出し: 展開あり {overhead['decoded_ms']:.1f}ms "
+          f"/ 展開なし {overhead['raw_ms']:.1f}ms")
+
+def main():
+    import history_db
+
+    parser = argparse.ArgumentParser(description="履歴本文の圧縮ストアの管理")
+    parser.add_argument('command', choices=['migrate', 'stats', 'gc'],
+                        help="migrate: 既存の履歴を変換 / stats: 圧縮率と読み出し時間 / gc: 不要な本文を削除")
+    parser.add_argument('--db', default=history_db.DEFAULT_DB_PATH)
+    parser.add_argument('--retrain', action='store_true', help="辞書を学習し直す（以降に保存する本文に使用）")
+    parser.add_argument('--vacuum', action='store_true', help="変換後に VACUUM してファイルを縮める")
+    args = parser.parse_args()
+
+    conn = history_db.connect(args.db, isolation_level=None)
+    history_db.migrate(conn)
+    conn.isolation_level = ''
+    try:
+        if args.command == 'migrate':
+            if args.retrain or current_dictionary(conn)[0] is None:
+                dict_id = train(conn)
+                print(f"📖 圧縮辞書を学習しました: {dict_id}" if dict_id else "📖 繰り返しが少ないため辞書なしで圧縮します")
+            print(f"✅ {migrate_rows(conn)}件を変換しました")
+            if args.vacuum:
+                conn.isolation_level = None
+                conn.execute('VACUUM')
+        elif args.command == 'gc':
+            print(f"🗑️ 不要な本文を{collect_garbage(conn)}件削除しました")
+        print_stats(conn)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプト履歴のバッチ書き込み
+
+履歴の保存要求をキューに溜め、1本の常時接続から「最大 batch_size 件、または最初の1件から
+batch_wait_ms ミリ秒」分をまとめて1トランザクションに書き込む（本文は history_store の圧縮ストアに保存）。
+1件ごとに接続・コミット（fsync）・切断していた頃と比べ、同時に多数の履歴が届いてもキューが溜まらない。
+
+submit() は PendingWrite を返すため、呼び出し側は wait() で自分の行の保存完了（と履歴ID）を待てる。
+まとめた書き込みが失敗した場合は1件ずつ書き込み直し、原因の行だけを失敗にする（他の人の履歴は失わない）。
+"""
+
+import threading
+import time
+from queue import Queue, Empty as queue_Empty
+
+import history_db
+import similarity_index
+
+# デフォルト設定
+DEFAULT_DB_PATH = 'prompt_history.db'
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_BATCH_WAIT_MS = 20
+
+class PendingWrite:
+    """キューに入れた履歴1件。保存が終わると id（失敗時は error）が設定される"""
+
+    __slots__ = ('prompt', 'response', 'api_type', 'client_ip', 'cached', 'requested_at',
+                 'submitted', 'trace_id', 'id', 'error', 'done')
+
+    def __init__(self, prompt, response, api_type, client_ip, cached=False, trace_id=None):
+        self.prompt = prompt
+        self.response = response
+        self.api_type = api_type
+        self.client_ip = client_ip
+        self.cached = cached
+        self.requested_at = time.time()  # 保存時刻ではなく要求時刻を記録する
+        self.submitted = time.perf_counter()
+        self.trace_id = trace_id  # トレースログに記録するリクエストのID（request_trace）
+        self.id = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """保存が終わるまで待ち、履歴IDを返す（タイムアウト・失敗時は None）"""
+        self.done.wait(timeout)
+        return self.id
+
+class HistoryWriter:
+    """履歴をまとめて書き込むバックグラウンドスレッド"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, batch_size=DEFAULT_BATCH_SIZE,
+                 batch_wait_ms=DEFAULT_BATCH_WAIT_MS, on_batch=None):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait_ms / 1000
+        self.on_batch = on_batch  # 書き込み後に on_batch(書き込んだ PendingWrite のリスト) を呼ぶ
+        self.queue = Queue()
+        self.thread = None
+        self.running = False
+
+        self.stats_lock = threading.Lock()
+        self.stats_counter = {
+            "written": 0, "failed": 0, "batches": 0,
+            "batch_ms_total": 0.0, "batch_ms_max": 0.0, "last_batch_ms": 0.0, "last_batch_size": 0,
+            "wait_ms_total": 0.0
+        }
+
+    def start(self):
+        """書き込みスレッドを開始する"""
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True, name="history-writer")
+        self.thread.start()
+
+    def submit(self, prompt, response, api_type, client_ip, cached=False, trace_id=None):
+        """履歴の保存を要求する（すぐに戻る。prompt・response が文字列でなければ TypeError）"""
+        # 不正な値は書き込みスレッドではなく呼び出し側で失敗させる
+        if not isinstance(prompt, str):
+            raise TypeError(f"prompt は文字列で指定してください: {type(prompt).__name__}")
+        if response is not None and not isinstance(response, str):
+            raise TypeError(f"response は文字列で指定してください: {type(response).__name__}")
+        pending = PendingWrite(prompt, response, api_type, client_ip, cached, trace_id)
+        self.queue.put(pending)
+        return pending
+
+    def stop(self, timeout=5):
+        """キューに残っている履歴を書き込んでからスレッドを停止する"""
+        if not self.running:
+            return
+        self.queue.put(None)  # 終了シグナル
+        self.thread.join(timeout)
+        self.running = False
+
+    def stats(self):
+        """キューの長さとバッチ書き込みの統計を返す"""
+        with self.stats_lock:
+            counter = dict(self.stats_counter)
+        batches = counter.pop('batches')
+        written = counter['written']
+        return {
+            "queue_depth": self.queue.qsize(),
+            "written": written,
+            "failed": counter['failed'],
+            "batches": batches,
+            "avg_batch_size": (written + counter['failed']) / batches if batches else 0.0,
+            "last_batch_size": counter['last_batch_size'],
+            "last_batch_ms": round(counter['last_batch_ms'], 2),
+            "avg_batch_ms": round(counter['batch_ms_total'] / batches, 2) if batches else 0.0,
+            "max_batch_ms": round(counter['batch_ms_max'], 2),
+            # 要求から保存完了までの平均時間（キューでの待ち時間を含む）
+            "avg_wait_ms": round(counter['wait_ms_total'] / written, 2) if written else 0.0
+        }
+
+    # ---- 書き込みスレッド ----
+
+    def run(self):
+        # トランザクションは自分で開始・コミットする（isolation_level=None）
+        conn = history_db.connect(self.db_path, isolation_level=None)
+        try:
+            while True:
+                batch, stopping = self.collect_batch()
+                if batch:
+                    self.write_batch(conn, batch)
+                if stopping:
+                    break
+        finally:
+            conn.close()
+
+    def collect_batch(self):
+        """最初の1件を待ち、その後 batch_wait 秒以内に届いたものを batch_size 件までまとめる"""
+        try:
+            first = self.queue.get(timeout=1)
+        except queue_Empty:
+            return [], False
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.perf_counter() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                # 時間切れでもキューに溜まっている分は待たずに取り出す
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue_Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def write_batch(self, conn, batch):
+        """まとめた履歴を1トランザクションで書き込み、それぞれの完了を通知する"""
+        started = time.perf_counter()
+        try:
+            self.write_transaction(conn, batch)
+        except Exception as e:
+            print(f"❌ 履歴保存エラー: {e}（1件ずつ書き込み直します）")
+            # 失敗した行だけを特定するため、1件ずつ別のトランザクションで書き込む
+            for item in batch:
+                try:
+                    self.write_transaction(conn, [item])
+                except Exception as item_error:
+                    item.error = str(item_error)
+                    print(f"❌ 履歴保存エラー: {item.client_ip} - {item_error}")
+
+        finished = time.perf_counter()
+        elapsed_ms = (finished - started) * 1000
+        failed = sum(1 for item in batch if item.error is not None)
+        with self.stats_lock:
+            counter = self.stats_counter
+            counter['batches'] += 1
+            counter['written'] += len(batch) - failed
+            counter['failed'] += failed
+            counter['last_batch_size'] = len(batch)
+            counter['last_batch_ms'] = elapsed_ms
+            counter['batch_ms_total'] += elapsed_ms
+            counter['batch_ms_max'] = max(counter['batch_ms_max'], elapsed_ms)
+            counter['wait_ms_total'] += sum((finished - item.submitted) * 1000
+                                            for item in batch if item.error is None)
+        for item in batch:
+            item.done.set()
+
+        if not failed:
+            print(f"📝 履歴保存完了: {len(batch)}件 ({elapsed_ms:.1f}ms)")
+        if self.on_batch is not None:
+            try:
+                self.on_batch(batch)
+            except Exception as e:
+                print(f"❌ 履歴保存後の処理でエラー: {e}")
+
+    def write_transaction(self, conn, items):
+        """items を1トランザクションで書き込む（失敗時はロールバックして例外を送出し、id は None に戻す）"""
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for item in items:
+                # 本文は圧縮ストアに保存（同じ本文は既存のものを参照）
+                item.id = history_db.insert_history(conn, item.prompt, item.response, item.api_type,
+                                                    item.client_ip, item.cached, now=item.requested_at)
+            self.index_batch(conn, items)
+            conn.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for item in items:
+                item.id = None
+            raise
+
+    def index_batch(self, conn, batch):
+        """類似プロンプト索引に追加する（失敗しても履歴の書き込みは取り消さない）"""
+        conn.execute('SAVEPOINT similarity_index')
+        try:
+            signature_rows = []
+            bucket_rows = []
+            for item in batch:
+                signature_row, rows = similarity_index.index_params(item.id, item.prompt)
+                signature_rows.append(signature_row)
+                bucket_rows.extend(rows)
+            conn.executemany(similarity_index.INSERT_SIGNATURE_SQL, signature_rows)
+            conn.executemany(similarity_index.INSERT_BUCKET_SQL, bucket_rows)
+            if similarity_index.catch_up_done.is_set():
+                conn.execute(similarity_index.UPDATE_WATERMARK_SQL, (batch[-1].id,))
+            conn.execute('RELEASE similarity_index')
+        except Exception as e:
+            conn.execute('ROLLBACK TO similarity_index')
+            conn.execute('RELEASE similarity_index')
+            print(f"❌ 類似プロンプト索引エラー: {e}")
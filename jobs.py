@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+"""
+時間のかかる生成をバックグラウンドで実行するジョブ（web_app.py・web_app_async.py で共通）
+
+/api/chat・/api/text は応答が返るまで接続を保持するため、長い生成は読み取りタイムアウトや
+ブラウザの制限で途中で切れ、利用者が再送すると同じ生成が二重に走る。
+POST /api/jobs はジョブを SQLite（jobs.db）に登録してすぐに ID を返し、ワーカーが上流に
+ストリーミングで送信する。受信した途中の回答は flush_interval 秒ごとに保存し、
+クライアントは GET /api/jobs/<id>（?wait= で完了まで待機）か /api/jobs/<id>/events（SSE）で受け取る。
+
+アプリを再起動すると、実行中だったジョブは待機中に戻して最初から生成し直す（max_attempts 回まで）。
+上流との接続の切断も retry_delay 秒後に再試行する。混雑（AdmissionRejected）の場合は Retry-After の秒数後に
+並び直し、試行回数には数えない。
+jobs.db はワーカーの開始時（アプリの起動処理）に開くため、モジュールを import しただけでは開かない。
+完了した回答は通常のリクエストと同じく HistoryWriter で prompt_history に保存する。
+jobs.db は1つのプロセスで使う前提（起動時に実行中のジョブをすべて再開するため）。
+
+設定は ipconfig.ini の [JOBS] セクション。
+"""
+
+import asyncio
+import configparser
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from batch_jobs import DEFAULT_TEMPERATURE, DEFAULT_MAX_TOKENS
+from response_cache import build_completion_result
+
+# デフォルト設定
+DEFAULT_DB_PATH = 'jobs.db'
+DEFAULT_WORKERS = 2
+DEFAULT_READ_TIMEOUT = 600
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 5
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_KEEP_DAYS = 7
+DEFAULT_MAX_PENDING = 20
+
+# 古いジョブを削除する間隔（秒）
+PURGE_INTERVAL = 3600
+
+# 待機中のワーカーが新しいジョブを確認する間隔（秒。再試行の待ち時間を過ぎたジョブを拾う）
+IDLE_INTERVAL = 1.0
+
+# GET /api/jobs/<id>?wait= で待てる最長の秒数
+MAX_WAIT_SECONDS = 60
+
+# /api/jobs/<id>/events で変化がない間に送るコメントの間隔（秒。接続を維持する）
+KEEPALIVE_INTERVAL = 15
+
+STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+class JobError(ValueError):
+    """ジョブの入力が不正（400 で返す）"""
+
+class TooManyJobs(Exception):
+    """このクライアントの未完了のジョブが多すぎる（429 で返す）"""
+
+class JobCancelledError(Exception):
+    """実行中のジョブが取り消された（上流の呼び出しの計測で cancelled として数える）"""
+
+def parse_job(data):
+    """POST /api/jobs の本文を (api_type, プロンプト, モデル, LM Studio に送る本文) に変換する"""
+    if not isinstance(data, dict):
+        raise JobError("JSON のオブジェクトで指定してください")
+    api_type = str(data.get('api_type') or 'chat').lower()
+    if api_type not in ('chat', 'text'):
+        raise JobError("api_type は chat か text を指定してください")
+    prompt = data.get('prompt')
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise JobError("prompt を指定してください")
+    model = str(data.get('model') or 'default')
+    try:
+        temperature = float(data.get('temperature', DEFAULT_TEMPERATURE))
+        max_tokens = int(data.get('max_tokens', DEFAULT_MAX_TOKENS[api_type]))
+    except (TypeError, ValueError):
+        raise JobError("temperature・max_tokens は数値で指定してください")
+
+    # /api/chat・/api/text と同じ形
+    if api_type == 'chat':
+        payload = {"messages": [{"role": "user", "content": prompt}]}
+    else:
+        payload = {"prompt": prompt}
+    payload["temperature"] = temperature
+    payload["max_tokens"] = max_tokens
+    if model != "default":
+        payload["model"] = model
+    return api_type, prompt, model, payload
+
+def load_job_manager(history_writer, config_file='ipconfig.ini'):
+    """ipconfig.ini の [JOBS] セクションからジョブの管理を作成する（無効時は None）"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file, encoding='utf-8')
+    except Exception as e:
+        print(f"❌ ジョブ設定の読み込みエラー: {e}")
+    section = 'JOBS'
+    if not config.getboolean(section, 'enabled', fallback=True):
+        print("⚠️ バックグラウンドジョブは無効です")
+        return None
+    return JobManager(
+        history_writer,
+        db_path=config.get(section, 'db_path', fallback=DEFAULT_DB_PATH),
+        workers=config.getint(section, 'workers', fallback=DEFAULT_WORKERS),
+        read_timeout=config.getfloat(section, 'read_timeout', fallback=DEFAULT_READ_TIMEOUT),
+        max_attempts=config.getint(section, 'max_attempts', fallback=DEFAULT_MAX_ATTEMPTS),
+        retry_delay=config.getfloat(section, 'retry_delay', fallback=DEFAULT_RETRY_DELAY),
+        flush_interval=config.getfloat(section, 'flush_interval', fallback=DEFAULT_FLUSH_INTERVAL),
+        keep_days=config.getfloat(section, 'keep_days', fallback=DEFAULT_KEEP_DAYS),
+        max_pending=config.getint(section, 'max_pending', fallback=DEFAULT_MAX_PENDING)
+    )
+
+class Job:
+    """ジョブ1件（jobs テーブルの1行）"""
+
+    __slots__ = ('id', 'client_ip', 'priority', 'api_type', 'model', 'prompt', 'payload', 'status',
+                 'attempts', 'not_before', 'created_at', 'started_at', 'finished_at', 'updated_at',
+                 'partial_text', 'result', 'error')
+
+    COLUMNS = __slots__
+
+    @classmethod
+    def from_row(cls, row):
+        job = cls()
+        for name, value in zip(cls.COLUMNS, row):
+            setattr(job, name, value)
+        job.payload = json.loads(job.payload)
+        job.result = json.loads(job.result) if job.result else None
+        job.error = json.loads(job.error) if job.error else None
+        job.partial_text = job.partial_text or ""
+        return job
+
+    @property
+    def endpoint(self):
+        return 'chat/completions' if self.api_type == 'chat' else 'completions'
+
+    @property
+    def finished(self):
+        return self.status in FINISHED
+
+    def to_dict(self, include_text=True):
+        entry = {
+            "id": self.id, "status": self.status, "api_type": self.api_type, "model": self.model,
+            "priority": self.priority, "prompt": self.prompt, "attempts": self.attempts,
+            "created_at": self.created_at, "started_at": self.started_at,
+            "finished_at": self.finished_at, "updated_at": self.updated_at,
+            "chars": len(self.partial_text), "error": self.error
+        }
+        if include_text:
+            entry["response"] = self.partial_text
+            entry["result"] = self.result
+        return entry
+
+class JobEventStream:
+    """/api/jobs/<id>/events で送るイベント（送った位置を覚えて、前回からの差分だけを返す）
+
+    途中の回答は data: {"delta": ...}（id: はそこまでの文字数。再接続時の Last-Event-ID で続きから送る）、
+    状態の変化は event: status、終了は event: done。再試行で最初から生成し直した場合は event: reset。
+    """
+
+    def __init__(self, offset=0):
+        self.offset = max(0, offset)
+        self.status = None
+
+    def events(self, job):
+        events = []
+        if job.status != self.status:
+            self.status = job.status
+            if not job.finished:
+                events.append(f"event: status\ndata: {json.dumps({'status': job.status, 'attempts': job.attempts})}\n\n")
+        text = job.partial_text
+        if len(text) < self.offset:
+            self.offset = 0
+            events.append("event: reset\ndata: {}\n\n")
+        if len(text) > self.offset:
+            delta = json.dumps({"delta": text[self.offset:]}, ensure_ascii=False)
+            self.offset = len(text)
+            events.append(f"id: {self.offset}\ndata: {delta}\n\n")
+        if job.finished:
+            done = json.dumps(job.to_dict(include_text=False), ensure_ascii=False)
+            events.append(f"event: done\ndata: {done}\n\n")
+        return events
+
+class JobManager:
+    """SQLite に保存するジョブのキューと、実行中のジョブの途中の回答"""
+
+    def __init__(self, history_writer, db_path=DEFAULT_DB_PATH, workers=DEFAULT_WORKERS,
+                 read_timeout=DEFAULT_READ_TIMEOUT, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 retry_delay=DEFAULT_RETRY_DELAY, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 keep_days=DEFAULT_KEEP_DAYS, max_pending=DEFAULT_MAX_PENDING):
+        self.history_writer = history_writer
+        self.db_path = db_path
+        self.workers = max(1, workers)
+        self.read_timeout = read_timeout
+        self.max_attempts = max(1, max_attempts)
+        self.retry_delay = retry_delay
+        self.flush_interval = flush_interval
+        self.keep_seconds = keep_days * 86400
+        self.max_pending = max_pending
+
+        self.lock = threading.Lock()
+        # ジョブの状態が変わるたびに version を増やし、完了や途中の回答を待っている側を起こす
+        self.changed = threading.Condition(self.lock)
+        self.version = 0
+        self.async_waiters = []
+        self.live = {}        # 実行中のジョブ: id -> Job（途中の回答はメモリが最新）
+        self.flushed_at = {}  # 実行中のジョブ: id -> 途中の回答を最後に保存した時刻
+        self.cancelled = set()
+        self.cancel_callbacks = {}  # 実行中のジョブ: id -> 取り消されたときに呼ぶ関数（上流との接続を閉じる）
+        self.running = False
+        self.threads = []
+        self.tasks = []
+        self.last_purge = 0.0
+        self.stats_counter = {"submitted": 0, "succeeded": 0, "failed": 0, "cancelled": 0,
+                              "retried": 0, "deferred": 0, "recovered": 0}
+        self.conn = None
+
+    def open(self):
+        """jobs.db を開き、前回の起動で実行中だったジョブを再開できるようにする（start から呼ぶ。2回目以降は何もしない）"""
+        with self.lock:
+            if self.conn is not None:
+                return
+            self.conn = self._connect()
+        self.recover()
+        self.purge()
+        counts = self.status_counts()
+        print(f"🧾 バックグラウンドジョブ: 待機中 {counts['queued']}件"
+              f"（うち再起動で再開 {self.stats_counter['recovered']}件）")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            client_ip TEXT NOT NULL,
+            priority TEXT,
+            api_type TEXT NOT NULL,
+            model TEXT,
+            prompt TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            updated_at REAL NOT NULL,
+            partial_text TEXT,
+            result TEXT,
+            error TEXT
+        )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, not_before, created_at)')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_client ON jobs (client_ip, created_at)')
+        return conn
+
+    # ---- 登録・参照 ----
+
+    def submit(self, client_ip, priority, api_type, model, prompt, payload):
+        """ジョブを待機中として登録して返す（未完了のジョブが max_pending 件以上なら TooManyJobs）"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            if self.max_pending:
+                pending = self.conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE client_ip = ? AND status IN ('queued', 'running')",
+                    (client_ip,)
+                ).fetchone()[0]
+                if pending >= self.max_pending:
+                    raise TooManyJobs(f"未完了のジョブは{self.max_pending}件までです")
+            self.conn.execute(
+                '''INSERT INTO jobs (id, client_ip, priority, api_type, model, prompt, payload, status,
+                                     created_at, updated_at)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?)''',
+                (job_id, client_ip, priority, api_type, model, prompt,
+                 json.dumps(payload, ensure_ascii=False), now, now)
+            )
+            self.stats_counter['submitted'] += 1
+            self._notify()
+            return self._load(job_id)
+
+    def get(self, job_id, client_ip=None):
+        """ジョブを取得する（client_ip を指定すると、そのクライアントのジョブのみ。なければ None）"""
+        with self.lock:
+            job = self.live.get(job_id) or self._load(job_id)
+        if job is None or (client_ip is not None and job.client_ip != client_ip):
+            return None
+        return job
+
+    def list_for_client(self, client_ip, limit=50):
+        """クライアントのジョブを新しい順に返す"""
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(Job.COLUMNS)} FROM jobs WHERE client_ip = ? ORDER BY created_at DESC LIMIT ?",
+                (client_ip, limit)
+            ).fetchall()
+            return [self.live.get(row[0]) or Job.from_row(row) for row in rows]
+
+    def cancel(self, job_id, client_ip):
+        """ジョブを取り消す（実行中のジョブは on_cancel で登録された関数で上流との接続を閉じる）"""
+        callback = None
+        with self.lock:
+            job = self.live.get(job_id) or self._load(job_id)
+            if job is None or job.client_ip != client_ip:
+                return None
+            if job.finished:
+                return job
+            partial_text = job.partial_text
+            self.conn.execute(
+                "UPDATE jobs SET status = 'cancelled', partial_text = ?, finished_at = ?, updated_at = ? WHERE id = ?",
+                (partial_text, time.time(), time.time(), job_id)
+            )
+            if job_id in self.live:
+                self.cancelled.add(job_id)
+                self._drop_live(job_id)
+                callback = self.cancel_callbacks.pop(job_id, None)
+            self.stats_counter['cancelled'] += 1
+            self._notify()
+            job = self._load(job_id)
+        if callback is not None:
+            callback()
+        return job
+
+    # ---- ワーカー側 ----
+
+    def claim(self):
+        """実行できる待機中のジョブを1件取り出して実行中にする（なければ None）"""
+        now = time.time()
+        with self.lock:
+            if now - self.last_purge >= PURGE_INTERVAL:
+                self._purge(now)
+            row = self.conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' AND not_before <= ? ORDER BY created_at LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            # 生成し直すため、前回の試行の途中の回答は捨てる
+            self.conn.execute(
+                '''UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ?, updated_at = ?,
+                                   partial_text = '', error = NULL
+                   WHERE id = ?''',
+                (now, now, row[0])
+            )
+            job = self._load(row[0])
+            self.live[job.id] = job
+            self.flushed_at[job.id] = now
+            self._notify()
+            return job
+
+    def is_cancelled(self, job):
+        with self.lock:
+            return job.id in self.cancelled
+
+    def on_cancel(self, job, callback):
+        """ジョブが取り消されたときに callback() を呼ぶ（取り消し済みならすぐに呼んで False を返す）"""
+        with self.lock:
+            cancelled = job.id in self.cancelled
+            if not cancelled:
+                self.cancel_callbacks[job.id] = callback
+        if cancelled:
+            callback()
+        return not cancelled
+
+    def detach(self, job):
+        """ワーカーがジョブの実行を終えた（取り消されたジョブの記録もここで消す）"""
+        with self.lock:
+            self._drop_live(job.id)
+            self.cancelled.discard(job.id)
+            self.cancel_callbacks.pop(job.id, None)
+
+    def progress(self, job, delta):
+        """受信した差分を途中の回答に追加する（保存する時期になったら True。保存は flush で行う）"""
+        with self.lock:
+            job.partial_text += delta
+            job.updated_at = time.time()
+            self._notify()
+            return job.id in self.live and job.updated_at - self.flushed_at[job.id] >= self.flush_interval
+
+    def flush(self, job):
+        """途中の回答を保存する（再起動後にも途中までの回答を確認できるように）"""
+        now = time.time()
+        with self.lock:
+            if job.id not in self.live:
+                return
+            self.conn.execute("UPDATE jobs SET partial_text = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+                              (job.partial_text, now, job.id))
+            self.flushed_at[job.id] = now
+
+    def complete(self, job, usage=None):
+        """ジョブを完了にし、回答を履歴に保存する（取り消されていた場合は何もしない）"""
+        response_text = job.partial_text
+        result = build_completion_result(job.api_type, response_text, job.model)
+        if usage:
+            result["usage"] = usage
+        now = time.time()
+        with self.lock:
+            updated = self.conn.execute(
+                '''UPDATE jobs SET status = 'succeeded', partial_text = ?, result = ?, finished_at = ?, updated_at = ?
+                   WHERE id = ? AND status = 'running' ''',
+                (response_text, json.dumps(result, ensure_ascii=False), now, now, job.id)
+            ).rowcount
+            self._drop_live(job.id)
+            self.cancelled.discard(job.id)
+            if updated:
+                self.stats_counter['succeeded'] += 1
+            self._notify()
+        if updated:
+            self.history_writer.submit(job.prompt, response_text, job.api_type, job.client_ip)
+            print(f"🧾 ジョブ完了: {job.client_ip} - {job.id}（{len(response_text)}文字）")
+
+    def fail(self, job, error, retry=False):
+        """ジョブを失敗にする（retry=True で試行回数が残っていれば retry_delay 秒後に再試行する）"""
+        now = time.time()
+        with self.lock:
+            if retry and job.attempts < self.max_attempts:
+                updated = self.conn.execute(
+                    '''UPDATE jobs SET status = 'queued', not_before = ?, error = ?, updated_at = ?
+                       WHERE id = ? AND status = 'running' ''',
+                    (now + self.retry_delay, json.dumps(error, ensure_ascii=False), now, job.id)
+                ).rowcount
+                counter = 'retried'
+            else:
+                updated = self.conn.execute(
+                    '''UPDATE jobs SET status = 'failed', partial_text = ?, error = ?, finished_at = ?, updated_at = ?
+                       WHERE id = ? AND status = 'running' ''',
+                    (job.partial_text, json.dumps(error, ensure_ascii=False), now, now, job.id)
+                ).rowcount
+                counter = 'failed'
+            self._drop_live(job.id)
+            self.cancelled.discard(job.id)
+            if updated:
+                self.stats_counter[counter] += 1
+            self._notify()
+        if updated:
+            print(f"{'🔁 ジョブを再試行' if counter == 'retried' else '❌ ジョブ失敗'}: {job.client_ip} - {job.id}"
+                  f" ({error.get('error')})")
+
+    def defer(self, job, error, delay):
+        """混雑で送信できなかったジョブを delay 秒後に並び直す（試行回数には数えない）"""
+        now = time.time()
+        with self.lock:
+            updated = self.conn.execute(
+                '''UPDATE jobs SET status = 'queued', attempts = MAX(0, attempts - 1), not_before = ?, error = ?,
+                                   updated_at = ?
+                   WHERE id = ? AND status = 'running' ''',
+                (now + delay, json.dumps(error, ensure_ascii=False), now, job.id)
+            ).rowcount
+            self._drop_live(job.id)
+            self.cancelled.discard(job.id)
+            if updated:
+                self.stats_counter['deferred'] += 1
+            self._notify()
+        if updated:
+            print(f"⏳ 混雑のためジョブを{delay:.0f}秒後に並び直します: {job.client_ip} - {job.id}")
+
+    # ---- 待機 ----
+
+    def wait_for_change(self, version, timeout):
+        """version から状態が変わるまで最大 timeout 秒待ち、現在の version を返す"""
+        with self.changed:
+            if self.version == version:
+                self.changed.wait(timeout)
+            return self.version
+
+    async def wait_for_change_async(self, version, timeout):
+        """wait_for_change の asyncio版"""
+        loop = asyncio.get_running_loop()
+        changed = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: changed.done() or changed.set_result(None))
+
+        with self.lock:
+            if self.version != version:
+                return self.version
+            self.async_waiters.append(wake)
+        try:
+            await asyncio.wait_for(changed, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            with self.lock:
+                if wake in self.async_waiters:
+                    self.async_waiters.remove(wake)
+        return self.version
+
+    def _notify(self):
+        # self.lock を保持した状態で呼ぶ
+        self.version += 1
+        self.changed.notify_all()
+        for wake in self.async_waiters:
+            try:
+                wake()
+            except RuntimeError:
+                pass  # イベントループが終了済み
+        self.async_waiters.clear()
+
+    # ---- ワーカーの起動 ----
+
+    def start(self, execute):
+        """jobs.db を開き、execute(job) を実行するワーカースレッドを workers 本開始する（web_app.py）"""
+        if self.running:
+            return
+        self.open()
+        self.running = True
+
+        def worker():
+            while self.running:
+                version = self.version
+                try:
+                    job = self.claim()
+                    if job is None:
+                        self.wait_for_change(version, IDLE_INTERVAL)
+                        continue
+                    try:
+                        execute(job)
+                    except Exception as e:
+                        # 想定外のエラーでジョブが実行中のまま残らないようにする
+                        self.fail(job, {"error": str(e)})
+                        raise
+                    finally:
+                        self.detach(job)
+                except Exception as e:
+                    print(f"❌ ジョブのワーカーエラー: {e}")
+                    time.sleep(IDLE_INTERVAL)
+
+        for number in range(self.workers):
+            thread = threading.Thread(target=worker, daemon=True, name=f"job-worker-{number}")
+            thread.start()
+            self.threads.append(thread)
+        print(f"🧾 ジョブのワーカーを開始しました（{self.workers}本）")
+
+    def start_async(self, execute):
+        """await execute(job) を実行するワーカーのタスクを workers 個開始する（web_app_async.py。open は先に済ませておく）
+
+        ジョブは1件ずつ別のタスクで実行し、取り消されたらそのタスクをキャンセルする
+        （受付制御の順番待ちや最初のトークンを待っている間でも、すぐに上流との接続を閉じる）。
+        """
+        if self.running:
+            return
+        self.open()
+        self.running = True
+        loop = asyncio.get_running_loop()
+
+        async def worker():
+            while self.running:
+                version = self.version
+                try:
+                    job = await asyncio.to_thread(self.claim)
+                    if job is None:
+                        await self.wait_for_change_async(version, IDLE_INTERVAL)
+                        continue
+                    attempt = asyncio.create_task(execute(job))
+                    self.on_cancel(job, lambda: loop.call_soon_threadsafe(attempt.cancel))
+                    try:
+                        await attempt
+                    except asyncio.CancelledError:
+                        # ジョブの取り消しなら次のジョブへ。ワーカー自体の停止なら終了する
+                        if not self.is_cancelled(job) or not self.running:
+                            raise
+                    except Exception as e:
+                        await asyncio.to_thread(self.fail, job, {"error": str(e)})
+                        raise
+                    finally:
+                        self.detach(job)
+                except Exception as e:
+                    print(f"❌ ジョブのワーカーエラー: {e}")
+                    await asyncio.sleep(IDLE_INTERVAL)
+
+        self.tasks = [asyncio.create_task(worker()) for _ in range(self.workers)]
+        print(f"🧾 ジョブのワーカーを開始しました（{self.workers}本）")
+
+    def stop(self):
+        """ワーカーを止める（実行中のジョブは jobs.db に実行中のまま残り、次の起動時に再開する）"""
+        self.running = False
+        for task in self.tasks:
+            task.cancel()
+        with self.lock:
+            if self.conn is None:
+                return
+            for job in self.live.values():
+                self.conn.execute("UPDATE jobs SET partial_text = ?, updated_at = ? WHERE id = ?",
+                                  (job.partial_text, time.time(), job.id))
+            self._notify()
+        for thread in self.threads:
+            thread.join(timeout=1)
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    # ---- 再起動・削除 ----
+
+    def recover(self):
+        """前回の起動で実行中だったジョブを待機中に戻す（試行回数を使い切ったものは失敗にする）"""
+        now = time.time()
+        error = json.dumps({"error": "アプリの再起動で中断されました"}, ensure_ascii=False)
+        with self.lock:
+            failed = self.conn.execute(
+                '''UPDATE jobs SET status = 'failed', error = ?, finished_at = ?, updated_at = ?
+                   WHERE status = 'running' AND attempts >= ?''',
+                (error, now, now, self.max_attempts)
+            ).rowcount
+            recovered = self.conn.execute(
+                "UPDATE jobs SET status = 'queued', not_before = 0, error = ?, updated_at = ? WHERE status = 'running'",
+                (error, now)
+            ).rowcount
+            self.stats_counter['recovered'] += recovered
+            self.stats_counter['failed'] += failed
+
+    def purge(self):
+        """keep_days を過ぎた終了済みのジョブを削除する"""
+        with self.lock:
+            return self._purge(time.time())
+
+    def _purge(self, now):
+        self.last_purge = now
+        if self.keep_seconds <= 0:
+            return 0
+        return self.conn.execute(
+            "DELETE FROM jobs WHERE status IN ('succeeded', 'failed', 'cancelled') AND finished_at < ?",
+            (now - self.keep_seconds,)
+        ).rowcount
+
+    def _load(self, job_id):
+        row = self.conn.execute(f"SELECT {', '.join(Job.COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job.from_row(row) if row is not None else None
+
+    def _drop_live(self, job_id):
+        self.live.pop(job_id, None)
+        self.flushed_at.pop(job_id, None)
+
+    # ---- 統計 ----
+
+    def status_counts(self):
+        with self.lock:
+            if self.conn is None:
+                counts = {}  # まだ開始していない
+            else:
+                counts = dict(self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    def stats(self):
+        counts = self.status_counts()
+        with self.lock:
+            counters = dict(self.stats_counter)
+        return dict(counters, jobs=counts, workers=self.workers, read_timeout=self.read_timeout,
+                    max_attempts=self.max_attempts)
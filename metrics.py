@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Prometheus 形式のメトリクス（/metrics）
+
+リクエストの処理中に値を記録するのはカウンターとヒストグラムだけで、どちらも値を
+STRIPES 個に分けて持つ。スレッドごとに別の区画（とロック）を使うため、同時に多数の
+リクエストを処理してもロックの取り合いがほとんど起きない。区画の合計は /metrics の取得時に計算する。
+
+キューの長さ・キャッシュのヒット数など、各部品が stats() で既に数えている値は
+add_collector() で登録した関数が取得時に読むため、リクエストの処理中には何もしない。
+"""
+
+import math
+import threading
+import time
+
+STRIPES = 16
+MAX_SERIES = 500  # 1つのメトリクスのラベルの組み合わせの上限（超えた分は "other" にまとめる）
+
+# 所要時間（秒）。LLM の応答は数十秒かかることがあるため上限を上流のタイムアウト（120秒）に合わせる
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKENS_PER_SECOND_BUCKETS = (1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+HISTORY_WRITE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def error_class(error):
+    """例外を (分類, HTTPステータス) にする（requests と httpx のどちらの例外も名前で判別する）"""
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return 'http', str(status_code)
+    names = [cls.__name__ for cls in type(error).__mro__]
+    if any(name.endswith('CancelledError') for name in names) or 'GeneratorExit' in names:
+        return 'cancelled', ''
+    if any('Timeout' in name for name in names):
+        return 'timeout', ''
+    if any('Connect' in name or name == 'NetworkError' for name in names):
+        return 'connection', ''
+    if 'NoBackendAvailable' in names:
+        return 'no_backend', ''
+    return 'other', ''
+
+class Metric:
+    """ラベルごとの値を STRIPES 個の区画に分けて持つメトリクス"""
+
+    type_name = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.stripes = [({}, threading.Lock()) for _ in range(STRIPES)]
+        self.series = set()
+        self.series_lock = threading.Lock()
+
+    def _key(self, labels):
+        key = tuple(str(value) for value in labels)
+        if key not in self.series:
+            with self.series_lock:
+                if len(self.series) >= MAX_SERIES:
+                    key = ('other',) * len(self.labelnames)
+                self.series.add(key)
+        return key
+
+    def _stripe(self):
+        return self.stripes[hash((threading.get_ident(),)) % STRIPES]
+
+    def _merged(self):
+        """区画ごとの値をラベルごとに合計する"""
+        merged = {}
+        for values, lock in self.stripes:
+            with lock:
+                items = [(key, self._copy(value)) for key, value in values.items()]
+            for key, value in items:
+                merged[key] = self._add(merged[key], value) if key in merged else value
+        return merged
+
+    def _copy(self, value):
+        return value
+
+    def _add(self, total, value):
+        return total + value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.type_name}']
+        for key, value in sorted(self._merged().items()):
+            lines.extend(self._render_series(list(zip(self.labelnames, key)), value))
+        return lines
+
+    def _render_series(self, labels, value):
+        return [f'{self.name}{format_labels(labels)} {format_value(value)}']
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        values, lock = self._stripe()
+        with lock:
+            values[key] = values.get(key, 0) + amount
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        # 値が入るバケットだけを数え、累積は取得時に計算する（最後の要素は +Inf、その後ろに合計）
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        values, lock = self._stripe()
+        with lock:
+            counts = values.get(key)
+            if counts is None:
+                counts = values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def _copy(self, value):
+        return list(value)
+
+    def _add(self, total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    def _render_series(self, labels, counts):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{format_labels(labels + [("le", format_value(bound))])} {cumulative}')
+        lines.append(f'{self.name}_sum{format_labels(labels)} {format_value(counts[-1])}')
+        lines.append(f'{self.name}_count{format_labels(labels)} {cumulative}')
+        return lines
+
+class Registry:
+    """メトリクスと、取得時に値を読む関数（collector）の一覧"""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, help_text, labelnames=()):
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect):
+        """collect() は (名前, 種類, 説明, [(ラベルのリスト, 値), ...]) を順に返す"""
+        self.collectors.append(collect)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collect in self.collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                print(f"❌ メトリクスの取得エラー: {e}")
+                continue
+            for name, type_name, help_text, samples in families:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {type_name}')
+                for labels, value in samples:
+                    lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+class UpstreamCall:
+    """上流（LM Studio）の呼び出し1回の計測。最初のバイト・usage・完了を順に記録する
+
+    trace（request_trace.RequestTrace）を渡すと、リクエストの Server-Timing に
+    upstream-ttfb（接続の時間を除く）と upstream-body も記録する。
+    """
+
+    __slots__ = ('metrics', 'endpoint', 'model', 'trace', 'connect_before', 'trace_mark', 'started',
+                 'first_byte_at', 'completion_tokens')
+
+    def __init__(self, metrics, endpoint, model, trace=None):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self.model = model or 'default'
+        self.trace = trace
+        self.connect_before = self._connect_seconds()
+        self.started = time.perf_counter()
+        self.trace_mark = self.started  # upstream-ttfb に記録済みの時刻
+        self.first_byte_at = None
+        self.completion_tokens = None
+
+    def _connect_seconds(self):
+        return self.trace.spans.get('upstream-connect', 0.0) if self.trace is not None else 0.0
+
+    def _trace_wait(self, until):
+        """前回の記録から until までのうち、接続以外の時間を upstream-ttfb に加える"""
+        if self.trace is not None:
+            connect_seconds = self._connect_seconds()
+            self.trace.add('upstream-ttfb', max(0.0, until - self.trace_mark - (connect_seconds - self.connect_before)))
+            self.trace_mark = until
+            self.connect_before = connect_seconds
+
+    def headers(self):
+        """ストリーミングの応答ヘッダーを受け取った（ここまでの待ち時間を応答開始時の Server-Timing に含める）"""
+        self._trace_wait(time.perf_counter())
+
+    def first_byte(self, elapsed=None):
+        """応答の最初のバイトを受け取った（elapsed は開始からの秒数。省略時は現在時刻から計算）"""
+        if self.first_byte_at is None:
+            self.first_byte_at = self.started + elapsed if elapsed is not None else time.perf_counter()
+            self.metrics.upstream_ttfb.observe(self.first_byte_at - self.started, self.endpoint, self.model)
+            self._trace_wait(self.first_byte_at)
+
+    def usage(self, usage):
+        """応答の usage を記録する（ストリーミングでは最後のチャンクにだけ含まれる）"""
+        if not usage:
+            return
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        self.completion_tokens = usage.get('completion_tokens') or 0
+        self.metrics.upstream_tokens.inc(self.model, 'prompt', amount=prompt_tokens)
+        self.metrics.upstream_tokens.inc(self.model, 'completion', amount=self.completion_tokens)
+
+    def finish(self, error=None, ended=None):
+        """完了を記録する（error は失敗時の例外。ended は本文を受信し終えた時刻で、省略時は現在時刻）"""
+        ended = time.perf_counter() if ended is None else ended
+        duration = ended - self.started
+        if self.first_byte_at is None:
+            self._trace_wait(ended)
+        elif self.trace is not None:
+            self.trace.add('upstream-body', max(0.0, ended - self.first_byte_at))
+        self.metrics.upstream_duration.observe(duration, self.endpoint, self.model)
+        if error is not None:
+            kind, status = error_class(error)
+            self.metrics.upstream_errors.inc(self.endpoint, kind, status)
+        elif self.completion_tokens and duration > 0:
+            self.metrics.upstream_tokens_per_second.observe(self.completion_tokens / duration, self.model)
+
+class ProxyMetrics:
+    """Web版（web_app.py / web_app_async.py）のメトリクス"""
+
+    def __init__(self):
+        self.registry = Registry()
+        registry = self.registry
+        self.http_duration = registry.histogram(
+            'lmstudio_http_request_duration_seconds',
+            'Time to build the HTTP response (streaming responses: until the stream starts)',
+            ('route', 'method', 'status'))
+        self.upstream_duration = registry.histogram(
+            'lmstudio_upstream_request_duration_seconds', 'Upstream LM Studio request duration',
+            ('endpoint', 'model'))
+        self.upstream_ttfb = registry.histogram(
+            'lmstudio_upstream_time_to_first_byte_seconds', 'Time until the first upstream response byte',
+            ('endpoint', 'model'))
+        self.upstream_tokens_per_second = registry.histogram(
+            'lmstudio_upstream_tokens_per_second', 'Completion tokens per second reported by usage',
+            ('model',), TOKENS_PER_SECOND_BUCKETS)
+        self.upstream_tokens = registry.counter(
+            'lmstudio_upstream_tokens_total', 'Tokens reported by usage', ('model', 'type'))
+        self.upstream_errors = registry.counter(
+            'lmstudio_upstream_errors_total', 'Upstream errors by class (timeout, connection, http, cancelled)',
+            ('endpoint', 'class', 'status'))
+        self.similar_reuse = registry.counter(
+            'lmstudio_similar_reuse_total', 'Responses answered from a similar past prompt', ('api_type',))
+        self.history_write = registry.histogram(
+            'lmstudio_history_write_seconds', 'Time from queueing a history row to its commit',
+            buckets=HISTORY_WRITE_BUCKETS)
+
+    def upstream_call(self, endpoint, model, trace=None):
+        return UpstreamCall(self, endpoint, model, trace)
+
+    def observe_request(self, route, method, status, seconds):
+        self.http_duration.observe(seconds, route, method, status)
+
+    def observe_history_batch(self, batch):
+        """HistoryWriter の on_batch から呼ぶ（書き込んだ各行の、要求から保存完了までの時間）"""
+        now = time.perf_counter()
+        for item in batch:
+            if item.error is None:
+                self.history_write.observe(now - item.submitted)
+
+    def add_sources(self, backend_pool=None, history_writer=None, response_cache=None, inflight=None,
+                    admission=None, jobs=None):
+        """各部品が stats() で数えている値を、/metrics の取得時に読む"""
+        if backend_pool is not None:
+            self.registry.add_collector(lambda: backend_families(backend_pool))
+        if history_writer is not None:
+            self.registry.add_collector(lambda: history_writer_families(history_writer))
+        if response_cache is not None:
+            self.registry.add_collector(lambda: response_cache_families(response_cache))
+        if inflight is not None:
+            self.registry.add_collector(lambda: inflight_families(inflight))
+        if admission is not None:
+            self.registry.add_collector(lambda: admission_families(admission))
+        if jobs is not None:
+            self.registry.add_collector(lambda: job_families(jobs))
+
+    def render(self):
+        return self.registry.render()
+
+def backend_families(backend_pool):
+    backends = backend_pool.status()
+    yield ('lmstudio_upstream_in_flight', 'gauge', 'Upstream requests in flight per backend',
+           [([('backend', b['url'])], b['outstanding']) for b in backends])
+    yield ('lmstudio_backend_healthy', 'gauge', 'Backend health (1 = healthy)',
+           [([('backend', b['url'])], int(b['healthy'])) for b in backends])
+
+def history_writer_families(history_writer):
+    stats = history_writer.stats()
+    yield ('lmstudio_history_queue_depth', 'gauge', 'History rows waiting to be written',
+           [([], stats['queue_depth'])])
+    yield ('lmstudio_history_rows_total', 'counter', 'History rows written or failed',
+           [([('result', 'written')], stats['written']), ([('result', 'failed')], stats['failed'])])
+    yield ('lmstudio_history_batches_total', 'counter', 'History write batches', [([], stats['batches'])])
+
+def response_cache_families(response_cache):
+    stats = response_cache.stats()
+    yield ('lmstudio_response_cache_lookups_total', 'counter', 'Response cache lookups',
+           [([('result', 'hit')], stats['hits']), ([('result', 'miss')], stats['misses'])])
+    yield ('lmstudio_response_cache_hit_ratio', 'gauge', 'Response cache hit ratio', [([], stats['hit_ratio'])])
+    yield ('lmstudio_response_cache_entries', 'gauge', 'Response cache entries', [([], stats['entries'])])
+    yield ('lmstudio_response_cache_bytes', 'gauge', 'Response cache size in bytes', [([], stats['bytes'])])
+
+def inflight_families(inflight):
+    stats = inflight.stats()
+    yield ('lmstudio_coalesce_requests_total', 'counter', 'Deterministic requests by upstream call or coalesced',
+           [([('result', 'upstream')], stats['upstream_calls']), ([('result', 'coalesced')], stats['coalesced'])])
+    yield ('lmstudio_coalesce_ratio', 'gauge', 'Share of deterministic requests that were coalesced',
+           [([], stats['saved_ratio'])])
+
+def admission_families(admission):
+    stats = admission.stats()
+    classes = stats['classes']
+    yield ('lmstudio_admission_waiting', 'gauge', 'Requests waiting for an upstream slot',
+           [([('priority', priority)], c['waiting']) for priority, c in classes.items()])
+    yield ('lmstudio_admission_clients_waiting', 'gauge', 'Clients with requests waiting for an upstream slot',
+           [([], stats['clients_waiting'])])
+    yield ('lmstudio_admission_requests_total', 'counter', 'Requests by priority class and admission result',
+           [([('priority', priority), ('result', result)], c[key])
+            for priority, c in classes.items()
+            for result, key in (('admitted', 'admitted'), ('queued', 'queued'), ('rejected', 'rejected'),
+                                ('timeout', 'timeouts'), ('guaranteed', 'guaranteed'))])
+    yield ('lmstudio_admission_wait_seconds_avg', 'gauge', 'Average wait for an upstream slot',
+           [([('priority', priority)], c['avg_wait_seconds']) for priority, c in classes.items()])
+    yield ('lmstudio_admission_wait_seconds_max', 'gauge', 'Longest wait for an upstream slot',
+           [([('priority', priority)], c['max_wait_seconds']) for priority, c in classes.items()])
+    yield ('lmstudio_admission_oldest_wait_seconds', 'gauge', 'Age of the oldest request still waiting (starvation)',
+           [([('priority', priority)], c['oldest_wait_seconds']) for priority, c in classes.items()])
+
+def job_families(jobs):
+    stats = jobs.stats()
+    yield ('lmstudio_jobs', 'gauge', 'Background jobs by status',
+           [([('status', status)], count) for status, count in stats['jobs'].items()])
+    yield ('lmstudio_jobs_total', 'counter', 'Background job outcomes since start',
+           [([('result', result)], stats[result])
+            for result in ('submitted', 'succeeded', 'failed', 'cancelled', 'retried', 'deferred', 'recovered')])
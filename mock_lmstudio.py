@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク用の LM Studio（OpenAI 互換 API）の模擬サーバー
+
+GPU のないマシンでも web_app.py の処理能力を測れるように、/v1/models・/v1/chat/completions・
+/v1/completions を標準ライブラリだけで返す。最初のトークンまでの時間（latency_ms）・生成速度（tokens_per_sec）・
+ストリーミング（SSE）・エラーの注入（error_rate / disconnect_rate）に対応する。
+
+GPU 1枚の LM Studio は同時に1件ずつしか生成しないため、parallel 件（既定 1）を超えるリクエストは
+前の生成が終わるまで待たせる（待ち時間は最初のトークンまでの時間に含まれる）。
+
+単体でも起動できる:  python mock_lmstudio.py --port 1234 --latency-ms 300 --tokens-per-sec 40
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# デフォルト設定
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 1234
+DEFAULT_MODELS = ('mock-model-7b', 'mock-model-13b')
+DEFAULT_LATENCY_MS = 200  # 生成枠を得てから最初のトークンまで（プロンプト処理の時間）
+DEFAULT_TOKENS_PER_SEC = 50.0
+DEFAULT_RESPONSE_TOKENS = 64  # max_tokens の指定がこれより小さければ max_tokens まで
+DEFAULT_PARALLEL = 1  # 同時に生成できる件数（0 は制限なし）
+
+WORDS = ('これは', '模擬', 'サーバー', 'の', '回答', 'です。', 'トークン', 'を', '順に', '返します。')
+
+class MockLMStudio:
+    """LM Studio の模擬サーバー（MockServer をバックグラウンドで動かす）"""
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, models=DEFAULT_MODELS,
+                 latency_ms=DEFAULT_LATENCY_MS, tokens_per_sec=DEFAULT_TOKENS_PER_SEC,
+                 response_tokens=DEFAULT_RESPONSE_TOKENS, parallel=DEFAULT_PARALLEL,
+                 error_rate=0.0, error_status=500, disconnect_rate=0.0, seed=None):
+        self.host = host
+        self.port = port
+        self.models = list(models)
+        self.latency = latency_ms / 1000
+        self.token_interval = 1 / tokens_per_sec if tokens_per_sec > 0 else 0.0
+        self.response_tokens = response_tokens
+        self.parallel = parallel
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        # 生成枠（GPU）。parallel が 0 の場合は待たせない
+        self.slots = threading.Semaphore(parallel) if parallel > 0 else None
+        self.server = None
+        self.thread = None
+
+        self.stats_lock = threading.Lock()
+        self.stats_counter = {
+            "requests": 0, "completions": 0, "streams": 0, "errors": 0, "disconnects": 0,
+            "tokens": 0, "waiting": 0, "max_waiting": 0, "active": 0, "max_active": 0,
+            "queue_wait_total": 0.0, "queue_wait_max": 0.0
+        }
+
+    def start(self):
+        """サーバーをバックグラウンドで起動する（port=0 の場合は空いているポートを使う）"""
+        if self.server is not None:
+            return
+        mock = self
+
+        class Handler(MockHandler):
+            server_mock = mock
+
+        self.server = MockServer((self.host, self.port), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True, name="mock-lmstudio")
+        self.thread.start()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    def stats(self):
+        with self.stats_lock:
+            counter = dict(self.stats_counter)
+        completions = counter['completions']
+        return {
+            "requests": counter['requests'],
+            "completions": completions,
+            "streams": counter['streams'],
+            "errors": counter['errors'],
+            "disconnects": counter['disconnects'],
+            "tokens": counter['tokens'],
+            "waiting": counter['waiting'],
+            "max_waiting": counter['max_waiting'],
+            "max_active": counter['max_active'],
+            # 生成枠を待った時間（GPU の取り合い）
+            "avg_queue_wait_ms": round(counter['queue_wait_total'] / completions * 1000, 2) if completions else 0.0,
+            "max_queue_wait_ms": round(counter['queue_wait_max'] * 1000, 2)
+        }
+
+    def count(self, name, amount=1):
+        with self.stats_lock:
+            self.stats_counter[name] += amount
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self.random_lock:
+            return self.random.random() < rate
+
+    def disconnect_point(self, count):
+        """ストリーミングを途中で切断する場合は何トークン目で切るか（切断しない場合は None）"""
+        if not count or not self.chance(self.disconnect_rate):
+            return None
+        with self.random_lock:
+            return self.random.randrange(count)
+
+    # ---- 生成 ----
+
+    def acquire_slot(self):
+        """生成枠が空くまで待ち、待った秒数を返す"""
+        with self.stats_lock:
+            counter = self.stats_counter
+            counter['waiting'] += 1
+            counter['max_waiting'] = max(counter['max_waiting'], counter['waiting'])
+        started = time.perf_counter()
+        if self.slots is not None:
+            self.slots.acquire()
+        waited = time.perf_counter() - started
+        with self.stats_lock:
+            counter = self.stats_counter
+            counter['waiting'] -= 1
+            counter['active'] += 1
+            counter['max_active'] = max(counter['max_active'], counter['active'])
+            counter['queue_wait_total'] += waited
+            counter['queue_wait_max'] = max(counter['queue_wait_max'], waited)
+        return waited
+
+    def release_slot(self, tokens):
+        with self.stats_lock:
+            self.stats_counter['active'] -= 1
+            self.stats_counter['completions'] += 1
+            self.stats_counter['tokens'] += tokens
+        if self.slots is not None:
+            self.slots.release()
+
+    def token_count(self, payload):
+        max_tokens = payload.get('max_tokens')
+        if isinstance(max_tokens, int) and 0 < max_tokens < self.response_tokens:
+            return max_tokens
+        return self.response_tokens
+
+    def generate(self, count):
+        """生成速度に合わせてトークンを1つずつ返す（最初のトークンの前にプロンプト処理の時間を待つ）"""
+        time.sleep(self.latency)
+        next_at = time.perf_counter()
+        for index in range(count):
+            if self.token_interval:
+                next_at += self.token_interval
+                delay = next_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            yield WORDS[index % len(WORDS)]
+
+def prompt_tokens(payload):
+    """プロンプトのトークン数の目安（4文字で1トークン）"""
+    if 'messages' in payload:
+        text = ''.join(str(message.get('content', '')) for message in payload.get('messages') or [])
+    else:
+        text = str(payload.get('prompt', ''))
+    return max(1, len(text) // 4)
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 既定の 5 では同時に多数の接続が来ると SYN の再送（約1秒）待ちになり、遅延が模擬サーバーのせいで増える
+    request_queue_size = 256
+
+class MockHandler(BaseHTTPRequestHandler):
+    """模擬サーバーのリクエスト処理（server_mock は MockLMStudio.start でサブクラスに設定する）"""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive とチャンク転送
+    server_mock = None
+
+    def log_message(self, format, *args):
+        pass  # 1リクエストごとのログは出さない
+
+    def do_GET(self):
+        mock = self.server_mock
+        if self.path == '/v1/models':
+            self.send_json(200, {"object": "list",
+                                 "data": [{"id": model, "object": "model", "owned_by": "mock"}
+                                          for model in mock.models]})
+        elif self.path == '/mock/stats':
+            self.send_json(200, mock.stats())
+        else:
+            self.send_json(404, {"error": f"Unexpected endpoint: {self.path}"})
+
+    def do_POST(self):
+        mock = self.server_mock
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_json(400, {"error": "Invalid JSON"})
+            return
+        if self.path == '/v1/chat/completions':
+            api_type = 'chat'
+        elif self.path == '/v1/completions':
+            api_type = 'text'
+        else:
+            self.send_json(404, {"error": f"Unexpected endpoint: {self.path}"})
+            return
+
+        mock.count('requests')
+        if mock.chance(mock.error_rate):
+            mock.count('errors')
+            self.send_json(mock.error_status, {"error": f"Injected error ({mock.error_status})"})
+            return
+
+        model = payload.get('model') or mock.models[0]
+        count = mock.token_count(payload)
+        usage = {"prompt_tokens": prompt_tokens(payload), "completion_tokens": count,
+                 "total_tokens": prompt_tokens(payload) + count}
+        mock.acquire_slot()
+        produced = 0
+        try:
+            if payload.get('stream'):
+                mock.count('streams')
+                produced = self.send_stream(mock, api_type, model, count, usage)
+            else:
+                tokens = list(mock.generate(count))
+                produced = len(tokens)
+                self.send_json(200, completion_body(api_type, model, ''.join(tokens), usage))
+        finally:
+            mock.release_slot(produced)
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(f'{len(data):X}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_stream(self, mock, api_type, model, count, usage):
+        """SSE（チャンク転送）でトークンを1つずつ送り、送ったトークン数を返す"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        completion_id = f'mock-{uuid.uuid4().hex[:12]}'
+        cut_at = mock.disconnect_point(count)
+        produced = 0
+        try:
+            for token in mock.generate(count):
+                if produced == cut_at:
+                    mock.count('disconnects')
+                    self.close_connection = True
+                    return produced
+                self.send_event(stream_chunk(completion_id, api_type, model, token))
+                produced += 1
+            self.send_event(stream_chunk(completion_id, api_type, model, None, usage))
+            self.send_chunk(b'data: [DONE]\n\n')
+            self.send_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # クライアント（web_app）が切断した
+        return produced
+
+    def send_event(self, chunk):
+        self.send_chunk(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+
+def completion_body(api_type, model, text, usage):
+    choice = ({"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+              if api_type == 'chat' else {"index": 0, "text": text, "finish_reason": "stop"})
+    return {
+        "id": f'mock-{uuid.uuid4().hex[:12]}',
+        "object": "chat.completion" if api_type == 'chat' else "text_completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [choice],
+        "usage": usage
+    }
+
+def stream_chunk(completion_id, api_type, model, token, usage=None):
+    """ストリーミングの1チャンク（token が None なら終了のチャンク。usage は最後のチャンクにだけ付ける）"""
+    finish_reason = None if token is not None else "stop"
+    if api_type == 'chat':
+        choice = {"index": 0, "delta": {"content": token} if token is not None else {},
+                  "finish_reason": finish_reason}
+    else:
+        choice = {"index": 0, "text": token or "", "finish_reason": finish_reason}
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk" if api_type == 'chat' else "text_completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [choice]
+    }
+    if usage is not None:
+        chunk["usage"] = usage
+    return chunk
+
+def add_mock_arguments(parser):
+    """模擬サーバーの設定のコマンドライン引数（benchmark.py と共通）"""
+    parser.add_argument('--latency-ms', type=float, default=DEFAULT_LATENCY_MS,
+                        help="生成枠を得てから最初のトークンまでの時間")
+    parser.add_argument('--tokens-per-sec', type=float, default=DEFAULT_TOKENS_PER_SEC,
+                        help="生成速度（0 は待たずに返す）")
+    parser.add_argument('--response-tokens', type=int, default=DEFAULT_RESPONSE_TOKENS,
+                        help="回答のトークン数（max_tokens の方が小さければ max_tokens）")
+    parser.add_argument('--parallel', type=int, default=DEFAULT_PARALLEL,
+                        help="同時に生成できる件数（1 は GPU 1枚の LM Studio と同じ。0 は制限なし）")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="エラー応答を返す割合")
+    parser.add_argument('--error-status', type=int, default=500, help="エラー応答のステータスコード")
+    parser.add_argument('--disconnect-rate', type=float, default=0.0, help="ストリーミングを途中で切断する割合")
+    parser.add_argument('--models', default=','.join(DEFAULT_MODELS), help="/v1/models に返すモデルID（カンマ区切り）")
+    parser.add_argument('--seed', type=int, default=None, help="エラー注入の乱数の種")
+
+def mock_from_args(args, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    return MockLMStudio(
+        host=host, port=port,
+        models=[model.strip() for model in args.models.split(',') if model.strip()],
+        latency_ms=args.latency_ms, tokens_per_sec=args.tokens_per_sec,
+        response_tokens=args.response_tokens, parallel=args.parallel,
+        error_rate=args.error_rate, error_status=args.error_status,
+        disconnect_rate=args.disconnect_rate, seed=args.seed
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="ベンチマーク用の LM Studio 模擬サーバー")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    mock = mock_from_args(args, args.host, args.port)
+    mock.start()
+    print(f"🧪 LM Studio 模擬サーバー: {mock.url} (最初のトークンまで {args.latency_ms:.0f}ms, "
+          f"{args.tokens_per_sec:g} tokens/s, 同時生成 {args.parallel or '制限なし'})")
+    print("終了するには Ctrl+C を押してください")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        mock.stop()
+        print(f"📊 {mock.stats()}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+モデル一覧のキャッシュ（stale-while-revalidate）
+
+LM Studio が生成中だと /v1/models の応答にも時間がかかるため、最後に取得できたモデル一覧を
+メモリと model_catalog.json に保持し、一覧の要求には常にそれを即座に返す。
+一覧が古くなっていれば（max_age 秒以上経過）バックグラウンドで取得し直し、
+取得に失敗した場合は前回の一覧をそのまま使い続ける。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+
+# デフォルト設定
+DEFAULT_CATALOG_PATH = 'model_catalog.json'
+DEFAULT_MAX_AGE = 30             # これより古い一覧は、返した後にバックグラウンドで更新する
+DEFAULT_REFRESH_INTERVAL = 60    # バックグラウンドでの定期更新の間隔（秒）
+
+def catalog_etag(catalog):
+    """モデル一覧の内容から ETag を作成する"""
+    body = json.dumps(catalog, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]
+
+def model_ids(catalog):
+    """/v1/models 形式の一覧からモデルIDのリストを取り出す"""
+    return [model['id'] for model in (catalog or {}).get('data', [])]
+
+class ModelCatalog:
+    """最後に取得できたモデル一覧を保持し、古くなったらバックグラウンドで更新する"""
+
+    def __init__(self, fetch, path=DEFAULT_CATALOG_PATH, max_age=DEFAULT_MAX_AGE,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.fetch = fetch  # /v1/models 形式の dict を返す関数（失敗時は例外）
+        self.path = path
+        self.max_age = max_age
+        self.refresh_interval = refresh_interval
+
+        self.lock = threading.Lock()
+        self.catalog = None
+        self.etag = None
+        self.fetched_at = None
+        self.last_error = None
+        self.refreshing = None  # 更新中は完了を通知する threading.Event
+        self.running = False
+
+        self.load()
+
+    # ---- 永続化 ----
+
+    def load(self):
+        """前回保存した一覧を読み込む（なければ何もしない）"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            with self.lock:
+                self.catalog = saved['catalog']
+                self.fetched_at = saved.get('fetched_at')
+                self.etag = catalog_etag(self.catalog)
+            return True
+        except Exception as e:
+            print(f"❌ モデル一覧キャッシュの読み込みエラー: {e}")
+            return False
+
+    def save(self):
+        """現在の一覧をファイルに保存する"""
+        with self.lock:
+            saved = {"fetched_at": self.fetched_at, "catalog": self.catalog}
+        # 書きかけのファイルを読まないよう、一時ファイルに書いてから置き換える（Web版とGUI版で共有）
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(saved, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    # ---- 参照 ----
+
+    def age(self):
+        """一覧を取得してからの経過秒数（未取得の場合は None）"""
+        with self.lock:
+            return None if self.fetched_at is None else max(0.0, time.time() - self.fetched_at)
+
+    def is_stale(self):
+        age = self.age()
+        return age is None or age >= self.max_age
+
+    def get(self, revalidate=True):
+        """現在の一覧と ETag を即座に返す。古ければバックグラウンドで更新を開始する"""
+        if revalidate and self.is_stale():
+            self.refresh_async()
+        with self.lock:
+            return self.catalog, self.etag
+
+    def status(self):
+        """キャッシュの状態を返す"""
+        age = self.age()
+        with self.lock:
+            return {
+                "models": len(model_ids(self.catalog)) if self.catalog is not None else None,
+                "etag": self.etag,
+                "fetched_at": self.fetched_at,
+                "age_seconds": round(age, 1) if age is not None else None,
+                "stale": age is None or age >= self.max_age,
+                "refreshing": self.refreshing is not None,
+                "last_error": self.last_error
+            }
+
+    # ---- 更新 ----
+
+    def refresh(self):
+        """一覧を取得し直す。失敗した場合は前回の一覧を残して False を返す"""
+        try:
+            catalog = self.fetch()
+        except Exception as e:
+            with self.lock:
+                self.last_error = str(e)
+            return False
+
+        etag = catalog_etag(catalog)
+        with self.lock:
+            self.catalog = catalog
+            self.etag = etag
+            self.fetched_at = time.time()
+            self.last_error = None
+        try:
+            self.save()
+        except Exception as e:
+            print(f"❌ モデル一覧キャッシュの保存エラー: {e}")
+        return True
+
+    def refresh_async(self):
+        """バックグラウンドで一覧を更新する（更新中なら新たに開始しない）。完了を通知する Event を返す"""
+        with self.lock:
+            if self.refreshing is not None:
+                return self.refreshing
+            done = self.refreshing = threading.Event()
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                with self.lock:
+                    self.refreshing = None
+                done.set()
+
+        threading.Thread(target=run, daemon=True, name="model-catalog-refresh").start()
+        return done
+
+    def start(self):
+        """定期的にバックグラウンドで一覧を更新するスレッドを開始する"""
+        if self.running:
+            return
+        self.running = True
+
+        def refresh_loop():
+            while self.running:
+                self.refresh_async().wait()
+                time.sleep(self.refresh_interval)
+
+        threading.Thread(target=refresh_loop, daemon=True, name="model-catalog-loop").start()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+リクエストごとの所要時間の内訳（Server-Timing）とリクエストID
+
+/api/* の応答には X-Request-ID と Server-Timing ヘッダーを付ける。Server-Timing は
+送信の順番待ち（admission-queue）・上流への接続（upstream-connect）・上流の最初のバイトまで（upstream-ttfb）・上流の本文の受信（upstream-body）・
+履歴のキューへの追加（history-enqueue）・それ以外の自分の処理（local）・合計（total）に分ける。
+ストリーミングの応答はヘッダーを送る時点までの内訳になるため、最後までの内訳はトレースログに記録する。
+
+トレースログ（コンソールと log_file）には、sample_rate の割合で抽出したリクエストと、
+slow_ms 以上かかったリクエストを記録する。抽出したリクエストは履歴の書き込み（history_writer）でも
+同じIDを記録し、ブラウザ（script.js）は X-Trace-Sampled が付いた応答と遅かった応答を同じIDでコンソールに出す。
+
+設定は ipconfig.ini の [TRACE] セクション。
+"""
+
+import configparser
+import contextvars
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+# デフォルト設定
+DEFAULT_SAMPLE_RATE = 0.01
+DEFAULT_SLOW_MS = 5000
+DEFAULT_LOG_FILE = 'request_trace.log'
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+SAMPLED_HEADER = 'X-Trace-Sampled'
+REQUEST_ID_RE = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+# Server-Timing に出す順（local は合計から他の区間を引いた残り）
+SPANS = ('admission-queue', 'upstream-connect', 'upstream-ttfb', 'upstream-body', 'history-enqueue')
+
+# 処理中のリクエストのトレース（スレッド・asyncio のタスクごと）
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+def current():
+    """処理中のリクエストのトレース（リクエストの外では None）"""
+    return current_trace.get()
+
+def record(name, seconds):
+    """処理中のリクエストに区間の時間を加える（リクエストの外では何もしない）"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+@contextmanager
+def span(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+def load_tracer(config_file='ipconfig.ini'):
+    """ipconfig.ini の [TRACE] セクションからトレースの設定を読み込む"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file, encoding='utf-8')
+    except Exception as e:
+        print(f"❌ トレース設定の読み込みエラー: {e}")
+    section = 'TRACE'
+    return Tracer(
+        sample_rate=config.getfloat(section, 'sample_rate', fallback=DEFAULT_SAMPLE_RATE),
+        slow_ms=config.getfloat(section, 'slow_ms', fallback=DEFAULT_SLOW_MS),
+        log_file=config.get(section, 'log_file', fallback=DEFAULT_LOG_FILE)
+    )
+
+class RequestTrace:
+    """1件のリクエストの区間ごとの時間"""
+
+    __slots__ = ('id', 'sampled', 'started', 'spans', 'deferred', 'finished')
+
+    def __init__(self, request_id, sampled):
+        self.id = request_id
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.deferred = False  # ストリーミング中（応答の送信後に finish する）
+        self.finished = False
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def breakdown(self, total=None):
+        """区間ごとのミリ秒（local は合計から他の区間を引いた残り）"""
+        total = time.perf_counter() - self.started if total is None else total
+        timings = {name: self.spans[name] * 1000 for name in SPANS if name in self.spans}
+        timings['local'] = max(0.0, total * 1000 - sum(timings.values()))
+        timings['total'] = total * 1000
+        return timings
+
+    def server_timing(self):
+        return ', '.join(f'{name};dur={ms:.1f}' for name, ms in self.breakdown().items())
+
+class Tracer:
+    """リクエストIDの発行と、抽出・遅いリクエストのトレースログ"""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, slow_ms=DEFAULT_SLOW_MS, log_file=DEFAULT_LOG_FILE):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.log_file = log_file
+        self.log_lock = threading.Lock()
+
+    def begin(self, request_id=None):
+        """リクエストの計測を始める（クライアントが送った X-Request-ID があればそれを使う）"""
+        if not request_id or not REQUEST_ID_RE.match(request_id):
+            request_id = uuid.uuid4().hex[:16]
+        trace = RequestTrace(request_id, random.random() < self.sample_rate)
+        current_trace.set(trace)
+        return trace
+
+    def apply_headers(self, trace, headers):
+        headers[REQUEST_ID_HEADER] = trace.id
+        headers['Server-Timing'] = trace.server_timing()
+        if trace.sampled:
+            headers[SAMPLED_HEADER] = '1'
+
+    def finish(self, trace, method, path, status):
+        """リクエストの完了を記録する（抽出したものと遅かったものだけをログに出す）"""
+        if trace.finished:
+            return
+        trace.finished = True
+        timings = trace.breakdown()
+        slow = timings['total'] >= self.slow_ms
+        if not (trace.sampled or slow):
+            return
+        spans = ' '.join(f'{name}={ms:.1f}ms' for name, ms in timings.items() if name != 'total')
+        print(f"🧭 {'🐢 遅いリクエスト' if slow else 'トレース'} [{trace.id}] {method} {path} {status} "
+              f"{timings['total']:.1f}ms ({spans})")
+        self.write({"event": "request", "id": trace.id, "method": method, "path": path, "status": status,
+                    "slow": slow, "ms": {name: round(ms, 2) for name, ms in timings.items()}})
+
+    def log_history_batch(self, batch):
+        """HistoryWriter の on_batch から呼ぶ（抽出したリクエストの履歴の保存を同じIDで記録する）"""
+        now = time.perf_counter()
+        for item in batch:
+            if item.trace_id is None:
+                continue
+            wait_ms = (now - item.submitted) * 1000
+            print(f"🧭 トレース [{item.trace_id}] 履歴保存 ID:{item.id} ({wait_ms:.1f}ms)")
+            self.write({"event": "history-write", "id": item.trace_id, "history_id": item.id,
+                        "error": item.error, "ms": round(wait_ms, 2)})
+
+    def write(self, entry):
+        if not self.log_file:
+            return
+        entry = dict(entry, time=datetime.now().isoformat(timespec='milliseconds'))
+        line = json.dumps(entry, ensure_ascii=False) + '\n'
+        try:
+            with self.log_lock:
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.write(line)
+        except OSError as e:
+            print(f"❌ トレースログの書き込みエラー: {e}")
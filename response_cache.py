@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+決定的なプロンプト向けの完全一致レスポンスキャッシュ
+
+(エンドポイント, モデル, 正規化したプロンプト/メッセージ, temperature, max_tokens) をキーに
+LM Studio の応答を SQLite（prompt_history.db と同じ場所の response_cache.db）へ保存する。
+よく使われるエントリはメモリ上のホット層（LRU）から返すため、ヒット時はミリ秒で応答できる。
+ヒット時の最終アクセス時刻とヒット数はメモリに溜め、保存・削除・終了時（または ACCESS_FLUSH_BATCH 件ごと）に
+まとめて書き込むため、読み取りのたびに SQLite へ書き込まない。
+エントリ数・合計サイズの上限を超えた場合は最終アクセスの古いものから削除し、TTLを過ぎたものは無効とする。
+"""
+
+import configparser
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# デフォルト設定
+DEFAULT_DB_PATH = 'response_cache.db'
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_HOT_SIZE = 256
+
+# ヒットの記録（最終アクセス時刻・ヒット数）をまとめて書き込む件数
+ACCESS_FLUSH_BATCH = 1000
+
+def normalize_text(text):
+    """キャッシュキー用にテキストを正規化する（Unicode NFC、改行統一、行末・前後の空白除去）"""
+    text = unicodedata.normalize('NFC', text or '')
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return '\n'.join(line.rstrip() for line in text.split('\n')).strip()
+
+def make_cache_key(endpoint, model, prompt_or_messages, temperature, max_tokens):
+    """リクエスト内容からキャッシュキー（SHA-256）を作成する"""
+    if isinstance(prompt_or_messages, list):
+        normalized = [
+            {"role": message.get('role'), "content": normalize_text(message.get('content'))}
+            for message in prompt_or_messages
+        ]
+    else:
+        normalized = normalize_text(prompt_or_messages)
+    key_source = json.dumps(
+        [endpoint, model or 'default', normalized, float(temperature), int(max_tokens)],
+        ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+def is_cacheable(temperature, opt_in=None):
+    """キャッシュを使うか判定する（temperature 0 のみ。クライアントは cache: true/false で上書き可能）"""
+    if opt_in is not None:
+        return bool(opt_in)
+    try:
+        return float(temperature) == 0.0
+    except (TypeError, ValueError):
+        return False
+
+def build_completion_result(api_type, response_text, model=None):
+    """ストリーミングで組み立てたテキストから、非ストリーミング応答と同じ形式の結果を作る"""
+    if api_type == 'chat':
+        choice = {"index": 0, "message": {"role": "assistant", "content": response_text}, "finish_reason": "stop"}
+        result = {"object": "chat.completion", "choices": [choice]}
+    else:
+        choice = {"index": 0, "text": response_text, "finish_reason": "stop"}
+        result = {"object": "text_completion", "choices": [choice]}
+    if model and model != 'default':
+        result["model"] = model
+    return result
+
+def build_stream_chunk(api_type, response_text):
+    """テキスト全体を1つのストリーミングチャンク（SSEのdata部分）に変換する"""
+    if api_type == 'chat':
+        choice = {"index": 0, "delta": {"content": response_text}, "finish_reason": "stop"}
+    else:
+        choice = {"index": 0, "text": response_text, "finish_reason": "stop"}
+    return {"choices": [choice], "cached": True}
+
+def load_response_cache(config_file='ipconfig.ini'):
+    """ipconfig.ini の [RESPONSE_CACHE] セクションからキャッシュを作成する（無効時は None）"""
+    config = configparser.ConfigParser()
+    try:
+        config.read(config_file, encoding='utf-8')
+    except Exception as e:
+        print(f"❌ キャッシュ設定の読み込みエラー: {e}")
+    section = 'RESPONSE_CACHE'
+    if not config.getboolean(section, 'enabled', fallback=True):
+        print("⚠️ レスポンスキャッシュは無効です")
+        return None
+    cache = ResponseCache(
+        db_path=config.get(section, 'db_path', fallback=DEFAULT_DB_PATH),
+        max_entries=config.getint(section, 'max_entries', fallback=DEFAULT_MAX_ENTRIES),
+        max_bytes=int(config.getfloat(section, 'max_mb', fallback=DEFAULT_MAX_BYTES / 1024 / 1024) * 1024 * 1024),
+        ttl_seconds=config.getfloat(section, 'ttl_hours', fallback=DEFAULT_TTL_SECONDS / 3600) * 3600,
+        hot_size=config.getint(section, 'hot_size', fallback=DEFAULT_HOT_SIZE)
+    )
+    print(f"⚡ レスポンスキャッシュ: {cache.entry_count}件 ({cache.total_bytes / 1024 / 1024:.1f}MB)")
+    return cache
+
+class ResponseCache:
+    """SQLite 永続層＋メモリのホット層からなるレスポンスキャッシュ"""
+
+    def __init__(self, db_path=DEFAULT_DB_PATH, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 hot_size=DEFAULT_HOT_SIZE):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hot_size = hot_size
+
+        self.lock = threading.Lock()
+        self.hot = OrderedDict()  # key -> entry（末尾が最近使われたもの）
+        self.accessed = {}  # key -> [最終アクセス時刻, まだ書き込んでいないヒット数]
+        self.stats_counter = {"hits": 0, "hot_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            endpoint TEXT NOT NULL,
+            model TEXT,
+            result TEXT NOT NULL,
+            response_text TEXT,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_access REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_last_access ON response_cache (last_access)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache (expires_at)')
+        self.conn.commit()
+
+        # 件数と合計サイズはメモリで管理し、書き込みのたびに集計しない
+        self.entry_count, self.total_bytes = self.conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM response_cache'
+        ).fetchone()
+        self.evict()
+
+    def get(self, key):
+        """キャッシュを検索する。見つからない・期限切れの場合は None"""
+        now = time.time()
+        with self.lock:
+            entry = self.hot.get(key)
+            if entry is not None and entry['expires_at'] > now:
+                self.hot.move_to_end(key)
+                self.stats_counter['hits'] += 1
+                self.stats_counter['hot_hits'] += 1
+                self._record_access(key, now)
+                return entry
+
+            row = self.conn.execute(
+                'SELECT result, response_text, expires_at FROM response_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or row[2] <= now:
+                if row is not None:
+                    self._delete(key)
+                    self.conn.commit()
+                self.hot.pop(key, None)
+                self.stats_counter['misses'] += 1
+                return None
+
+            entry = {"result": json.loads(row[0]), "response_text": row[1], "expires_at": row[2]}
+            self._record_access(key, now)
+            self._remember(key, entry)
+            self.stats_counter['hits'] += 1
+            return entry
+
+    def put(self, key, endpoint, model, result, response_text, ttl_seconds=None):
+        """応答をキャッシュに保存する"""
+        now = time.time()
+        expires_at = now + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        result_json = json.dumps(result, ensure_ascii=False)
+        size = len(result_json.encode('utf-8')) + len((response_text or '').encode('utf-8'))
+
+        with self.lock:
+            previous = self.conn.execute('SELECT size FROM response_cache WHERE key = ?', (key,)).fetchone()
+            if previous is not None:
+                self.entry_count -= 1
+                self.total_bytes -= previous[0]
+            self.conn.execute(
+                'INSERT OR REPLACE INTO response_cache '
+                '(key, endpoint, model, result, response_text, size, created_at, last_access, expires_at, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)',
+                (key, endpoint, model, result_json, response_text, size, now, now, expires_at)
+            )
+            self.entry_count += 1
+            self.total_bytes += size
+            self.stats_counter['stores'] += 1
+            self._remember(key, {"result": result, "response_text": response_text, "expires_at": expires_at})
+            self._evict_locked(now)
+            self.conn.commit()
+
+    def flush_access(self):
+        """メモリに溜めたヒットの記録を書き込む"""
+        with self.lock:
+            if self.accessed:
+                self._flush_access_locked()
+                self.conn.commit()
+
+    def evict(self):
+        """期限切れのエントリと上限超過分を削除する"""
+        with self.lock:
+            self._evict_locked(time.time())
+            self.conn.commit()
+
+    def clear(self):
+        """キャッシュをすべて削除する"""
+        with self.lock:
+            self.conn.execute('DELETE FROM response_cache')
+            self.conn.commit()
+            self.hot.clear()
+            self.accessed.clear()
+            self.entry_count = 0
+            self.total_bytes = 0
+
+    def stats(self):
+        """ヒット率などの統計情報を返す"""
+        with self.lock:
+            lookups = self.stats_counter['hits'] + self.stats_counter['misses']
+            return dict(
+                self.stats_counter,
+                entries=self.entry_count,
+                bytes=self.total_bytes,
+                hot_entries=len(self.hot),
+                pending_access=len(self.accessed),
+                hit_ratio=(self.stats_counter['hits'] / lookups) if lookups else 0.0
+            )
+
+    def close(self):
+        with self.lock:
+            if self.accessed:
+                self._flush_access_locked()
+                self.conn.commit()
+            self.conn.close()
+
+    def _record_access(self, key, now):
+        """ヒットをメモリに記録する（ACCESS_FLUSH_BATCH 件溜まったらまとめて書き込む）"""
+        access = self.accessed.get(key)
+        if access is None:
+            self.accessed[key] = [now, 1]
+        else:
+            access[0] = now
+            access[1] += 1
+        if len(self.accessed) >= ACCESS_FLUSH_BATCH:
+            self._flush_access_locked()
+            self.conn.commit()
+
+    def _flush_access_locked(self):
+        # 呼び出し側でコミットする
+        self.conn.executemany(
+            'UPDATE response_cache SET last_access = MAX(last_access, ?), hits = hits + ? WHERE key = ?',
+            [(last_access, hits, key) for key, (last_access, hits) in self.accessed.items()]
+        )
+        self.accessed.clear()
+
+    def _remember(self, key, entry):
+        """ホット層に追加し、上限を超えたら最も古いものを落とす"""
+        self.hot[key] = entry
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+    def _delete(self, key):
+        row = self.conn.execute('SELECT size FROM response_cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+            self.accessed.pop(key, None)
+            self.entry_count -= 1
+            self.total_bytes -= row[0]
+            self.stats_counter['evictions'] += 1
+
+    def _evict_locked(self, now):
+        # LRU の順序に最近のヒットを反映してから削除する
+        if self.accessed:
+            self._flush_access_locked()
+
+        # 期限切れを削除
+        expired = self.conn.execute(
+            'SELECT key FROM response_cache WHERE expires_at <= ?', (now,)
+        ).fetchall()
+        for (key,) in expired:
+            self._delete(key)
+            self.hot.pop(key, None)
+
+        # 件数・サイズの上限を超えていれば、最終アクセスの古い順に削除（LRU）
+        while self.entry_count > self.max_entries or self.total_bytes > self.max_bytes:
+            # サイズ超過のみの場合は少しずつまとめて削除する
+            excess = self.entry_count - self.max_entries if self.entry_count > self.max_entries else 50
+            victims = self.conn.execute(
+                'SELECT key FROM response_cache ORDER BY last_access ASC LIMIT ?', (min(excess, 500),)
+            ).fetchall()
+            if not victims:
+                break
+            for (key,) in victims:
+                self._delete(key)
+                self.hot.pop(key, None)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+プロンプト履歴の近似重複検出（MinHash / LSH）
+
+空白・句読点の違いや末尾の一文だけが異なるプロンプトを見つけるため、
+prompt_history.prompt の文字3-gramから MinHash 署名を作り、バンド分割した LSH バケットを
+prompt_history.db 内のテーブルに保存する。
+
+- prompt_minhash: 履歴IDごとの MinHash 署名（32bit × NUM_PERM）
+- prompt_lsh: (バケット, 履歴ID) の組。検索時は NUM_BANDS 個のバケットを引くだけで候補が得られる
+
+履歴を削除するとトリガーで署名とバケットも削除するため、検索（find_similar）は読み取りだけで済む。
+
+索引はディスク上にあるため、起動時は未登録の新しい行だけを追加すればよく、全件の再計算は不要。
+"""
+
+import functools
+import hashlib
+import random
+import struct
+import threading
+import unicodedata
+
+import history_db
+
+# MinHash のパラメータ（8バンド × 4行 → 類似度およそ0.6以上が候補に入る）
+NUM_PERM = 32
+NUM_BANDS = 8
+ROWS_PER_BAND = NUM_PERM // NUM_BANDS
+
+# ハッシュ関数 h(x) = (a*x + b) mod p の係数（署名を永続化するため固定シードで生成）
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+_rng = random.Random(20250601)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                 for _ in range(NUM_PERM)]
+
+# 起動時の索引追加で1回に処理する行数
+CATCH_UP_BATCH_SIZE = 1000
+
+# 1回の検索で類似度を計算する候補の上限（同じ定型文が大量にある場合は新しいものを優先）
+MAX_CANDIDATES = 2000
+
+# 最近計算した署名を保持する件数（reuse_similar の検索で計算した署名を、同じプロンプトの履歴を
+# 索引に追加するときにも使う。長いプロンプトでは署名の計算が検索全体の大半を占めるため）
+SIGNATURE_CACHE_SIZE = 256
+
+_SIGNATURE_FORMAT = f'<{NUM_PERM}I'
+
+def normalize_for_shingles(text):
+    """空白・句読点・記号を除き、全角半角と大文字小文字を揃える"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    return ''.join(ch for ch in text if unicodedata.category(ch)[0] not in ('P', 'Z', 'S', 'C'))
+
+def shingles(text, size=3):
+    """文字 n-gram の集合を返す（日本語でも分かち書き不要）"""
+    normalized = normalize_for_shingles(text)
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+@functools.lru_cache(maxsize=SIGNATURE_CACHE_SIZE)
+def minhash_signature(text):
+    """テキストの MinHash 署名（NUM_PERM 個の32bit整数のタプル）を返す
+
+    計算量は 文字数 × NUM_PERM に比例する（数千文字のプロンプトでは数ミリ秒以上かかる）。
+    """
+    values = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little')
+              for s in shingles(text)]
+    if not values:
+        return tuple([_MAX_HASH] * NUM_PERM)
+    return tuple(
+        min((a * x + b) % _MERSENNE_PRIME for x in values) & _MAX_HASH
+        for a, b in _PERMUTATIONS
+    )
+
+def band_buckets(signature):
+    """署名をバンドに分け、各バンドのバケットID（符号付き64bit）を返す"""
+    buckets = []
+    for band in range(NUM_BANDS):
+        part = signature[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        digest = hashlib.blake2b(struct.pack(f'<I{ROWS_PER_BAND}I', band, *part), digest_size=8).digest()
+        buckets.append(int.from_bytes(digest, 'little', signed=True))
+    return buckets
+
+def estimate_similarity(signature_a, signature_b):
+    """2つの署名から Jaccard 類似度を推定する"""
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / NUM_PERM
+
+def pack_signature(signature):
+    return struct.pack(_SIGNATURE_FORMAT, *signature)
+
+def unpack_signature(blob):
+    return struct.unpack(_SIGNATURE_FORMAT, blob)
+
+# 索引への書き込みSQL（同期・非同期のどちらの接続からも使う）
+INSERT_SIGNATURE_SQL = 'INSERT OR REPLACE INTO prompt_minhash (id, signature) VALUES (?, ?)'
+INSERT_BUCKET_SQL = 'INSERT OR IGNORE INTO prompt_lsh (bucket, id) VALUES (?, ?)'
+UPDATE_WATERMARK_SQL = "UPDATE prompt_index_state SET last_id = MAX(last_id, ?) WHERE name = 'minhash'"
+
+# 起動時の索引追加が完了したか（完了後は新しい行を追加するたびに索引済みIDを進める）
+catch_up_done = threading.Event()
+
+# 索引テーブルとトリガーの作成SQL
+SCHEMA_STATEMENTS = [
+    '''
+    CREATE TABLE IF NOT EXISTS prompt_minhash (
+        id INTEGER PRIMARY KEY,
+        signature BLOB NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS prompt_lsh (
+        bucket INTEGER NOT NULL,
+        id INTEGER NOT NULL,
+        PRIMARY KEY (bucket, id)
+    ) WITHOUT ROWID
+    ''',
+    # どの履歴IDまで索引済みか（起動時はこれより新しい行だけを処理する）
+    '''
+    CREATE TABLE IF NOT EXISTS prompt_index_state (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    )
+    ''',
+    "INSERT OR IGNORE INTO prompt_index_state (name, last_id) VALUES ('minhash', 0)",
+    # 以前のバージョンが残した LSHバケットの残骸を掃除したか（1 で掃除済み）
+    "INSERT OR IGNORE INTO prompt_index_state (name, last_id) VALUES ('lsh_cleanup', 0)",
+    'CREATE INDEX IF NOT EXISTS idx_prompt_lsh_id ON prompt_lsh (id)',
+    # 履歴を削除したら署名と LSHバケットも削除
+    '''
+    CREATE TRIGGER IF NOT EXISTS prompt_minhash_delete AFTER DELETE ON prompt_history
+    BEGIN
+        DELETE FROM prompt_minhash WHERE id = old.id;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS prompt_lsh_delete AFTER DELETE ON prompt_history
+    BEGIN
+        DELETE FROM prompt_lsh WHERE id = old.id;
+    END
+    ''',
+]
+
+def init_similarity_tables(conn):
+    """索引テーブルとトリガーを作成する"""
+    for sql in SCHEMA_STATEMENTS:
+        conn.execute(sql)
+
+def index_params(history_id, prompt):
+    """索引に追加するためのパラメーター（署名の行, バケットの行リスト）を作成する"""
+    signature = minhash_signature(prompt)
+    return (history_id, pack_signature(signature)), [(bucket, history_id) for bucket in band_buckets(signature)]
+
+def add_to_index(conn, history_id, prompt):
+    """1件の履歴を索引に追加する（呼び出し側のトランザクション内で実行）"""
+    signature_row, bucket_rows = index_params(history_id, prompt)
+    conn.execute(INSERT_SIGNATURE_SQL, signature_row)
+    conn.executemany(INSERT_BUCKET_SQL, bucket_rows)
+    if catch_up_done.is_set():
+        conn.execute(UPDATE_WATERMARK_SQL, (history_id,))
+
+def remove_stale_buckets(conn):
+    """削除済みの履歴を指す LSHバケットを一度だけ削除する（トリガーで削除する前のバージョンが残したもの）"""
+    done = conn.execute("SELECT last_id FROM prompt_index_state WHERE name = 'lsh_cleanup'").fetchone()[0]
+    if done:
+        return 0
+    removed = conn.execute('DELETE FROM prompt_lsh WHERE id NOT IN (SELECT id FROM prompt_minhash)').rowcount
+    conn.execute("UPDATE prompt_index_state SET last_id = 1 WHERE name = 'lsh_cleanup'")
+    conn.commit()
+    if removed:
+        print(f"🔎 類似プロンプト索引から削除済みの履歴のバケットを{removed}件削除しました")
+    return removed
+
+def catch_up(db_path, batch_size=CATCH_UP_BATCH_SIZE):
+    """まだ索引に入っていない履歴（最後に索引した ID より新しい行）だけを追加する"""
+    conn = history_db.connect(db_path)
+    try:
+        init_similarity_tables(conn)
+        conn.commit()
+        remove_stale_buckets(conn)
+        last_id = conn.execute("SELECT last_id FROM prompt_index_state WHERE name = 'minhash'").fetchone()[0]
+        total = 0
+        while True:
+            rows = conn.execute(
+                'SELECT id, prompt FROM history_entries WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            for history_id, prompt in rows:
+                add_to_index(conn, history_id, prompt)
+            last_id = rows[-1][0]
+            conn.execute(UPDATE_WATERMARK_SQL, (last_id,))
+            conn.commit()
+            total += len(rows)
+        catch_up_done.set()
+        if total:
+            print(f"🔎 類似プロンプト索引に{total}件を追加しました")
+        return total
+    finally:
+        conn.close()
+
+def start_catch_up(db_path):
+    """起動時の索引追加をバックグラウンドで実行する"""
+    def run():
+        try:
+            catch_up(db_path)
+        except Exception as e:
+            print(f"❌ 類似プロンプト索引の更新エラー: {e}")
+
+    thread = threading.Thread(target=run, daemon=True, name="similarity-catch-up")
+    thread.start()
+    return thread
+
+def signature_for_id(conn, history_id):
+    """索引済みの履歴の署名を返す（未登録の場合は None）"""
+    row = conn.execute('SELECT signature FROM prompt_minhash WHERE id = ?', (history_id,)).fetchone()
+    return unpack_signature(row[0]) if row else None
+
+def find_similar(conn, client_ip, prompt=None, signature=None, limit=5, min_similarity=0.5,
+                 api_type=None, exclude_id=None):
+    """類似した過去のプロンプトと回答を類似度の高い順に返す（読み取りのみ）"""
+    if signature is None:
+        signature = minhash_signature(prompt)
+    buckets = band_buckets(signature)
+
+    # 候補の上限は現在のクライアントの履歴に絞ってから適用する（他のクライアントの定型文で候補枠が埋まらないように）。
+    # バケットごとに主キー (bucket, id) を新しい順にたどって MAX_CANDIDATES 件で止め、
+    # 定型文でバケットが大きくなってもバケット全体は読まない
+    bucket_query = ('SELECT id FROM (SELECT l.id FROM prompt_lsh l JOIN prompt_history p ON p.id = l.id '
+                    'WHERE l.bucket = ? AND (p.client_ip = ? OR p.client_ip IS NULL)'
+                    + (' AND p.api_type = ?' if api_type else '') +
+                    ' ORDER BY l.id DESC LIMIT ?)')
+    query = ' UNION '.join([bucket_query] * len(buckets)) + ' ORDER BY id DESC LIMIT ?'
+    params = []
+    for bucket in buckets:
+        params += [bucket, client_ip] + ([api_type] if api_type else []) + [MAX_CANDIDATES]
+    candidate_ids = [row[0] for row in conn.execute(query, params + [MAX_CANDIDATES])]
+    if exclude_id is not None:
+        candidate_ids = [i for i in candidate_ids if i != exclude_id]
+    if not candidate_ids:
+        return []
+
+    # 候補の署名から類似度を推定して絞り込む
+    placeholders = ','.join('?' * len(candidate_ids))
+    signatures = dict(conn.execute(
+        f'SELECT id, signature FROM prompt_minhash WHERE id IN ({placeholders})', candidate_ids
+    ).fetchall())
+
+    scored = []
+    for history_id, blob in signatures.items():
+        similarity = estimate_similarity(signature, unpack_signature(blob))
+        if similarity >= min_similarity:
+            scored.append((similarity, history_id))
+    scored.sort(reverse=True)
+    if not scored:
+        return []
+
+    # 候補はすでにクライアントで絞り込んであるため、本文は返す件数分だけ読む（行の削除と重なった場合に備えて条件も付ける）
+    similarity_by_id = {history_id: similarity for similarity, history_id in scored[:limit]}
+    placeholders = ','.join('?' * len(similarity_by_id))
+    query = (f'SELECT id, prompt, response, api_type, timestamp FROM history_entries '
+             f'WHERE id IN ({placeholders}) AND (client_ip = ? OR client_ip IS NULL)')
+    params = list(similarity_by_id) + [client_ip]
+    if api_type:
+        query += ' AND api_type = ?'
+        params.append(api_type)
+
+    results = []
+    for row in conn.execute(query, params):
+        results.append({
+            "id": row[0],
+            "prompt": row[1],
+            "response": row[2],
+            "api_type": row[3],
+            "timestamp": row[4],
+            "similarity": similarity_by_id[row[0]]
+        })
+    results.sort(key=lambda item: (item['similarity'], item['id']), reverse=True)
+    return results[:limit]
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+同一リクエストの相乗り（single-flight）
+
+共有テンプレートが複数人から同時に送信されると、同じ内容の決定的なリクエスト（temperature 0 など）が
+LM Studio に何本も届き、順番に処理される。ここでは処理中のリクエストをキー（レスポンスキャッシュと同じ
+キー）で管理し、後から来た同一リクエストは先行リクエストの結果を待つ（ストリーミングの場合は受信済みの
+チャンクから順に受け取る）。履歴は参加した各リクエストが自分のプロンプト・IPアドレスで保存する。
+
+- Flight: スレッド版（web_app.py）
+- AsyncFlight: asyncio版（web_app_async.py）
+"""
+
+import asyncio
+import threading
+import time
+
+# 相乗りした参加者が結果（ストリーミングでは次のチャンク）を待つ最長の秒数
+# （上流の読み取りタイムアウト＋受付制御の順番待ちより長くし、取り残された Flight で待ち続けないようにする）
+FOLLOWER_TIMEOUT = 300
+
+class BaseFlight:
+    """処理中の上流リクエスト1件と、その結果を待つ参加者"""
+
+    def __init__(self, key):
+        self.key = key
+        self.created = time.time()
+        self.subscribers = []   # (prompt, client_ip) のリスト。先頭が上流を呼び出したリクエスト
+        self.streaming = False  # 上流をストリーミングで呼び出しているか
+        self.events = []        # 受信済みのSSEチャンク（data部分）
+        self.parts = []         # 受信済みの差分テキスト
+        self.done = False
+        self.result = None
+        self.response_text = ""
+        self.error = None       # エラー時は {"error": ..., "details": ...}
+
+    def _append(self, data, delta):
+        self.events.append(data)
+        if delta:
+            self.parts.append(delta)
+
+    def _finish(self, result, response_text, error):
+        self.result = result
+        self.response_text = response_text if response_text is not None else "".join(self.parts)
+        self.error = error
+        self.done = True
+
+    def partial_text(self):
+        """ここまでに受信したテキスト"""
+        return "".join(self.parts)
+
+class Flight(BaseFlight):
+    """スレッド間で結果を共有する Flight"""
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.cond = threading.Condition()
+
+    def publish(self, data, delta=""):
+        """上流から受信したチャンクを追加し、待っている参加者を起こす"""
+        with self.cond:
+            self._append(data, delta)
+            self.cond.notify_all()
+
+    def finish(self, result=None, response_text=None, error=None):
+        with self.cond:
+            self._finish(result, response_text, error)
+            self.cond.notify_all()
+
+    def wait(self, timeout=FOLLOWER_TIMEOUT):
+        """上流の処理が終わるまで最大 timeout 秒待つ（終わっていれば True）"""
+        with self.cond:
+            return self.cond.wait_for(lambda: self.done, timeout)
+
+    def iter_events(self, timeout=FOLLOWER_TIMEOUT):
+        """受信済みのチャンクを先頭から返し、終了するまで新しいチャンクを待つ
+        （timeout 秒チャンクが届かなければ TimeoutError）"""
+        index = 0
+        while True:
+            with self.cond:
+                if not self.cond.wait_for(lambda: index < len(self.events) or self.done, timeout):
+                    raise TimeoutError("相乗りした上流の応答が届きません")
+                pending = self.events[index:]
+                done = self.done
+            index += len(pending)
+            yield from pending
+            if done:
+                return
+
+class AsyncFlight(BaseFlight):
+    """イベントループ上で結果を共有する Flight（同じイベントループからのみ操作する）"""
+
+    def __init__(self, key):
+        super().__init__(key)
+        self.changed = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.task = None  # 上流を受信するタスク（参照を保持して途中で回収されないようにする）
+
+    def _notify(self):
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, data, delta=""):
+        self._append(data, delta)
+        self._notify()
+
+    def finish(self, result=None, response_text=None, error=None):
+        self._finish(result, response_text, error)
+        self.finished.set()
+        self._notify()
+
+    async def wait(self, timeout=FOLLOWER_TIMEOUT):
+        """上流の処理が終わるまで最大 timeout 秒待つ（終わっていれば True）"""
+        try:
+            await asyncio.wait_for(self.finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    async def iter_events(self, timeout=FOLLOWER_TIMEOUT):
+        """受信済みのチャンクを先頭から返し、終了するまで新しいチャンクを待つ
+        （timeout 秒チャンクが届かなければ asyncio.TimeoutError）"""
+        index = 0
+        while True:
+            while index < len(self.events):
+                yield self.events[index]
+                index += 1
+            if self.done:
+                return
+            await asyncio.wait_for(self.changed.wait(), timeout)
+
+class SingleFlight:
+    """キーごとに処理中の Flight を管理し、相乗りで省略できた上流呼び出しの数を数える"""
+
+    def __init__(self, flight_class=Flight):
+        self.flight_class = flight_class
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats_counter = {"upstream_calls": 0, "coalesced": 0}
+
+    def join(self, key, prompt, client_ip):
+        """処理中の Flight に参加する。なければ新しく作る。(Flight, 上流を呼び出す役か) を返す"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flight_class(key)
+                self.flights[key] = flight
+                self.stats_counter['upstream_calls'] += 1
+            else:
+                self.stats_counter['coalesced'] += 1
+            flight.subscribers.append((prompt, client_ip))
+            return flight, leader
+
+    def complete(self, flight, result=None, response_text=None, error=None):
+        """Flight を締め切って結果を配る。締め切り時点の参加者のリストを返す"""
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            subscribers = list(flight.subscribers)
+        flight.finish(result, response_text, error)
+        return subscribers
+
+    def abandon(self, flight):
+        """結果が届かない Flight を締め切らずに外す（以降の同一リクエストは新しく上流を呼び出す）"""
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+    def stats(self):
+        """相乗りの統計（saved_calls は省略できた上流呼び出しの数）"""
+        now = time.time()
+        with self.lock:
+            total = self.stats_counter['upstream_calls'] + self.stats_counter['coalesced']
+            return dict(
+                self.stats_counter,
+                saved_calls=self.stats_counter['coalesced'],
+                saved_ratio=(self.stats_counter['coalesced'] / total) if total else 0.0,
+                in_flight=[
+                    {
+                        "key": flight.key[:12],
+                        "subscribers": len(flight.subscribers),
+                        "streaming": flight.streaming,
+                        "age_seconds": round(now - flight.created, 1)
+                    }
+                    for flight in self.flights.values()
+                ]
+            )
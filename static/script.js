@@ -14,12 +14,32 @@ const responseOutput = document.getElementById("response-output");
 const statusBar = document.getElementById("status-bar");
 const promptHistoryList = document.getElementById("prompt-history-list");
 const clearHistoryButton = document.getElementById("clear-history-button");
+const historySearchInput = document.getElementById("history-search-input");
 const copyResponseBtn = document.getElementById("copy-response-btn");
 const clientIpDisplay = document.getElementById("client-ip-address");
 
 // 履歴データの構造
 let promptHistory = [];
 
+// 次に読み込むページの before_id（null の場合はこれ以上古い履歴はない）
+let historyNextBeforeId = null;
+let historyPageLoading = false;
+// 読み込みの世代（最初から読み直した後に、古い要求の結果を追加しないため）
+let historyGeneration = 0;
+
+// 一覧の下端からこの距離まで近づいたら次のページを読み込む（px）
+const HISTORY_SCROLL_THRESHOLD = 200;
+
+// 履歴の検索語（空の場合は最新の履歴を表示）
+let historySearchQuery = "";
+let historySearchTimer = null;
+
+// この時間以上かかった応答は抽出の有無にかかわらずコンソールに内訳を出す（ms、[TRACE] slow_ms と同じ）
+const SLOW_REQUEST_MS = 5000;
+
+// 応答が始まるまで、この間隔で順番待ちの状況（/api/queue）を確認する（ms）
+const QUEUE_POLL_INTERVAL_MS = 1000;
+
 // 初期化
 document.addEventListener("DOMContentLoaded", () => {
   // モデル一覧を取得
@@ -41,6 +61,15 @@ document.addEventListener("DOMContentLoaded", () => {
 
   // 履歴関連のイベントリスナーを設定
   clearHistoryButton.addEventListener("click", clearPromptHistory);
+  promptHistoryList.addEventListener("scroll", loadMoreIfNeeded);
+  historySearchInput.addEventListener("input", () => {
+    // 入力が止まってから検索する
+    clearTimeout(historySearchTimer);
+    historySearchTimer = setTimeout(() => {
+      historySearchQuery = historySearchInput.value.trim();
+      loadPromptHistory();
+    }, 250);
+  });
   
   // コピーボタンのイベントリスナーを設定
   copyResponseBtn.addEventListener("click", () => copyToClipboard(responseOutput.textContent, copyResponseBtn));
@@ -70,7 +99,14 @@ function loadClientInfo() {
 
 // 履歴をサーバーから読み込む
 function loadPromptHistory() {
+  if (historySearchQuery) {
+    searchPromptHistory(historySearchQuery);
+    return;
+  }
+
   setStatus("📚 履歴を読み込み中...");
+  const generation = ++historyGeneration;
+  historyNextBeforeId = null;
 
   fetch("/api/prompt-history")
     .then((response) => {
@@ -80,8 +116,11 @@ function loadPromptHistory() {
       return response.json();
     })
     .then((data) => {
+      if (generation !== historyGeneration) return;
       promptHistory = data.history || [];
+      historyNextBeforeId = data.next_before_id;
       renderPromptHistory();
+      loadMoreIfNeeded();
       
       // クライアントIPも更新
       if (data.client_ip) {
@@ -96,6 +135,72 @@ function loadPromptHistory() {
     });
 }
 
+// スクロールが一覧の下端に近づいたら、さらに古い履歴を読み込む
+function loadMoreIfNeeded() {
+  if (historyNextBeforeId === null || historyPageLoading || historySearchQuery) return;
+  const remaining = promptHistoryList.scrollHeight - promptHistoryList.scrollTop - promptHistoryList.clientHeight;
+  if (remaining <= HISTORY_SCROLL_THRESHOLD) {
+    loadMorePromptHistory();
+  }
+}
+
+// 次のページ（before_id より古い履歴）を読み込んで一覧の末尾に追加する
+function loadMorePromptHistory() {
+  const generation = historyGeneration;
+  historyPageLoading = true;
+
+  fetch(`/api/prompt-history?before_id=${historyNextBeforeId}`)
+    .then((response) => {
+      if (!response.ok) {
+        throw new Error(`HTTP error ${response.status}`);
+      }
+      return response.json();
+    })
+    .then((data) => {
+      if (generation !== historyGeneration) return;
+      const page = data.history || [];
+      promptHistory = promptHistory.concat(page);
+      historyNextBeforeId = data.next_before_id;
+      page.forEach(appendHistoryItem);
+      setStatus(`✅ 履歴を読み込みました (${promptHistory.length}件)`);
+    })
+    .catch((error) => {
+      console.error("履歴の読み込みに失敗しました:", error);
+      setStatus(`❌ 履歴の読み込みに失敗: ${error.message}`);
+    })
+    .finally(() => {
+      historyPageLoading = false;
+      // 一覧が画面を埋めていない場合は続けて読み込む
+      if (generation === historyGeneration) loadMoreIfNeeded();
+    });
+}
+
+// 履歴を全文検索する
+function searchPromptHistory(query) {
+  setStatus("🔍 履歴を検索中...");
+
+  fetch(`/api/prompt-history/search?q=${encodeURIComponent(query)}`)
+    .then((response) => {
+      if (!response.ok) {
+        throw new Error(`HTTP error ${response.status}`);
+      }
+      return response.json();
+    })
+    .then((data) => {
+      // 結果が返るまでに検索語が変わっていたら表示しない
+      if (query !== historySearchQuery) return;
+      historyGeneration++;
+      historyNextBeforeId = null;
+      promptHistory = data.results || [];
+      renderPromptHistory();
+      setStatus(`🔍 「${query}」の検索結果: ${promptHistory.length}件`);
+    })
+    .catch((error) => {
+      console.error("履歴の検索に失敗しました:", error);
+      setStatus(`❌ 履歴の検索に失敗: ${error.message}`);
+    });
+}
+
 // 日時をフォーマットする関数
 function formatTimestamp(timestamp) {
   const date = new Date(timestamp);
@@ -129,6 +234,11 @@ function truncateText(text, maxLength = 150) {
   return text.substring(0, maxLength) + "...";
 }
 
+// 回答のプレビュー（検索結果の場合はハイライト付きのスニペット）
+function previewResponse(item) {
+  return item.response_snippet !== undefined ? item.response_snippet : truncateText(item.response, 100);
+}
+
 // 履歴を画面に表示
 function renderPromptHistory() {
   promptHistoryList.innerHTML = "";
@@ -136,6 +246,14 @@ function renderPromptHistory() {
   if (promptHistory.length === 0) {
     const emptyMessage = document.createElement("div");
     emptyMessage.className = "history-empty";
+    if (historySearchQuery) {
+      emptyMessage.innerHTML = `
+      <div style="font-size: 48px; margin-bottom: 10px;">🔍</div>
+      <div>一致する履歴はありません</div>
+    `;
+      promptHistoryList.appendChild(emptyMessage);
+      return;
+    }
     emptyMessage.innerHTML = `
       <div style="font-size: 48px; margin-bottom: 10px;">📝</div>
       <div>プロンプト履歴はまだありません</div>
@@ -147,152 +265,162 @@ function renderPromptHistory() {
     return;
   }
 
-  promptHistory.forEach((item, index) => {
-    const historyItem = document.createElement("div");
-    historyItem.className = "history-item";
-    historyItem.dataset.id = item.id;
-
-    // ヘッダー部分（API タイプとタイムスタンプ）
-    const header = document.createElement("div");
-    header.className = "history-item-header";
-
-    const apiTypeBadge = document.createElement("span");
-    apiTypeBadge.className = `api-type-badge ${item.api_type === "text" ? "text-type" : ""}`;
-    apiTypeBadge.innerHTML = item.api_type === "chat" ? "💬 チャット" : "📝 テキスト";
-
-    const timestamp = document.createElement("div");
-    timestamp.className = "history-timestamp";
-    timestamp.textContent = formatTimestamp(item.timestamp);
+  promptHistory.forEach(appendHistoryItem);
+}
 
-    header.appendChild(apiTypeBadge);
-    header.appendChild(timestamp);
+// 履歴の1件を一覧の末尾に追加
+function appendHistoryItem(item) {
+  const historyItem = document.createElement("div");
+  historyItem.className = "history-item";
+  historyItem.dataset.id = item.id;
+
+  // ヘッダー部分（API タイプとタイムスタンプ）
+  const header = document.createElement("div");
+  header.className = "history-item-header";
+
+  const apiTypeBadge = document.createElement("span");
+  apiTypeBadge.className = `api-type-badge ${item.api_type === "text" ? "text-type" : ""}`;
+  apiTypeBadge.innerHTML = item.api_type === "chat" ? "💬 チャット" : "📝 テキスト";
+
+  const timestamp = document.createElement("div");
+  timestamp.className = "history-timestamp";
+  timestamp.textContent = formatTimestamp(item.timestamp);
+
+  header.appendChild(apiTypeBadge);
+  if (item.cached) {
+    const cachedBadge = document.createElement("span");
+    cachedBadge.className = "api-type-badge cached-badge";
+    cachedBadge.textContent = "⚡ キャッシュ";
+    cachedBadge.title = "キャッシュから回答されました";
+    header.appendChild(cachedBadge);
+  }
+  header.appendChild(timestamp);
 
-    // プロンプトプレビュー
-    const promptPreview = document.createElement("div");
-    promptPreview.className = "prompt-preview";
-    const truncatedPrompt = truncateText(item.prompt);
-    promptPreview.innerHTML = `<strong>質問:</strong> ${truncatedPrompt}`;
-    
-    // 回答プレビューを追加
-    const responsePreview = document.createElement("div");
-    responsePreview.className = "response-preview";
-    
-    const responseHeader = document.createElement("div");
-    responseHeader.className = "response-header";
-    responseHeader.style.display = "flex";
-    responseHeader.style.justifyContent = "space-between";
-    responseHeader.style.alignItems = "center";
-    
-    const responseContent = document.createElement("div");
-    responseContent.className = "response-content";
+  // プロンプトプレビュー
+  const promptPreview = document.createElement("div");
+  promptPreview.className = "prompt-preview";
+  const truncatedPrompt = item.prompt_snippet !== undefined ? item.prompt_snippet : truncateText(item.prompt);
+  promptPreview.innerHTML = `<strong>質問:</strong> ${truncatedPrompt}`;
+  
+  // 回答プレビューを追加
+  const responsePreview = document.createElement("div");
+  responsePreview.className = "response-preview";
+  
+  const responseHeader = document.createElement("div");
+  responseHeader.className = "response-header";
+  responseHeader.style.display = "flex";
+  responseHeader.style.justifyContent = "space-between";
+  responseHeader.style.alignItems = "center";
+  
+  const responseContent = document.createElement("div");
+  responseContent.className = "response-content";
+  
+  if (item.response) {
+    const truncatedResponse = previewResponse(item);
+    responseContent.innerHTML = `<strong>回答:</strong> ${truncatedResponse}`;
     
-    if (item.response) {
-      const truncatedResponse = truncateText(item.response, 100);
-      responseContent.innerHTML = `<strong>回答:</strong> ${truncatedResponse}`;
-      
-      // 回答のコピーボタンを追加
-      const copyBtn = document.createElement("button");
-      copyBtn.className = "copy-btn copy-btn-small";
-      copyBtn.innerHTML = "📋";
-      copyBtn.title = "回答をコピー";
-      copyBtn.addEventListener("click", (e) => {
-        e.stopPropagation();
-        copyToClipboard(item.response, copyBtn);
-      });
-      responseHeader.appendChild(copyBtn);
+    // 回答のコピーボタンを追加
+    const copyBtn = document.createElement("button");
+    copyBtn.className = "copy-btn copy-btn-small";
+    copyBtn.innerHTML = "📋";
+    copyBtn.title = "回答をコピー";
+    copyBtn.addEventListener("click", (e) => {
+      e.stopPropagation();
+      copyToClipboard(item.response, copyBtn);
+    });
+    responseHeader.appendChild(copyBtn);
+  } else {
+    responseContent.innerHTML = `<strong>回答:</strong> <em style="color: #999;">なし</em>`;
+  }
+  
+  responsePreview.appendChild(responseHeader);
+  responsePreview.appendChild(responseContent);
+  
+  // クリックで展開/折りたたみ
+  promptPreview.addEventListener("click", () => {
+    if (promptPreview.classList.contains("expanded")) {
+      promptPreview.innerHTML = `<strong>質問:</strong> ${truncatedPrompt}`;
+      promptPreview.classList.remove("expanded");
+      if (item.response) {
+        const truncatedResponse = previewResponse(item);
+        responseContent.innerHTML = `<strong>回答:</strong> ${truncatedResponse}`;
+      }
+      responsePreview.classList.remove("expanded");
     } else {
-      responseContent.innerHTML = `<strong>回答:</strong> <em style="color: #999;">なし</em>`;
-    }
-    
-    responsePreview.appendChild(responseHeader);
-    responsePreview.appendChild(responseContent);
-    
-    // クリックで展開/折りたたみ
-    promptPreview.addEventListener("click", () => {
-      if (promptPreview.classList.contains("expanded")) {
-        promptPreview.innerHTML = `<strong>質問:</strong> ${truncatedPrompt}`;
-        promptPreview.classList.remove("expanded");
-        if (item.response) {
-          const truncatedResponse = truncateText(item.response, 100);
-          responseContent.innerHTML = `<strong>回答:</strong> ${truncatedResponse}`;
-        }
-        responsePreview.classList.remove("expanded");
-      } else {
-        promptPreview.innerHTML = `<strong>質問:</strong> ${item.prompt}`;
-        promptPreview.classList.add("expanded");
-        if (item.response) {
-          responseContent.innerHTML = `<strong>回答:</strong> ${item.response}`;
-        }
-        responsePreview.classList.add("expanded");
+      promptPreview.innerHTML = `<strong>質問:</strong> ${item.prompt}`;
+      promptPreview.classList.add("expanded");
+      if (item.response) {
+        responseContent.innerHTML = `<strong>回答:</strong> ${item.response}`;
       }
-    });
+      responsePreview.classList.add("expanded");
+    }
+  });
 
-    // 回答もクリックで展開/折りたたみ
-    responseContent.addEventListener("click", () => {
-      if (responsePreview.classList.contains("expanded")) {
-        if (item.response) {
-          const truncatedResponse = truncateText(item.response, 100);
-          responseContent.innerHTML = `<strong>回答:</strong> ${truncatedResponse}`;
-        }
-        responsePreview.classList.remove("expanded");
-        promptPreview.innerHTML = `<strong>質問:</strong> ${truncatedPrompt}`;
-        promptPreview.classList.remove("expanded");
-      } else {
-        if (item.response) {
-          responseContent.innerHTML = `<strong>回答:</strong> ${item.response}`;
-        }
-        responsePreview.classList.add("expanded");
-        promptPreview.innerHTML = `<strong>質問:</strong> ${item.prompt}`;
-        promptPreview.classList.add("expanded");
+  // 回答もクリックで展開/折りたたみ
+  responseContent.addEventListener("click", () => {
+    if (responsePreview.classList.contains("expanded")) {
+      if (item.response) {
+        const truncatedResponse = previewResponse(item);
+        responseContent.innerHTML = `<strong>回答:</strong> ${truncatedResponse}`;
       }
-    });
-
-    // もし切り詰められている場合は、展開可能であることを示す
-    if (item.prompt.length > 150 || (item.response && item.response.length > 100)) {
-      promptPreview.style.cursor = "pointer";
-      responseContent.style.cursor = "pointer";
-      promptPreview.title = "クリックして全文を表示";
-      responseContent.title = "クリックして全文を表示";
+      responsePreview.classList.remove("expanded");
+      promptPreview.innerHTML = `<strong>質問:</strong> ${truncatedPrompt}`;
+      promptPreview.classList.remove("expanded");
+    } else {
+      if (item.response) {
+        responseContent.innerHTML = `<strong>回答:</strong> ${item.response}`;
+      }
+      responsePreview.classList.add("expanded");
+      promptPreview.innerHTML = `<strong>質問:</strong> ${item.prompt}`;
+      promptPreview.classList.add("expanded");
     }
+  });
 
-    // コントロールボタン
-    const controls = document.createElement("div");
-    controls.className = "history-item-controls";
-
-    const useButton = document.createElement("button");
-    useButton.className = "use-prompt-btn";
-    useButton.innerHTML = "✅ 使用";
-    useButton.title = "このプロンプトを入力エリアに設定";
-    useButton.addEventListener("click", () => usePromptFromHistory(item));
-
-    const editButton = document.createElement("button");
-    editButton.className = "edit-prompt-btn";
-    editButton.innerHTML = "✏️ 編集";
-    editButton.title = "このプロンプトを編集";
-    editButton.addEventListener("click", () => editPromptFromHistory(item));
-
-    const deleteButton = document.createElement("button");
-    deleteButton.className = "delete-prompt-btn";
-    deleteButton.innerHTML = "🗑️ 削除";
-    deleteButton.title = "この履歴を削除";
-    deleteButton.addEventListener("click", () => {
-      if (confirm("この履歴を削除しますか？")) {
-        deletePromptFromHistory(item.id);
-      }
-    });
+  // もし切り詰められている場合は、展開可能であることを示す
+  if (item.prompt.length > 150 || (item.response && item.response.length > 100)) {
+    promptPreview.style.cursor = "pointer";
+    responseContent.style.cursor = "pointer";
+    promptPreview.title = "クリックして全文を表示";
+    responseContent.title = "クリックして全文を表示";
+  }
 
-    // 要素を組み立てる
-    controls.appendChild(useButton);
-    controls.appendChild(editButton);
-    controls.appendChild(deleteButton);
+  // コントロールボタン
+  const controls = document.createElement("div");
+  controls.className = "history-item-controls";
+
+  const useButton = document.createElement("button");
+  useButton.className = "use-prompt-btn";
+  useButton.innerHTML = "✅ 使用";
+  useButton.title = "このプロンプトを入力エリアに設定";
+  useButton.addEventListener("click", () => usePromptFromHistory(item));
+
+  const editButton = document.createElement("button");
+  editButton.className = "edit-prompt-btn";
+  editButton.innerHTML = "✏️ 編集";
+  editButton.title = "このプロンプトを編集";
+  editButton.addEventListener("click", () => editPromptFromHistory(item));
+
+  const deleteButton = document.createElement("button");
+  deleteButton.className = "delete-prompt-btn";
+  deleteButton.innerHTML = "🗑️ 削除";
+  deleteButton.title = "この履歴を削除";
+  deleteButton.addEventListener("click", () => {
+    if (confirm("この履歴を削除しますか？")) {
+      deletePromptFromHistory(item.id);
+    }
+  });
 
-    historyItem.appendChild(header);
-    historyItem.appendChild(promptPreview);
-    historyItem.appendChild(responsePreview);
-    historyItem.appendChild(controls);
+  // 要素を組み立てる
+  controls.appendChild(useButton);
+  controls.appendChild(editButton);
+  controls.appendChild(deleteButton);
 
-    promptHistoryList.appendChild(historyItem);
-  });
+  historyItem.appendChild(header);
+  historyItem.appendChild(promptPreview);
+  historyItem.appendChild(responsePreview);
+  historyItem.appendChild(controls);
+
+  promptHistoryList.appendChild(historyItem);
 }
 
 // 履歴からプロンプトを使用
@@ -403,6 +531,8 @@ function clearPromptHistory() {
         return response.json();
       })
       .then((data) => {
+        historyGeneration++;
+        historyNextBeforeId = null;
         promptHistory = [];
         renderPromptHistory();
         setStatus(`✅ プロンプト履歴をクリアしました - IP: ${data.client_ip || '不明'}`);
@@ -443,18 +573,24 @@ function hidePromptStatus() {
   }
 }
 
-// モデル一覧を取得する関数
-function fetchModels() {
+// モデル一覧を取得する関数（サーバーは最後に取得できた一覧を即座に返す）
+function fetchModels(forceRefresh = false) {
   setStatus("🔍 モデル一覧を取得中...");
 
-  fetch("/api/models")
+  // 更新ボタンの場合は最新の一覧を取得し直すよう要求する
+  const url = forceRefresh ? "/api/models?refresh=1" : "/api/models";
+  fetch(url)
     .then((response) => {
       if (!response.ok) {
         throw new Error(`HTTP error ${response.status}`);
       }
-      return response.json();
+      const stale = response.headers.get("X-Catalog-Stale") === "true";
+      return response.json().then((data) => ({ data, stale }));
     })
-    .then((data) => {
+    .then(({ data, stale }) => {
+      // 選択中のモデルは一覧の更新後も維持する
+      const previousModel = modelSelect.value;
+
       // セレクトボックスをクリア
       modelSelect.innerHTML = '<option value="">モデルを選択してください</option>';
 
@@ -468,9 +604,11 @@ function fetchModels() {
       });
 
       if (models.length > 0) {
-        setStatus(`✅ ${models.length}個のモデルが見つかりました`);
-        // 最初のモデルを選択
-        modelSelect.value = models[0].id;
+        const staleNote = stale ? "（前回取得した一覧）" : "";
+        setStatus(`✅ ${models.length}個のモデルが見つかりました${staleNote}`);
+        // 前回選択していたモデル、なければ最初のモデルを選択
+        const keep = models.some((model) => model.id === previousModel);
+        modelSelect.value = keep ? previousModel : models[0].id;
       } else {
         setStatus("⚠️ モデルが見つかりませんでした");
       }
@@ -482,6 +620,66 @@ function fetchModels() {
 }
 
 // プロンプトを送信する関数
+// リクエストID（サーバーの Server-Timing・トレースログと同じIDで突き合わせる）
+function newRequestId() {
+  if (window.crypto && typeof crypto.randomUUID === "function") {
+    return crypto.randomUUID().replace(/-/g, "").slice(0, 16);
+  }
+  return Math.random().toString(36).slice(2, 10) + Date.now().toString(36);
+}
+
+// 抽出された応答（X-Trace-Sampled）と遅かった応答の内訳をコンソールに出す
+function logRequestTrace(trace, endpoint, totalMs, firstTokenMs) {
+  if (!trace.sampled && totalMs < SLOW_REQUEST_MS) {
+    return;
+  }
+  const firstToken = firstTokenMs !== null ? ` (最初のトークン ${firstTokenMs.toFixed(0)}ms)` : "";
+  console.info(
+    `🧭 [${trace.id}] POST ${endpoint} ${totalMs.toFixed(0)}ms${firstToken} server: ${trace.serverTiming || "-"}`
+  );
+}
+
+// 応答が始まるまで順番待ちの位置と待ち時間の目安を表示する（戻り値の関数で確認をやめる）
+function watchQueuePosition() {
+  let stopped = false;
+  let timer = null;
+  let waiting = false;
+
+  const poll = () => {
+    fetch("/api/queue")
+      .then((response) => (response.ok ? response.json() : null))
+      .then((data) => {
+        if (stopped || !data) {
+          return;
+        }
+        const mine = data.mine || [];
+        if (mine.length > 0) {
+          // 同じIPアドレスから複数送信している場合は、最も先頭に近いものを表示
+          const next = mine[0];
+          waiting = true;
+          setStatus(`⏳ 順番待ち: ${next.position}番目（約${Math.ceil(next.estimated_wait)}秒）`);
+          setPromptStatus(`⏳ ${next.position}番目`, true);
+        } else if (waiting) {
+          waiting = false;
+          setStatus("🚀 リクエスト送信中...");
+          setPromptStatus("🔄 処理中", true);
+        }
+      })
+      .catch(() => {})
+      .finally(() => {
+        if (!stopped) {
+          timer = setTimeout(poll, QUEUE_POLL_INTERVAL_MS);
+        }
+      });
+  };
+
+  timer = setTimeout(poll, QUEUE_POLL_INTERVAL_MS);
+  return () => {
+    stopped = true;
+    clearTimeout(timer);
+  };
+}
+
 function sendPrompt() {
   const prompt = promptInput.value.trim();
   if (!prompt) {
@@ -524,41 +722,79 @@ function sendPrompt() {
   // APIエンドポイント
   const endpoint = apiType === "chat" ? "/api/chat" : "/api/text";
 
-  // フェッチリクエスト
+  // フェッチリクエスト（stream: true でトークンを逐次受信）
+  requestData.stream = true;
+  let firstTokenTime = null;
+  let cacheHit = false;
+  const trace = { id: newRequestId(), sampled: false, serverTiming: "" };
+  const stopQueueWatch = watchQueuePosition();
+
   fetch(endpoint, {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
+      "X-Request-ID": trace.id,
+      // 画面からの対話は、スクリプトからの一括処理（bulk）より先に順番が回ってくる
+      "X-Priority": "interactive",
     },
     body: JSON.stringify(requestData),
   })
     .then((response) => {
+      // 応答ヘッダーが届いた時点で順番は回ってきている
+      stopQueueWatch();
+      trace.id = response.headers.get("X-Request-ID") || trace.id;
+      trace.sampled = response.headers.get("X-Trace-Sampled") === "1";
+      trace.serverTiming = response.headers.get("Server-Timing") || "";
       if (!response.ok) {
         return response.json().then((errData) => {
+          if (response.status === 503) {
+            // 混雑のため受け付けられなかった（Retry-After 秒後に再送信できる）
+            const retryAfter = response.headers.get("Retry-After") || errData.retry_after;
+            throw new Error(`${errData.error || "混雑しています"}（約${retryAfter}秒後）`);
+          }
           throw new Error(`${errData.error || "APIエラー"} ${errData.details || ""}`);
         });
       }
-      return response.json();
+      cacheHit = response.headers.get("X-Cache") === "HIT";
+      const contentType = response.headers.get("Content-Type") || "";
+      if (contentType.includes("text/event-stream") && response.body) {
+        return readCompletionStream(response, apiType, () => {
+          if (firstTokenTime === null) {
+            firstTokenTime = performance.now();
+            responseOutput.textContent = "";
+            setStatus("✍️ 回答を受信中...");
+          }
+        });
+      }
+      // ストリーミング非対応の応答は従来どおり一括で処理
+      return response.json().then((data) => {
+        const result =
+          apiType === "chat" ? data.choices?.[0]?.message?.content : data.choices?.[0]?.text;
+        responseOutput.textContent = result || "";
+        return result || "";
+      });
     })
-    .then((data) => {
-      // レスポンスを処理
-      let result = "";
-
-      if (apiType === "chat") {
-        // チャット完了APIの場合
-        result = data.choices?.[0]?.message?.content || "レスポンスが空です";
-      } else {
-        // テキスト完了APIの場合
-        result = data.choices?.[0]?.text || "レスポンスが空です";
+    .then((result) => {
+      if (!result) {
+        responseOutput.textContent = "レスポンスが空です";
       }
-
-      responseOutput.textContent = result;
       copyResponseBtn.style.display = result ? "block" : "none";
       
       // レスポンス時間を計算して表示
       const endTime = performance.now();
       const responseTime = ((endTime - startTime) / 1000).toFixed(2);
-      setStatus(`✅ 回答の生成が完了しました（${responseTime}秒）`);
+      const ttft = firstTokenTime !== null ? `、最初のトークン ${((firstTokenTime - startTime) / 1000).toFixed(2)}秒` : "";
+      if (cacheHit) {
+        setStatus(`⚡ キャッシュから回答しました（${responseTime}秒）`);
+      } else {
+        setStatus(`✅ 回答の生成が完了しました（${responseTime}秒${ttft}）`);
+      }
+      logRequestTrace(
+        trace,
+        endpoint,
+        endTime - startTime,
+        firstTokenTime !== null ? firstTokenTime - startTime : null
+      );
       setPromptStatus("✅ 完了", false);
 
       // 送信後に履歴を再読み込み（非同期で並行処理）
@@ -573,12 +809,16 @@ function sendPrompt() {
       // エラー時もレスポンス時間を計算
       const endTime = performance.now();
       const responseTime = ((endTime - startTime) / 1000).toFixed(2);
+      console.warn(
+        `🧭 [${trace.id}] POST ${endpoint} エラー ${(endTime - startTime).toFixed(0)}ms server: ${trace.serverTiming || "-"}`
+      );
       
-      responseOutput.textContent = `❌ エラーが発生しました: ${error.message}\n\n🔧 以下を確認してください:\n• LM Studio APIサーバーが起動しているか\n• ネットワーク接続が正常か\n• 選択したモデルが利用可能か\n\n⏱️ 処理時間: ${responseTime}秒`;
+      responseOutput.textContent = `❌ エラーが発生しました: ${error.message}\n\n🔧 以下を確認してください:\n• LM Studio APIサーバーが起動しているか\n• ネットワーク接続が正常か\n• 選択したモデルが利用可能か\n\n⏱️ 処理時間: ${responseTime}秒\n🧭 リクエストID: ${trace.id}`;
       setStatus(`❌ エラー: ${error.message}（${responseTime}秒）`);
       setPromptStatus("❌ エラー", false);
     })
     .finally(() => {
+      stopQueueWatch();
       sendButton.disabled = false;
       sendButton.textContent = "🚀 送信";
       sendButton.classList.remove("processing");
@@ -586,6 +826,73 @@ function sendPrompt() {
     });
 }
 
+// Server-Sent Events のストリームを読み取り、トークンを逐次表示する関数
+async function readCompletionStream(response, apiType, onFirstToken) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder("utf-8");
+  let buffer = "";
+  let result = "";
+  let pending = "";
+  let frameRequested = false;
+
+  // 描画はフレームごとにまとめて行い、トークン単位のDOM更新を避ける
+  const flush = () => {
+    frameRequested = false;
+    if (pending) {
+      responseOutput.textContent += pending;
+      pending = "";
+    }
+  };
+
+  const handleEvent = (rawEvent) => {
+    let eventType = "message";
+    const dataLines = [];
+    for (const line of rawEvent.split("\n")) {
+      if (line.startsWith("event:")) {
+        eventType = line.slice(6).trim();
+      } else if (line.startsWith("data:")) {
+        dataLines.push(line.slice(5).trim());
+      }
+    }
+    const data = dataLines.join("\n");
+    if (!data || data === "[DONE]") return;
+
+    const chunk = JSON.parse(data);
+    if (eventType === "error") {
+      throw new Error(chunk.error || "ストリーミングエラー");
+    }
+    const delta =
+      apiType === "chat" ? chunk.choices?.[0]?.delta?.content : chunk.choices?.[0]?.text;
+    if (!delta) return;
+
+    onFirstToken();
+    result += delta;
+    pending += delta;
+    if (!frameRequested) {
+      frameRequested = true;
+      requestAnimationFrame(flush);
+    }
+  };
+
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true }).replace(/\r\n/g, "\n");
+
+    let separator;
+    while ((separator = buffer.indexOf("\n\n")) !== -1) {
+      const rawEvent = buffer.slice(0, separator);
+      buffer = buffer.slice(separator + 2);
+      handleEvent(rawEvent);
+    }
+  }
+  if (buffer.trim()) {
+    handleEvent(buffer);
+  }
+  flush();
+  return result;
+}
+
 // プロンプトをクリアする関数
 function clearPrompt() {
   if (promptInput.value.trim() && !confirm("入力したプロンプトを削除しますか？")) {
@@ -668,7 +975,7 @@ async function copyToClipboard(text, button) {
 }
 
 // イベントリスナー
-refreshModelsBtn.addEventListener("click", fetchModels);
+refreshModelsBtn.addEventListener("click", () => fetchModels(true));
 sendButton.addEventListener("click", sendPrompt);
 clearButton.addEventListener("click", clearPrompt);
 
@@ -1,13 +1,32 @@
-from flask import Flask, render_template, request, jsonify, Response, stream_template
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, g
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import json
 import os
-import sqlite3
 from datetime import datetime
 import configparser
 import threading
 import time
-from queue import Queue, Empty as queue_Empty
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from backend_pool import BackendPool, parse_server_list
+from admission import load_admission, AdmissionRejected
+from response_cache import (load_response_cache, make_cache_key, is_cacheable,
+                            build_completion_result, build_stream_chunk)
+import similarity_index
+import history_search
+from single_flight import SingleFlight
+from batch_jobs import (load_batch_settings, parse_batch, parse_jsonl, ndjson_line, item_result, item_error,
+                        BatchError, BatchProgress, NDJSON_MIMETYPE, JSONL_MIMETYPES)
+from jobs import (load_job_manager, parse_job, JobError, TooManyJobs, JobCancelledError, JobEventStream,
+                  MAX_WAIT_SECONDS, KEEPALIVE_INTERVAL)
+from model_catalog import ModelCatalog
+from history_writer import HistoryWriter
+from history_retention import load_history_retention, list_archives, archive_page, DEFAULT_ARCHIVE_DIR
+import history_db
+from metrics import ProxyMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import request_trace
 
 app = Flask(__name__)
 
@@ -29,7 +48,15 @@ def load_api_config():
             config.read(config_file, encoding='utf-8')
             ip = config.get('API_SERVER', 'ip', fallback=default_ip)
             port = config.get('API_SERVER', 'port', fallback=default_port)
+            servers = config.get('API_SERVER', 'servers', fallback='')
             print(f"✅ 設定ファイル読み込み成功: {config_file}")
+            # servers が指定されていれば複数バックエンドとして扱う
+            urls = parse_server_list(servers)
+            if urls:
+                print(f"📡 API サーバー設定: {len(urls)}台のバックエンド")
+                for url in urls:
+                    print(f"  - {url}")
+                return urls
             print(f"📡 API サーバー設定: {ip}:{port}")
         except Exception as e:
             print(f"❌ 設定ファイルの読み込みエラー: {e}")
@@ -52,6 +79,9 @@ port = {default_port}
 # ip = 192.168.1.100
 # ip = localhost
 # port = 1234
+
+# 複数のLM Studioサーバーに振り分ける場合（指定時は ip/port より優先）:
+# servers = 192.168.1.166:1234, 192.168.1.167:1234
 """
         
         try:
@@ -66,54 +96,116 @@ port = {default_port}
         ip = default_ip
         port = default_port
     
-    return f"http://{ip}:{port}/v1"
+    return [f"http://{ip}:{port}/v1"]
+
+# API URLを設定（複数バックエンド対応、API_URL は先頭のサーバー）
+API_URLS = load_api_config()
+API_URL = API_URLS[0]
+
+# バックエンドプール（最小処理中数＋モデルアフィニティで振り分け、ヘルスチェックで自動除外）
+backend_pool = BackendPool(API_URLS)
+
+# 上流への同時送信数の制限と、client_ip ごとの公平な順番待ち
+admission = load_admission(backend_pool)
+
+# /api/batch の件数と同時送信数の上限
+batch_settings = load_batch_settings()
+
+def fetch_model_catalog():
+    """全バックエンドを並列に確認し、モデル一覧を統合して返す"""
+    backend_pool.check_all(timeout=10)
+    if not any(backend['healthy'] for backend in backend_pool.status()):
+        raise RuntimeError("利用可能なLM Studioサーバーがありません")
+    return backend_pool.models_union()
+
+# モデル一覧のキャッシュ（最後に取得できた一覧を即座に返し、古ければバックグラウンドで更新）
+model_catalog = ModelCatalog(fetch_model_catalog)
+
+# temperature 0 の決定的なリクエスト向けレスポンスキャッシュ（無効時は None）
+response_cache = load_response_cache()
+
+# 処理中の同一リクエストの相乗り（決定的なリクエストのみ）
+inflight = SingleFlight()
+
+# /metrics で公開するメトリクス
+metrics = ProxyMetrics()
+
+# /api/* の Server-Timing・リクエストIDと、抽出したリクエストのトレースログ
+tracer = request_trace.load_tracer()
+
+# 上流への接続を開いた時間を Server-Timing の upstream-connect に記録する接続クラス
+# （接続を使い回した場合は記録されない）
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with request_trace.span('upstream-connect'):
+            super().connect()
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with request_trace.span('upstream-connect'):
+            super().connect()
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    """接続の時間を計測する接続プールを使うアダプター"""
+    
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool,
+                                                   "https": TimedHTTPSConnectionPool}
 
-# API URLを設定
-API_URL = load_api_config()
+def on_history_batch(batch):
+    """履歴の書き込み後に、保存までの時間と抽出したリクエストの保存を記録する"""
+    metrics.observe_history_batch(batch)
+    tracer.log_history_batch(batch)
 
 # HTTPセッションを作成（接続プールを使用）
 session = requests.Session()
 session.timeout = (5, 120)  # 接続タイムアウト5秒、読み取りタイムアウト120秒
+session.mount('http://', TimedHTTPAdapter())
+session.mount('https://', TimedHTTPAdapter())
 
-# 非同期履歴保存用のキュー
-history_queue = Queue()
-history_thread_running = True
+# 履歴の書き込み（1本の接続で、まとめて1トランザクションで保存する）
+history_writer = HistoryWriter('prompt_history.db', on_batch=on_history_batch)
 
-# 非同期履歴保存ワーカー
-def history_worker():
-    """バックグラウンドで履歴を保存する"""
-    while history_thread_running:
-        try:
-            # キューから履歴データを取得（タイムアウト1秒）
-            history_data = history_queue.get(timeout=1)
-            
-            if history_data is None:  # 終了シグナル
-                break
-                
-            prompt, response, api_type, client_ip = history_data
-            
-            # データベースに保存
-            conn = sqlite3.connect('prompt_history.db')
-            cursor = conn.cursor()
-            timestamp = datetime.now().isoformat()
-            cursor.execute(
-                'INSERT INTO prompt_history (prompt, response, api_type, timestamp, client_ip) VALUES (?, ?, ?, ?, ?)',
-                (prompt, response, api_type, timestamp, client_ip)
-            )
-            conn.commit()
-            conn.close()
-            
-            history_queue.task_done()
-            print(f"📝 履歴保存完了: {client_ip} - {api_type}")
-            
-        except queue_Empty:
-            # タイムアウトは正常な動作なので何もしない
-            continue
-        except Exception as e:
-            error_msg = str(e).strip()
-            if error_msg:
-                print(f"❌ 履歴保存エラー: {error_msg}")
-            # 空のエラーメッセージの場合はスキップ
+# 履歴の読み取り・削除用の接続プール（WALモード）
+db_pool = history_db.ConnectionPool('prompt_history.db')
+
+# 時間のかかる生成を実行するバックグラウンドジョブ（jobs.db はワーカーの開始時に開く。無効時は None）
+job_manager = load_job_manager(history_writer)
+
+# 古い履歴のアーカイブへの移動（無効時は None）
+retention = load_history_retention(db_path='prompt_history.db')
+archive_dir = retention.archive_dir if retention is not None else DEFAULT_ARCHIVE_DIR
+
+metrics.add_sources(backend_pool=backend_pool, history_writer=history_writer,
+                    response_cache=response_cache, inflight=inflight, admission=admission, jobs=job_manager)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.path.startswith('/api/'):
+        g.trace = tracer.begin(request.headers.get(request_trace.REQUEST_ID_HEADER))
+
+@app.after_request
+def record_request_metrics(response):
+    """ルートごとの所要時間を記録し、/api/* には Server-Timing とリクエストIDを付ける（ストリーミングは応答開始まで）"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+    trace = g.get('trace')
+    if trace is not None:
+        tracer.apply_headers(trace, response.headers)
+        # ストリーミングはストリームの終了時に記録する
+        if not trace.deferred:
+            tracer.finish(trace, request.method, request.path, response.status_code)
+    return response
 
 # クライアントIPアドレスを取得する関数
 def get_client_ip():
@@ -125,46 +217,26 @@ def get_client_ip():
         # 複数のプロキシを経由している場合、最初のIPアドレスを取得
         return request.environ['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
 
+def get_request_priority():
+    """リクエストの優先度のクラス（interactive / bulk）を取得する"""
+    return admission.classify(request.headers)
+
 # データベース初期化
 def init_db():
     """データベースを初期化し、必要なテーブルを作成する"""
-    conn = sqlite3.connect('prompt_history.db')
-    cursor = conn.cursor()
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS prompt_history (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        prompt TEXT NOT NULL,
-        response TEXT,
-        api_type TEXT NOT NULL,
-        timestamp TEXT NOT NULL,
-        client_ip TEXT
-    )
-    ''')
-    
-    # 既存のテーブルに response列がない場合は追加
-    cursor.execute("PRAGMA table_info(prompt_history)")
-    columns = [column[1] for column in cursor.fetchall()]
-    if 'response' not in columns:
-        cursor.execute('ALTER TABLE prompt_history ADD COLUMN response TEXT')
+    conn = history_db.connect('prompt_history.db', isolation_level=None)
+    history_db.migrate(conn)
     
-    # 既存のテーブルに client_ip列がない場合は追加
-    if 'client_ip' not in columns:
-        cursor.execute('ALTER TABLE prompt_history ADD COLUMN client_ip TEXT')
+    # 類似プロンプト検索用の索引テーブル
+    similarity_index.init_similarity_tables(conn)
     
-    conn.commit()
     conn.close()
 
 # アプリケーション起動時にデータベースを初期化
 init_db()
 
-# 履歴保存用のワーカースレッドを開始（デバッグモード時の重複起動を防ぐ）
-if not hasattr(app, '_history_thread_started'):
-    history_thread = threading.Thread(target=history_worker, daemon=True)
-    history_thread.start()
-    app._history_thread_started = True
-    print("🚀 非同期履歴保存スレッドを開始しました")
-else:
-    print("⚠️ 履歴保存スレッドは既に起動済みです（デバッグモード）")
+# 前回の起動以降に追加された履歴だけを類似プロンプト索引に追加（バックグラウンド）
+similarity_index.start_catch_up('prompt_history.db')
 
 @app.route('/')
 def index():
@@ -184,19 +256,53 @@ def get_client_info():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 一覧の更新ボタン（?refresh=1）で、最新の一覧の取得を待つ最大秒数
+MODEL_REFRESH_WAIT = 3
+
 @app.route('/api/models', methods=['GET'])
 def get_models():
-    """利用可能なモデルの一覧を取得"""
+    """利用可能なモデルの一覧を取得（最後に取得できた一覧を即座に返す）"""
     try:
-        # セッションを使用して高速化
-        response = session.get(f"{API_URL}/models", timeout=10)
-        if response.status_code == 200:
-            return jsonify(response.json())
-        else:
-            return jsonify({"error": f"エラー: {response.status_code}", "details": response.text}), 500
+        if request.args.get('refresh'):
+            # 明示的な更新は少しだけ待ち、間に合わなければ前回の一覧を返す
+            model_catalog.refresh_async().wait(MODEL_REFRESH_WAIT)
+        catalog, etag = model_catalog.get()
+        if catalog is None:
+            # まだ一度も取得できていない場合のみ、取得を待つ
+            model_catalog.refresh()
+            catalog, etag = model_catalog.get()
+        if catalog is None:
+            status = model_catalog.status()
+            return jsonify({"error": status['last_error'] or "モデル一覧を取得できません",
+                            "backends": backend_pool.status()}), 500
+        return model_catalog_response(catalog, etag)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def model_catalog_response(catalog, etag):
+    """モデル一覧の応答を作成（ETagが一致すれば304）"""
+    status = model_catalog.status()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(catalog)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"private, max-age={model_catalog.max_age}, stale-while-revalidate=300"
+    response.headers['Age'] = str(int(status['age_seconds'] or 0))
+    if status['stale']:
+        response.headers['X-Catalog-Stale'] = 'true'
+    return response
+
+@app.route('/api/models/status', methods=['GET'])
+def get_models_status():
+    """モデル一覧キャッシュの状態を取得"""
+    return jsonify(model_catalog.status())
+
+@app.route('/api/backends', methods=['GET'])
+def get_backends():
+    """バックエンドプールの状態を取得"""
+    return jsonify({"backends": backend_pool.status()})
+
 @app.route('/api/chat', methods=['POST'])
 def chat_completion():
     """チャット完了APIにプロンプトを送信"""
@@ -207,6 +313,7 @@ def chat_completion():
         model = data.get('model', 'default')
         temperature = data.get('temperature', 0.7)
         max_tokens = data.get('max_tokens', 4000)
+        stream = bool(data.get('stream', False))
         
         headers = {
             "Content-Type": "application/json"
@@ -224,17 +331,38 @@ def chat_completion():
         if model != "default":
             payload["model"] = model
         
-        # セッションを使用して高速化
-        response = session.post(
-            f"{API_URL}/chat/completions", 
-            headers=headers,
-            json=payload,  # json=を使用してjson.dumps()を省略
-            timeout=(5, 120)  # 接続5秒、読み取り120秒
-        )
+        # 決定的なリクエスト（temperature 0、またはクライアントが cache: true を指定した場合）は
+        # キャッシュと処理中リクエストの相乗りの対象にする
+        request_key = None
+        if is_cacheable(temperature, data.get('cache')):
+            request_key = make_cache_key('chat', model, payload["messages"], temperature, max_tokens)
+        cache_key = request_key if response_cache is not None else None
+        if cache_key:
+            entry = response_cache.get(cache_key)
+            if entry is not None:
+                save_prompt_history_async(prompt, entry['response_text'], 'chat', get_client_ip(), cached=True)
+                return cached_completion_response(entry, 'chat', stream)
         
-        if response.status_code == 200:
-            result = response.json()
-            
+        # 類似した過去のプロンプトの回答を再利用（クライアントが reuse_similar に類似度の下限を指定した場合）
+        if data.get('reuse_similar'):
+            reused = reuse_similar_response(prompt, 'chat', data.get('reuse_similar'), stream)
+            if reused is not None:
+                return reused
+        
+        # 同じ内容のリクエストが処理中なら、上流を呼ばずにその結果を共有する
+        if request_key:
+            return coalesced_completion("chat/completions", headers, payload, prompt, 'chat',
+                                        get_client_ip(), model, request_key, cache_key, stream)
+        
+        # ストリーミングモードの場合はSSEで逐次中継
+        if stream:
+            return stream_completion("chat/completions", headers, payload,
+                                     prompt, 'chat', get_client_ip(), model)
+        
+        # セッションを使用して高速化（処理中リクエストが最も少ないバックエンドへ送信）
+        response, result = post_upstream("chat/completions", headers, payload, model)
+        
+        if result is not None:
             # レスポンスからメッセージ内容を抽出
             response_text = ""
             if 'choices' in result and len(result['choices']) > 0:
@@ -248,6 +376,8 @@ def chat_completion():
         else:
             return jsonify({"error": f"エラー: {response.status_code}", "details": response.text}), 500
             
+    except AdmissionRejected as e:
+        return rejected_response(e.to_dict())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -261,6 +391,7 @@ def text_completion():
         model = data.get('model', 'default')
         temperature = data.get('temperature', 0.7)
         max_tokens = data.get('max_tokens', 1000)
+        stream = bool(data.get('stream', False))
         
         headers = {
             "Content-Type": "application/json"
@@ -276,17 +407,38 @@ def text_completion():
         if model != "default":
             payload["model"] = model
         
-        # セッションを使用して高速化
-        response = session.post(
-            f"{API_URL}/completions", 
-            headers=headers,
-            json=payload,  # json=を使用してjson.dumps()を省略
-            timeout=(5, 120)  # 接続5秒、読み取り120秒
-        )
+        # 決定的なリクエスト（temperature 0、またはクライアントが cache: true を指定した場合）は
+        # キャッシュと処理中リクエストの相乗りの対象にする
+        request_key = None
+        if is_cacheable(temperature, data.get('cache')):
+            request_key = make_cache_key('text', model, prompt, temperature, max_tokens)
+        cache_key = request_key if response_cache is not None else None
+        if cache_key:
+            entry = response_cache.get(cache_key)
+            if entry is not None:
+                save_prompt_history_async(prompt, entry['response_text'], 'text', get_client_ip(), cached=True)
+                return cached_completion_response(entry, 'text', stream)
         
-        if response.status_code == 200:
-            result = response.json()
-            
+        # 類似した過去のプロンプトの回答を再利用（クライアントが reuse_similar に類似度の下限を指定した場合）
+        if data.get('reuse_similar'):
+            reused = reuse_similar_response(prompt, 'text', data.get('reuse_similar'), stream)
+            if reused is not None:
+                return reused
+        
+        # 同じ内容のリクエストが処理中なら、上流を呼ばずにその結果を共有する
+        if request_key:
+            return coalesced_completion("completions", headers, payload, prompt, 'text',
+                                        get_client_ip(), model, request_key, cache_key, stream)
+        
+        # ストリーミングモードの場合はSSEで逐次中継
+        if stream:
+            return stream_completion("completions", headers, payload,
+                                     prompt, 'text', get_client_ip(), model)
+        
+        # セッションを使用して高速化（処理中リクエストが最も少ないバックエンドへ送信）
+        response, result = post_upstream("completions", headers, payload, model)
+        
+        if result is not None:
             # レスポンスからテキスト内容を抽出
             response_text = ""
             if 'choices' in result and len(result['choices']) > 0:
@@ -300,55 +452,764 @@ def text_completion():
         else:
             return jsonify({"error": f"エラー: {response.status_code}", "details": response.text}), 500
             
+    except AdmissionRejected as e:
+        return rejected_response(e.to_dict())
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# ストリーミングチャンクから差分テキストを取り出す関数
+def extract_stream_delta(chunk, api_type):
+    """SSEチャンク（dict）から追加されたテキストを取り出す"""
+    choices = chunk.get('choices') or []
+    if not choices:
+        return ""
+    if api_type == 'chat':
+        return choices[0].get('delta', {}).get('content') or ""
+    return choices[0].get('text') or ""
+
+# LM StudioのSSEレスポンスを1イベントずつ読み出すジェネレーター
+def iter_sse_data(response):
+    """SSEレスポンスから data: 行の中身を順に返す（[DONE]で終了）"""
+    for line in response.iter_lines(decode_unicode=False):
+        if not line or not line.startswith(b'data:'):
+            continue
+        data = line[5:].strip().decode('utf-8')
+        if data == '[DONE]':
+            break
+        yield data
+
+# LM Studioが200以外を返した場合の例外
+class UpstreamError(Exception):
+    """上流のエラー応答（ステータスコードと本文）"""
+    
+    def __init__(self, status_code, details):
+        super().__init__(f"エラー: {status_code}")
+        self.status_code = status_code
+        self.details = details
+    
+    def to_dict(self):
+        return {"error": f"エラー: {self.status_code}", "details": self.details}
+
+def post_upstream(endpoint, headers, payload, model=None, client_ip=None, priority=None):
+    """LM Studioに非ストリーミングで送信し、(レスポンス, 結果) を返す（200以外の場合、結果は None）
+
+    client_ip・priority を省略すると処理中のリクエストから取得する（リクエストの外のスレッドからは指定する）。
+    """
+    # 順番が来るまで待つ（混雑時は AdmissionRejected）。処理中リクエストが最も少ないバックエンドへ送信
+    ticket = admission.acquire(client_ip or get_client_ip(), model, priority or get_request_priority())
+    call = metrics.upstream_call(endpoint, model, request_trace.current())
+    failed = False
+    try:
+        response = session.post(
+            f"{ticket.backend.url}/{endpoint}",
+            headers=headers,
+            json=payload,  # json=を使用してjson.dumps()を省略
+            timeout=(5, 120)  # 接続5秒、読み取り120秒
+        )
+    except requests.exceptions.ConnectionError as e:
+        failed = True
+        call.finish(e)
+        raise
+    except Exception as e:
+        call.finish(e)
+        raise
+    finally:
+        admission.release(ticket, failed)
+    received = time.perf_counter()
+    # elapsed は送信から応答ヘッダーの受信までの時間（本文の解析は自分の処理として数える）
+    call.first_byte(response.elapsed.total_seconds())
+    if response.status_code != 200:
+        call.finish(UpstreamError(response.status_code, response.text), ended=received)
+        return response, None
+    try:
+        result = response.json()
+    except ValueError as e:
+        call.finish(e, ended=received)
+        raise
+    call.usage(result.get('usage'))
+    call.finish(ended=received)
+    return response, result
+
+def open_upstream_stream(endpoint, headers, payload, model=None, client_ip=None, priority=None, read_timeout=120):
+    """LM Studioにstream: trueで送信し、(受付, レスポンス, 計測) を返す（受付は admission.release まで確保したまま）
+
+    client_ip・priority を省略すると処理中のリクエストから取得する（リクエストの外のスレッドからは指定する）。
+    """
+    payload = dict(payload, stream=True)
+    
+    # 順番が来るまで待ち、ストリームが終わるまでバックエンドを確保する（処理中数に含める）
+    ticket = admission.acquire(client_ip or get_client_ip(), model, priority or get_request_priority())
+    call = metrics.upstream_call(endpoint, model, request_trace.current())
+    try:
+        response = session.post(
+            f"{ticket.backend.url}/{endpoint}",
+            headers=headers,
+            json=payload,
+            timeout=(5, read_timeout),  # 読み取りタイムアウトはチャンク間の待ち時間に適用される
+            stream=True
+        )
+    except requests.exceptions.ConnectionError as e:
+        admission.release(ticket, failed=True)
+        call.finish(e)
+        raise
+    except Exception as e:
+        admission.release(ticket)
+        call.finish(e)
+        raise
+    
+    if response.status_code != 200:
+        details = response.text
+        response.close()
+        admission.release(ticket)
+        error = UpstreamError(response.status_code, details)
+        call.finish(error)
+        raise error
+    call.headers()
+    return ticket, response, call
+
+def stream_completion(endpoint, headers, payload, prompt, api_type, client_ip, model=None):
+    """LM Studioにstream: trueで送信し、差分をServer-Sent Eventsとして中継する"""
+    try:
+        ticket, response, call = open_upstream_stream(endpoint, headers, payload, model)
+    except UpstreamError as e:
+        return jsonify(e.to_dict()), 500
+    except AdmissionRejected as e:
+        return rejected_response(e.to_dict())
+    
+    # 内訳はストリームの終了時に記録する
+    trace = request_trace.current()
+    method, path = request.method, request.path
+    if trace is not None:
+        trace.deferred = True
+    
+    def generate():
+        parts = []
+        error = None
+        try:
+            for data in iter_sse_data(response):
+                call.first_byte()
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                call.usage(chunk.get('usage'))
+                delta = extract_stream_delta(chunk, api_type)
+                if delta:
+                    parts.append(delta)
+                # 上流のチャンクをそのまま中継（クライアント側で同じ形式を解釈できる）
+                yield f"data: {data}\n\n"
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            error = e
+            message = json.dumps({"error": str(e)}, ensure_ascii=False)
+            yield f"event: error\ndata: {message}\n\n"
+        except BaseException as e:
+            # クライアントの切断（GeneratorExit）は成功として数えない
+            error = e
+            raise
+        finally:
+            response.close()
+            admission.release(ticket)
+            call.finish(error)
+            # ストリーム終了時（途中切断を含む）に組み立てた全文を履歴に保存
+            response_text = "".join(parts)
+            if response_text:
+                save_prompt_history_async(prompt, response_text, api_type, client_ip)
+            if trace is not None:
+                tracer.finish(trace, method, path, 200 if error is None else 500)
+    
+    return sse_response(generate())
+
+def fetch_completion(endpoint, headers, payload, api_type, model=None, client_ip=None, priority=None):
+    """LM Studioを非ストリーミングで呼び出し、(結果, 応答テキスト) を返す"""
+    response, result = post_upstream(endpoint, headers, payload, model, client_ip, priority)
+    if result is None:
+        raise UpstreamError(response.status_code, response.text)
+    
+    response_text = ""
+    if 'choices' in result and len(result['choices']) > 0:
+        if api_type == 'chat':
+            response_text = result['choices'][0].get('message', {}).get('content', '')
+        else:
+            response_text = result['choices'][0].get('text', '')
+    return result, response_text
+
+# 相乗りした上流呼び出しの結果が FOLLOWER_TIMEOUT 秒以内に届かなかった場合のエラー
+FLIGHT_TIMEOUT_ERROR = {"error": "相乗りした同一リクエストの応答待ちがタイムアウトしました"}
+
+def coalesced_completion(endpoint, headers, payload, prompt, api_type, client_ip, model, request_key, cache_key, stream):
+    """同じ内容のリクエストが処理中ならその結果を待ち、なければ自分が上流を呼び出して結果を共有する"""
+    flight, leader = inflight.join(request_key, prompt, client_ip)
+    if leader:
+        if stream:
+            start_stream_flight(flight, endpoint, headers, payload, api_type, model, cache_key)
+        else:
+            run_flight(flight, endpoint, headers, payload, api_type, model, cache_key)
+    else:
+        print(f"🔗 処理中の同一リクエストに相乗り: {client_ip} - {api_type} ({len(flight.subscribers)}件目)")
+    return flight_response(flight, api_type, stream, leader, cache_key)
+
+def run_flight(flight, endpoint, headers, payload, api_type, model, cache_key):
+    """非ストリーミングで上流を呼び出し、結果を相乗りした全員に配る"""
+    try:
+        result, response_text = fetch_completion(endpoint, headers, payload, api_type, model)
+    except (UpstreamError, AdmissionRejected) as e:
+        finish_flight(flight, api_type, model, cache_key, error=e.to_dict())
+    except Exception as e:
+        finish_flight(flight, api_type, model, cache_key, error={"error": str(e)})
+    else:
+        finish_flight(flight, api_type, model, cache_key, result=result, response_text=response_text)
+
+def start_stream_flight(flight, endpoint, headers, payload, api_type, model, cache_key):
+    """ストリーミングで上流を呼び出し、受信したチャンクを相乗りした全員に配るスレッドを開始する"""
+    try:
+        ticket, response, call = open_upstream_stream(endpoint, headers, payload, model)
+    except (UpstreamError, AdmissionRejected) as e:
+        finish_flight(flight, api_type, model, cache_key, error=e.to_dict())
+        return
+    except Exception as e:
+        finish_flight(flight, api_type, model, cache_key, error={"error": str(e)})
+        return
+    flight.streaming = True
+    
+    # 上流の受信は専用スレッドで行い、どの参加者が途中で切断しても他の参加者には最後まで届ける
+    def pump():
+        error = None
+        try:
+            for data in iter_sse_data(response):
+                call.first_byte()
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                call.usage(chunk.get('usage'))
+                flight.publish(data, extract_stream_delta(chunk, api_type))
+        except Exception as e:
+            error = {"error": str(e)}
+            call.finish(e)
+        else:
+            call.finish()
+        finally:
+            response.close()
+            admission.release(ticket)
+            response_text = flight.partial_text()
+            result = build_completion_result(api_type, response_text, model) if error is None else None
+            finish_flight(flight, api_type, model, cache_key,
+                          result=result, response_text=response_text, error=error)
+    
+    threading.Thread(target=pump, daemon=True, name="single-flight-stream").start()
+
+def finish_flight(flight, api_type, model, cache_key, result=None, response_text="", error=None):
+    """相乗りを締め切って結果を配り、参加した全員の履歴をそれぞれのIPアドレスで保存する"""
+    # 締め切った直後の同一リクエストがキャッシュにヒットするよう、先にキャッシュへ保存する
+    if cache_key and error is None and result is not None:
+        response_cache.put(cache_key, api_type, model, result, response_text)
+    subscribers = inflight.complete(flight, result=result, response_text=response_text, error=error)
+    if response_text:
+        for index, (prompt, client_ip) in enumerate(subscribers):
+            # 上流を呼び出したリクエスト以外は、共有された回答として cached=1 で記録
+            save_prompt_history_async(prompt, response_text, api_type, client_ip, cached=index > 0)
+
+def flight_response(flight, api_type, stream, leader, cache_key):
+    """相乗りの結果を応答に変換する（ストリーミング要求には受信済みのチャンクから順に中継）"""
+    if flight.done and flight.error is not None and not flight.events:
+        return flight_error_response(flight.error)
+    
+    if stream:
+        def generate():
+            try:
+                for data in flight.iter_events():
+                    yield f"data: {data}\n\n"
+            except TimeoutError:
+                inflight.abandon(flight)
+                error = json.dumps(FLIGHT_TIMEOUT_ERROR, ensure_ascii=False)
+                yield f"event: error\ndata: {error}\n\n"
+                return
+            if flight.error is not None:
+                error = json.dumps(flight.error, ensure_ascii=False)
+                yield f"event: error\ndata: {error}\n\n"
+                return
+            if not flight.streaming:
+                # 上流が非ストリーミングの場合は全文を1チャンクで返す
+                chunk = json.dumps(build_stream_chunk(api_type, flight.response_text), ensure_ascii=False)
+                yield f"data: {chunk}\n\n"
+            yield "data: [DONE]\n\n"
+        
+        response = sse_response(generate())
+    else:
+        if not flight.wait():
+            inflight.abandon(flight)
+            return jsonify(FLIGHT_TIMEOUT_ERROR), 504
+        if flight.error is not None:
+            return flight_error_response(flight.error)
+        response = jsonify(flight.result)
+    
+    if not leader:
+        response.headers['X-Coalesced'] = 'true'
+    return with_cache_header(response, cache_key)
+
+def rejected_response(error):
+    """混雑で受け付けなかったリクエストの応答（503 と Retry-After）"""
+    response = jsonify(error)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error['retry_after'])
+    return response
+
+def flight_error_response(error):
+    """相乗りした上流呼び出しのエラーの応答（順番待ちで断られた場合は 503）"""
+    if 'retry_after' in error:
+        return rejected_response(error)
+    return jsonify(error), 500
+
+def sse_response(generator):
+    """ジェネレーターからServer-Sent Eventsのレスポンスを作成"""
+    return Response(
+        stream_with_context(generator),
+        mimetype='text/event-stream',
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"  # リバースプロキシでのバッファリングを無効化
+        }
+    )
+
+def with_cache_header(response, cache_key):
+    """キャッシュ対象のリクエストに X-Cache: MISS を付ける"""
+    if cache_key:
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+def cached_completion_response(entry, api_type, stream):
+    """キャッシュのエントリから応答を作成（ストリーミング要求の場合は1チャンクのSSEで返す）"""
+    if stream:
+        chunk = json.dumps(build_stream_chunk(api_type, entry['response_text']), ensure_ascii=False)
+        
+        def generate():
+            yield f"data: {chunk}\n\n"
+            yield "data: [DONE]\n\n"
+        
+        response = sse_response(generate())
+    else:
+        response = jsonify(dict(entry['result'], cached=True))
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+def reuse_similar_response(prompt, api_type, min_similarity, stream):
+    """類似度が min_similarity 以上の過去の回答があれば、それを応答として返す（なければ None）"""
+    try:
+        min_similarity = float(min_similarity)
+    except (TypeError, ValueError):
+        min_similarity = 0.9
+    client_ip = get_client_ip()
+    with db_pool.connection() as conn:
+        matches = similarity_index.find_similar(conn, client_ip, prompt=prompt, limit=5,
+                                                min_similarity=min_similarity, api_type=api_type)
+    match = next((item for item in matches if item['response']), None)
+    if match is None:
+        return None
+    
+    print(f"♻️ 類似プロンプトの回答を再利用: {client_ip} - ID:{match['id']} ({match['similarity']:.2f})")
+    metrics.similar_reuse.inc(api_type)
+    save_prompt_history_async(prompt, match['response'], api_type, client_ip, cached=True)
+    entry = {"result": build_completion_result(api_type, match['response']), "response_text": match['response']}
+    response = cached_completion_response(entry, api_type, stream)
+    response.headers['X-Cache'] = 'SIMILAR'
+    response.headers['X-Reused-From'] = str(match['id'])
+    return response
+
+def read_batch_request():
+    """/api/batch の入力（JSON、アップロードした JSONL、JSONL の本文）を (項目, 同時送信数) に変換する"""
+    if request.files:
+        upload = request.files.get('file') or next(iter(request.files.values()))
+        try:
+            text = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise BatchError("JSONL ファイルは UTF-8 で保存してください")
+        return parse_batch(parse_jsonl(text), request.form.to_dict(), batch_settings)
+    if request.mimetype in JSONL_MIMETYPES:
+        return parse_batch(parse_jsonl(request.get_data(as_text=True)), request.args.to_dict(), batch_settings)
+    data = request.get_json(silent=True)
+    if data is None:
+        raise BatchError("JSON（items の配列）か JSONL で指定してください")
+    return parse_batch(data, request.args.to_dict(), batch_settings)
+
+def run_batch_item(item, client_ip, priority):
+    """バッチの1項目を上流に送り、結果の行を返す（ワーカースレッドで実行）"""
+    started = time.perf_counter()
+    cache_key = item.cache_key() if response_cache is not None else None
+    try:
+        if cache_key:
+            entry = response_cache.get(cache_key)
+            if entry is not None:
+                history_writer.submit(item.prompt, entry['response_text'], item.api_type, client_ip, cached=True)
+                return item_result(item, started, entry['response_text'], entry['result'].get('usage'), cached=True)
+        
+        result, response_text = fetch_completion(item.endpoint, {"Content-Type": "application/json"},
+                                                 item.payload(), item.api_type, item.model, client_ip, priority)
+        if cache_key:
+            response_cache.put(cache_key, item.api_type, item.model, result, response_text)
+        # 履歴は書き込みスレッドのキューに入れ、他の項目の分とまとめて保存される
+        history_writer.submit(item.prompt, response_text, item.api_type, client_ip)
+        return item_result(item, started, response_text, result.get('usage'))
+    except (UpstreamError, AdmissionRejected) as e:
+        return item_error(item, started, e.to_dict())
+    except Exception as e:
+        return item_error(item, started, {"error": str(e)})
+
+@app.route('/api/batch', methods=['POST'])
+def batch_completion():
+    """複数のプロンプトを concurrency 件ずつ送信し、終わった順に NDJSON で返す"""
+    try:
+        items, concurrency = read_batch_request()
+    except BatchError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    client_ip = get_client_ip()
+    priority = get_request_priority()
+    print(f"📦 バッチを開始: {client_ip} - {len(items)}件（同時{concurrency}件, {priority}）")
+    
+    # 内訳はバッチの終了時に記録する
+    trace = request_trace.current()
+    method, path = request.method, request.path
+    if trace is not None:
+        trace.deferred = True
+    
+    def generate():
+        progress = BatchProgress(items, concurrency)
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch")
+        try:
+            yield ndjson_line(progress.header())
+            futures = [executor.submit(run_batch_item, item, client_ip, priority) for item in items]
+            for future in as_completed(futures):
+                line = future.result()
+                progress.add(line)
+                yield ndjson_line(line)
+            yield ndjson_line(progress.summary())
+        finally:
+            # クライアントが途中で切断した場合は、まだ送っていない項目を取り消す
+            executor.shutdown(wait=False, cancel_futures=True)
+            print(f"📦 バッチを終了: {client_ip} - 成功 {progress.succeeded}件, 失敗 {progress.failed}件"
+                  f"（{progress.total}件中）")
+            if trace is not None:
+                tracer.finish(trace, method, path, 200)
+    
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE,
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def run_job(job):
+    """ジョブを上流にストリーミングで送り、受信した差分を保存しながら最後まで生成する（ジョブのワーカースレッドで実行）
+
+    取り消されたら上流との接続を閉じる（受付制御の順番待ちの間に取り消された場合は送信せずに終える）。
+    """
+    if job_manager.is_cancelled(job):
+        return
+    try:
+        ticket, response, call = open_upstream_stream(job.endpoint, {"Content-Type": "application/json"},
+                                                      job.payload, job.model, job.client_ip, job.priority,
+                                                      job_manager.read_timeout)
+    except AdmissionRejected as e:
+        # 混雑している場合は Retry-After の秒数後に並び直す（試行回数には数えない）
+        job_manager.defer(job, e.to_dict(), e.retry_after)
+        return
+    except UpstreamError as e:
+        job_manager.fail(job, e.to_dict(), retry=e.status_code >= 500)
+        return
+    except requests.exceptions.RequestException as e:
+        job_manager.fail(job, {"error": str(e)}, retry=True)
+        return
+    except Exception as e:
+        job_manager.fail(job, {"error": str(e)})
+        return
+    if not job_manager.on_cancel(job, response.close):
+        # 順番待ちの間に取り消された（接続は on_cancel で閉じた）
+        admission.release(ticket)
+        call.finish(JobCancelledError())
+        return
+    
+    usage = None
+    error = None
+    try:
+        for data in iter_sse_data(response):
+            call.first_byte()
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            call.usage(chunk.get('usage'))
+            usage = chunk.get('usage') or usage
+            delta = extract_stream_delta(chunk, job.api_type)
+            if delta and job_manager.progress(job, delta):
+                job_manager.flush(job)
+            if job_manager.is_cancelled(job):
+                break
+    except Exception as e:
+        error = e
+    finally:
+        response.close()
+        admission.release(ticket)
+        cancelled = job_manager.is_cancelled(job)
+        call.finish(JobCancelledError() if cancelled else error)
+    
+    if cancelled:
+        return
+    if error is None:
+        job_manager.complete(job, usage)
+    else:
+        # 読み取りタイムアウト・切断は最初から生成し直す
+        job_manager.fail(job, {"error": str(error)}, retry=isinstance(error, requests.exceptions.RequestException))
+
+def jobs_disabled_response():
+    return jsonify({"error": "バックグラウンドジョブは無効です", "enabled": False}), 404
+
+def job_not_found_response():
+    return jsonify({"error": "指定されたジョブが見つからないか、参照権限がありません"}), 404
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """生成をバックグラウンドのジョブとして登録し、ジョブのIDをすぐに返す（202）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    try:
+        api_type, prompt, model, payload = parse_job(request.get_json(silent=True))
+        job = job_manager.submit(client_ip, get_request_priority(), api_type, model, prompt, payload)
+    except JobError as e:
+        return jsonify({"error": str(e)}), 400
+    except TooManyJobs as e:
+        return jsonify({"error": str(e)}), 429
+    
+    print(f"🧾 ジョブを登録: {client_ip} - {job.id} ({api_type}, {job.priority})")
+    response = jsonify(job.to_dict(include_text=False))
+    response.status_code = 202
+    response.headers['Location'] = f"/api/jobs/{job.id}"
+    return response
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """現在のクライアントIPのジョブを新しい順に取得する（?limit=50。途中の回答は含めない）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    jobs = job_manager.list_for_client(client_ip, limit)
+    return jsonify({"jobs": [job.to_dict(include_text=False) for job in jobs],
+                    "stats": job_manager.stats(), "client_ip": client_ip})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """ジョブの状態と途中（完了後は最終）の回答を取得する（?wait=秒 で完了まで待つ）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_WAIT_SECONDS)
+    deadline = time.monotonic() + wait
+    while True:
+        version = job_manager.version
+        job = job_manager.get(job_id, client_ip)
+        if job is None:
+            return job_not_found_response()
+        remaining = deadline - time.monotonic()
+        if job.finished or remaining <= 0:
+            return jsonify(job.to_dict())
+        job_manager.wait_for_change(version, remaining)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    """ジョブの途中の回答と完了を Server-Sent Events で受け取る（Last-Event-ID・?offset= で続きから）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    if job_manager.get(job_id, client_ip) is None:
+        return job_not_found_response()
+    offset = request.headers.get('Last-Event-ID') or request.args.get('offset') or 0
+    try:
+        stream = JobEventStream(int(offset))
+    except ValueError:
+        return jsonify({"error": "offset は整数で指定してください"}), 400
+    
+    def generate():
+        while True:
+            version = job_manager.version
+            job = job_manager.get(job_id)
+            if job is None:
+                return
+            for event in stream.events(job):
+                yield event
+            if job.finished:
+                return
+            if job_manager.wait_for_change(version, KEEPALIVE_INTERVAL) == version:
+                yield ": keepalive\n\n"
+    
+    return sse_response(generate())
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """ジョブを取り消す（実行中の場合は途中までの回答を残して生成を止める）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    job = job_manager.cancel(job_id, client_ip)
+    if job is None:
+        return job_not_found_response()
+    print(f"🛑 ジョブを取り消し: {client_ip} - {job_id}")
+    return jsonify(job.to_dict(include_text=False))
+
+@app.route('/api/cache', methods=['GET'])
+def get_cache_stats():
+    """レスポンスキャッシュの統計情報を取得"""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(response_cache.stats(), enabled=True))
+
+@app.route('/api/inflight', methods=['GET'])
+def get_inflight_stats():
+    """処理中リクエストの相乗りの統計（省略できた上流呼び出しの数）を取得"""
+    return jsonify(inflight.stats())
+
+@app.route('/api/queue', methods=['GET'])
+def get_queue_status():
+    """送信の順番待ちの状況（このクライアントの順番と待ち時間の目安を含む）"""
+    return jsonify(admission.queue_status(get_client_ip()))
+
+@app.route('/api/admission', methods=['GET'])
+def get_admission_stats():
+    """受付制御の統計（優先度のクラスごとの待ち時間・最も長く待っているリクエスト）を取得"""
+    return jsonify(admission.stats())
+
+@app.route('/api/cache', methods=['DELETE'])
+def clear_cache():
+    """レスポンスキャッシュをすべて削除"""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    response_cache.clear()
+    print("🗑️ レスポンスキャッシュを削除しました")
+    return jsonify({"message": "レスポンスキャッシュを削除しました", "enabled": True})
+
 # 非同期で履歴を保存する関数
-def save_prompt_history_async(prompt, response, api_type, client_ip):
-    """プロンプト履歴を非同期で保存する"""
+def save_prompt_history_async(prompt, response, api_type, client_ip, cached=False):
+    """プロンプト履歴を非同期で保存する（保存完了を待つための PendingWrite を返す）"""
     try:
-        history_queue.put((prompt, response, api_type, client_ip), timeout=1)
+        trace = request_trace.current()
+        with request_trace.span('history-enqueue'):
+            pending = history_writer.submit(prompt, response, api_type, client_ip, cached,
+                                            trace_id=trace.id if trace is not None and trace.sampled else None)
         print(f"📝 履歴保存キューに追加: {client_ip} - {api_type}")
+        return pending
     except Exception as e:
         print(f"❌ 履歴キューエラー: {e}")
+        return None
 
 # プロンプト履歴をデータベースに保存する関数（同期版、互換性のため残す）
 def save_prompt_history(prompt, response, api_type, client_ip):
     """プロンプト履歴をデータベースに保存する（同期版）"""
     try:
-        conn = sqlite3.connect('prompt_history.db')
-        cursor = conn.cursor()
-        timestamp = datetime.now().isoformat()
-        cursor.execute(
-            'INSERT INTO prompt_history (prompt, response, api_type, timestamp, client_ip) VALUES (?, ?, ?, ?, ?)',
-            (prompt, response, api_type, timestamp, client_ip)
-        )
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            history_db.insert_history(conn, prompt, response, api_type, client_ip)
+            conn.commit()
         print(f"📝 履歴保存: {client_ip} - {api_type}")
     except Exception as e:
         print(f"❌ 履歴の保存中にエラーが発生しました: {e}")
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus のテキスト形式でメトリクスを返す"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/history-writer', methods=['GET'])
+def get_history_writer_stats():
+    """履歴書き込みの統計（キューの長さ・バッチの所要時間）を取得"""
+    return jsonify(dict(history_writer.stats(), read_pool=db_pool.stats()))
+
 # プロンプト履歴のAPI
 @app.route('/api/prompt-history', methods=['GET'])
 def get_prompt_history():
-    """現在のクライアントIPのプロンプト履歴を取得する"""
+    """現在のクライアントIPのプロンプト履歴を新しい順に取得する（?before_id=&limit= でさらに古いページ）"""
     try:
         client_ip = get_client_ip()
-        conn = sqlite3.connect('prompt_history.db')
-        conn.row_factory = sqlite3.Row  # 辞書形式で結果を取得
-        cursor = conn.cursor()
-        
-        # 現在のクライアントIPの最新20件を取得
-        cursor.execute(
-            'SELECT * FROM prompt_history WHERE client_ip = ? OR client_ip IS NULL ORDER BY id DESC LIMIT 20', 
-            (client_ip,)
-        )
-        history = [dict(row) for row in cursor.fetchall()]
+        limit = min(int(request.args.get('limit', history_db.PAGE_SIZE)), history_db.MAX_PAGE_SIZE)
+        before_id = request.args.get('before_id', type=int)
+        with db_pool.connection() as conn:
+            # 現在のクライアントIPの履歴を before_id より古いものから limit 件取得
+            history, next_before_id = history_db.history_page(conn, client_ip, limit, before_id)
         
-        conn.close()
         print(f"📖 履歴取得: {client_ip} - {len(history)}件")
-        return jsonify({"history": history, "client_ip": client_ip})
+        return jsonify({"history": history, "next_before_id": next_before_id, "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/similar', methods=['GET', 'POST'])
+def get_similar_prompts():
+    """類似した過去のプロンプトと回答を取得する（POST: {"prompt": ...} / GET: ?id=履歴ID）"""
+    try:
+        client_ip = get_client_ip()
+        if request.method == 'POST':
+            params = request.get_json(silent=True) or {}
+        else:
+            params = request.args
+        limit = min(int(params.get('limit', 5)), 50)
+        min_similarity = float(params.get('min_similarity', 0.5))
+        api_type = params.get('api_type') or None
+        
+        with db_pool.connection() as conn:
+            if params.get('id') is not None:
+                history_id = int(params.get('id'))
+                signature = similarity_index.signature_for_id(conn, history_id)
+                if signature is None:
+                    return jsonify({"error": "指定された履歴は索引に登録されていません"}), 404
+                similar = similarity_index.find_similar(conn, client_ip, signature=signature, limit=limit,
+                                                        min_similarity=min_similarity, api_type=api_type,
+                                                        exclude_id=history_id)
+            else:
+                prompt = params.get('prompt', '')
+                if not prompt.strip():
+                    return jsonify({"error": "prompt または id を指定してください"}), 400
+                similar = similarity_index.find_similar(conn, client_ip, prompt=prompt, limit=limit,
+                                                        min_similarity=min_similarity, api_type=api_type)
+        
+        return jsonify({"similar": similar, "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/search', methods=['GET'])
+def search_prompt_history():
+    """プロンプトと回答を全文検索する（?q=検索語&limit=20&api_type=chat）"""
+    try:
+        client_ip = get_client_ip()
+        query = request.args.get('q', '')
+        if not query.strip():
+            return jsonify({"error": "q を指定してください"}), 400
+        limit = min(int(request.args.get('limit', 20)), 50)
+        api_type = request.args.get('api_type') or None
+        
+        started = time.perf_counter()
+        with db_pool.connection() as conn:
+            results = history_search.search(conn, client_ip, query, limit=limit, api_type=api_type)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        
+        print(f"🔍 履歴検索: {client_ip} - \"{query}\" {len(results)}件 ({elapsed_ms:.1f}ms)")
+        return jsonify({"results": results, "query": query, "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/archives', methods=['GET'])
+def get_history_archives():
+    """アーカイブ済みの履歴の月の一覧と、保持設定の統計を取得"""
+    return jsonify({"archives": list_archives(archive_dir),
+                    "retention": dict(retention.stats(), enabled=True) if retention is not None else {"enabled": False}})
+
+@app.route('/api/prompt-history/archives/<month>', methods=['GET'])
+def get_archived_history(month):
+    """アーカイブ（月）の履歴を読み取り専用で新しい順に取得する（?before_id=&limit=）"""
+    try:
+        client_ip = get_client_ip()
+        limit = min(int(request.args.get('limit', history_db.PAGE_SIZE)), history_db.MAX_PAGE_SIZE)
+        before_id = request.args.get('before_id', type=int)
+        page = archive_page(archive_dir, month, client_ip, limit, before_id)
+        if page is None:
+            return jsonify({"error": "指定された月のアーカイブはありません"}), 404
+        history, next_before_id = page
+        return jsonify({"history": history, "next_before_id": next_before_id, "month": month, "client_ip": client_ip})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -357,15 +1218,10 @@ def clear_prompt_history():
     """現在のクライアントIPのプロンプト履歴をすべて削除する"""
     try:
         client_ip = get_client_ip()
-        conn = sqlite3.connect('prompt_history.db')
-        cursor = conn.cursor()
-        
-        # 現在のクライアントIPの履歴のみ削除
-        cursor.execute('DELETE FROM prompt_history WHERE client_ip = ? OR client_ip IS NULL', (client_ip,))
-        deleted_count = cursor.rowcount
-        
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            # 現在のクライアントIPの履歴のみ削除
+            deleted_count = history_db.clear_history(conn, client_ip)
+            conn.commit()
         print(f"🗑️ 履歴削除: {client_ip} - {deleted_count}件")
         return jsonify({"message": f"履歴を削除しました ({deleted_count}件)", "client_ip": client_ip})
     except Exception as e:
@@ -376,18 +1232,10 @@ def delete_prompt_history(prompt_id):
     """指定されたIDのプロンプト履歴を削除する（現在のクライアントIPのもののみ）"""
     try:
         client_ip = get_client_ip()
-        conn = sqlite3.connect('prompt_history.db')
-        cursor = conn.cursor()
-        
-        # 現在のクライアントIPのもののみ削除
-        cursor.execute(
-            'DELETE FROM prompt_history WHERE id = ? AND (client_ip = ? OR client_ip IS NULL)', 
-            (prompt_id, client_ip)
-        )
-        deleted_count = cursor.rowcount
-        
-        conn.commit()
-        conn.close()
+        with db_pool.connection() as conn:
+            # 現在のクライアントIPのもののみ削除
+            deleted_count = history_db.delete_history(conn, client_ip, prompt_id)
+            conn.commit()
         
         if deleted_count > 0:
             print(f"🗑️ 個別削除: {client_ip} - ID:{prompt_id}")
@@ -397,6 +1245,23 @@ def delete_prompt_history(prompt_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 履歴保存用のワーカースレッドを開始（デバッグモード時の重複起動を防ぐ。run_job などの定義の後で開始する）
+if not hasattr(app, '_history_thread_started'):
+    history_writer.start()
+    app._history_thread_started = True
+    print("🚀 非同期履歴保存スレッドを開始しました")
+    
+    # バックエンドのヘルスチェックとモデル一覧の定期更新を開始
+    backend_pool.start()
+    model_catalog.start()
+    if retention is not None:
+        retention.start()
+    # 前回の起動で終わらなかったジョブもここから再開する
+    if job_manager is not None:
+        job_manager.start(run_job)
+else:
+    print("⚠️ 履歴保存スレッドは既に起動済みです（デバッグモード）")
+
 # テンプレートディレクトリがなければ作成
 if not os.path.exists('templates'):
     os.makedirs('templates')
@@ -404,15 +1269,26 @@ if not os.path.exists('templates'):
 # アプリケーション終了時の処理
 def shutdown_handler():
     """アプリケーション終了時に呼び出される"""
-    global history_thread_running
     print("\n🛑 アプリケーションを終了中...")
     
-    # 履歴保存スレッドを停止
-    history_thread_running = False
-    history_queue.put(None)  # 終了シグナル
+    # 実行中のジョブは途中の回答を保存して次の起動時に再開する
+    if job_manager is not None:
+        job_manager.stop()
+    
+    # キューに残っている履歴を書き込んでから履歴保存スレッドを停止
+    history_writer.stop()
+    if retention is not None:
+        retention.stop()
+    db_pool.close()
     
-    # セッションを閉じる
+    # セッションとバックエンドプールを閉じる
     session.close()
+    backend_pool.stop()
+    model_catalog.stop()
+    if response_cache is not None:
+        response_cache.close()
+    if job_manager is not None:
+        job_manager.close()
     
     print("✅ 終了処理が完了しました")
 
@@ -421,13 +1297,15 @@ if __name__ == '__main__':
         print("=" * 60)
         print("🚀 LM Studio Web アプリケーション起動中...")
         print(f"📱 バージョン: {VERSION}")
-        print(f"📡 API サーバー: {API_URL}")
+        print(f"📡 API サーバー: {', '.join(API_URLS)}")
         print("🌐 Web サーバー: http://localhost:8000")
         print("💡 設定変更: ipconfig.ini ファイルを編集してください")
         print("⚡ 高速化機能:")
         print("  - HTTPセッション接続プール")
         print("  - 非同期履歴保存")
         print("  - 最適化されたタイムアウト設定")
+        print("  - ストリーミング応答（Server-Sent Events）")
+        print("  - temperature 0 のレスポンスキャッシュ")
         print("=" * 60)
         
         # 環境変数でデバッグモードを制御（デフォルトはプロダクションモード）
@@ -0,0 +1,1257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LM Studio Web アプリケーション - asyncio版（ASGI）
+
+web_app.py と同じルートを asyncio ネイティブで提供する。
+LM Studio への通信は httpx.AsyncClient で行い、履歴の読み取りは接続プール（history_db.py）を
+スレッドで、書き込みは専用スレッドのバッチ書き込み（history_writer.py）で行うため、
+生成待ちのリクエストがOSスレッドを占有しない。数百件の同時生成でも1プロセスで処理できる。
+
+起動方法:
+    python web_app_async.py
+    hypercorn web_app_async:app --bind 0.0.0.0:8000
+"""
+
+import asyncio
+import configparser
+import json
+import os
+import time
+from datetime import datetime
+
+import httpx
+from quart import Quart, render_template, request, jsonify, Response, g
+
+from backend_pool import BackendPool, parse_server_list
+from admission import load_admission, AdmissionRejected
+from response_cache import (load_response_cache, make_cache_key, is_cacheable,
+                            build_completion_result, build_stream_chunk)
+import similarity_index
+import history_search
+from single_flight import SingleFlight, AsyncFlight
+from batch_jobs import (load_batch_settings, parse_batch, parse_jsonl, ndjson_line, item_result, item_error,
+                        BatchError, BatchProgress, NDJSON_MIMETYPE, JSONL_MIMETYPES)
+from jobs import load_job_manager, parse_job, JobError, TooManyJobs, JobEventStream, MAX_WAIT_SECONDS, KEEPALIVE_INTERVAL
+from model_catalog import ModelCatalog
+from history_writer import HistoryWriter
+from history_retention import load_history_retention, list_archives, archive_page, DEFAULT_ARCHIVE_DIR
+import history_db
+from metrics import ProxyMetrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+import request_trace
+
+app = Quart(__name__)
+
+# バージョン情報
+VERSION = "20250528.1633"
+
+# 履歴データベースのパス
+DB_PATH = 'prompt_history.db'
+
+# LM Studio への接続タイムアウト（接続5秒、読み取り120秒）
+UPSTREAM_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+
+def load_api_config():
+    """設定ファイルからAPIサーバーの設定を読み込む"""
+    config = configparser.ConfigParser()
+    config_file = 'ipconfig.ini'
+
+    # デフォルト設定
+    default_ip = "192.168.1.166"
+    default_port = "1234"
+
+    ip = default_ip
+    port = default_port
+    if os.path.exists(config_file):
+        try:
+            config.read(config_file, encoding='utf-8')
+            ip = config.get('API_SERVER', 'ip', fallback=default_ip)
+            port = config.get('API_SERVER', 'port', fallback=default_port)
+            print(f"✅ 設定ファイル読み込み成功: {config_file}")
+            urls = parse_server_list(config.get('API_SERVER', 'servers', fallback=''))
+            if urls:
+                print(f"📡 API サーバー設定: {len(urls)}台のバックエンド")
+                return urls
+            print(f"📡 API サーバー設定: {ip}:{port}")
+        except Exception as e:
+            print(f"❌ 設定ファイルの読み込みエラー: {e}")
+            print("⚠️ デフォルト設定を使用します")
+            ip = default_ip
+            port = default_port
+    else:
+        print(f"⚠️ 設定ファイル '{config_file}' が見つかりません（web_app.py の初回起動で作成されます）")
+
+    return [f"http://{ip}:{port}/v1"]
+
+# API URLを設定（複数バックエンド対応）
+API_URLS = load_api_config()
+
+# バックエンドプール（ヘルスチェックはプール内のスレッドで実行される）
+backend_pool = BackendPool(API_URLS)
+
+# 上流への同時送信数の制限と、client_ip ごとの公平な順番待ち
+admission = load_admission(backend_pool)
+
+# /api/batch の件数と同時送信数の上限
+batch_settings = load_batch_settings()
+
+def fetch_model_catalog():
+    """全バックエンドを並列に確認し、モデル一覧を統合して返す（更新スレッドで実行される）"""
+    backend_pool.check_all(timeout=10)
+    if not any(backend['healthy'] for backend in backend_pool.status()):
+        raise RuntimeError("利用可能なLM Studioサーバーがありません")
+    return backend_pool.models_union()
+
+# モデル一覧のキャッシュ（最後に取得できた一覧を即座に返し、古ければバックグラウンドで更新）
+model_catalog = ModelCatalog(fetch_model_catalog)
+
+# 一覧の更新ボタン（?refresh=1）で、最新の一覧の取得を待つ最大秒数
+MODEL_REFRESH_WAIT = 3
+
+# temperature 0 の決定的なリクエスト向けレスポンスキャッシュ（無効時は None）
+response_cache = load_response_cache()
+
+# 処理中の同一リクエストの相乗り（決定的なリクエストのみ）
+inflight = SingleFlight(AsyncFlight)
+
+# /metrics で公開するメトリクス
+metrics = ProxyMetrics()
+
+# /api/* の Server-Timing・リクエストIDと、抽出したリクエストのトレースログ
+tracer = request_trace.load_tracer()
+
+def on_history_batch(batch):
+    """履歴の書き込み後に、保存までの時間と抽出したリクエストの保存を記録する"""
+    metrics.observe_history_batch(batch)
+    tracer.log_history_batch(batch)
+
+def connect_timing(trace):
+    """httpx の trace 拡張で、上流への接続（TCP と TLS）を開いた時間を upstream-connect に記録する
+    （接続を使い回した場合は記録されない）"""
+    if trace is None:
+        return None
+    started = {}
+
+    async def hook(event_name, info):
+        step, _, state = event_name.rpartition('.')
+        if step not in ('connection.connect_tcp', 'connection.start_tls'):
+            return
+        if state == 'started':
+            started[step] = time.perf_counter()
+        elif state == 'complete' and step in started:
+            trace.add('upstream-connect', time.perf_counter() - started.pop(step))
+    return {"trace": hook}
+
+# バックエンドへの接続失敗として扱う例外
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+# 起動後に初期化される共有リソース
+client = None        # httpx.AsyncClient（接続プール）
+
+# 履歴の読み取り・削除用の接続プール（WALモード）
+db_pool = history_db.ConnectionPool(DB_PATH)
+
+# 履歴の書き込み（専用スレッドの1本の接続で、まとめて1トランザクションで保存する）
+history_writer = HistoryWriter(DB_PATH, on_batch=on_history_batch)
+
+# 時間のかかる生成を実行するバックグラウンドジョブ（jobs.db はワーカーの開始時に開く。無効時は None）
+job_manager = load_job_manager(history_writer)
+
+# 古い履歴のアーカイブへの移動（無効時は None）
+retention = load_history_retention(db_path=DB_PATH)
+archive_dir = retention.archive_dir if retention is not None else DEFAULT_ARCHIVE_DIR
+
+metrics.add_sources(backend_pool=backend_pool, history_writer=history_writer,
+                    response_cache=response_cache, inflight=inflight, admission=admission, jobs=job_manager)
+
+# クライアントIPアドレスを取得する関数
+def get_client_ip():
+    """クライアントのIPアドレスを取得する"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        # 複数のプロキシを経由している場合、最初のIPアドレスを取得
+        return forwarded.split(',')[0].strip()
+    return request.remote_addr
+
+def get_request_priority():
+    """リクエストの優先度のクラス（interactive / bulk）を取得する"""
+    return admission.classify(request.headers)
+
+async def run_db(func, *args):
+    """接続プールから借りた接続で func(conn, *args) をスレッドで実行する"""
+    def call():
+        with db_pool.connection() as conn:
+            return func(conn, *args)
+    return await asyncio.to_thread(call)
+
+def init_db():
+    """データベースを初期化し、未適用のマイグレーションを適用する"""
+    conn = history_db.connect(DB_PATH, isolation_level=None)
+    history_db.migrate(conn)
+
+    # 類似プロンプト検索用の索引テーブル
+    similarity_index.init_similarity_tables(conn)
+
+    conn.close()
+
+def save_prompt_history_async(prompt, response, api_type, client_ip, cached=False):
+    """プロンプト履歴を非同期で保存する（キューに入れるだけなのでイベントループを止めない）"""
+    try:
+        trace = request_trace.current()
+        with request_trace.span('history-enqueue'):
+            pending = history_writer.submit(prompt, response, api_type, client_ip, cached,
+                                            trace_id=trace.id if trace is not None and trace.sampled else None)
+        print(f"📝 履歴保存キューに追加: {client_ip} - {api_type}")
+        return pending
+    except Exception as e:
+        print(f"❌ 履歴キューエラー: {e}")
+        return None
+
+@app.before_serving
+async def startup():
+    """共有リソースを初期化"""
+    global client
+
+    client = httpx.AsyncClient(
+        timeout=UPSTREAM_TIMEOUT,
+        # 同時生成数はLM Studio側で制限されるため、接続数はここでは絞らない
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=20)
+    )
+
+    await asyncio.to_thread(init_db)
+
+    history_writer.start()
+    print("🚀 非同期履歴保存スレッドを開始しました")
+
+    # 前回の起動以降に追加された履歴だけを類似プロンプト索引に追加（バックグラウンド）
+    similarity_index.start_catch_up(DB_PATH)
+
+    backend_pool.start()
+    model_catalog.start()
+    if retention is not None:
+        retention.start()
+    # 前回の起動で終わらなかったジョブもここから再開する
+    if job_manager is not None:
+        await asyncio.to_thread(job_manager.open)
+        job_manager.start_async(run_job)
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+    if request.path.startswith('/api/'):
+        g.trace = tracer.begin(request.headers.get(request_trace.REQUEST_ID_HEADER))
+
+@app.after_request
+async def record_request_metrics(response):
+    """ルートごとの所要時間を記録し、/api/* には Server-Timing とリクエストIDを付ける（ストリーミングは応答開始まで）"""
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+    trace = g.get('trace')
+    if trace is not None:
+        tracer.apply_headers(trace, response.headers)
+        # ストリーミングはストリームの終了時に記録する
+        if not trace.deferred:
+            tracer.finish(trace, request.method, request.path, response.status_code)
+    return response
+
+@app.after_serving
+async def shutdown():
+    """アプリケーション終了時に呼び出される"""
+    print("\n🛑 アプリケーションを終了中...")
+
+    # 実行中のジョブは途中の回答を保存して次の起動時に再開する
+    if job_manager is not None:
+        job_manager.stop()
+        await asyncio.gather(*job_manager.tasks, return_exceptions=True)
+
+    # 残っている履歴を書き出してから書き込みスレッドを停止
+    await asyncio.to_thread(history_writer.stop)
+    if retention is not None:
+        await asyncio.to_thread(retention.stop)
+
+    await client.aclose()
+    db_pool.close()
+    backend_pool.stop()
+    model_catalog.stop()
+    if response_cache is not None:
+        response_cache.close()
+    if job_manager is not None:
+        job_manager.close()
+    print("✅ 終了処理が完了しました")
+
+@app.route('/')
+async def index():
+    """メインページを表示"""
+    return await render_template('index.html', version=VERSION)
+
+@app.route('/api/client-info', methods=['GET'])
+async def get_client_info():
+    """クライアント情報を取得する"""
+    try:
+        return jsonify({
+            "client_ip": get_client_ip(),
+            "user_agent": request.headers.get('User-Agent', ''),
+            "timestamp": datetime.now().isoformat()
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/models', methods=['GET'])
+async def get_models():
+    """利用可能なモデルの一覧を取得（最後に取得できた一覧を即座に返す）"""
+    try:
+        if request.args.get('refresh'):
+            # 明示的な更新は少しだけ待ち、間に合わなければ前回の一覧を返す
+            done = model_catalog.refresh_async()
+            await asyncio.to_thread(done.wait, MODEL_REFRESH_WAIT)
+        catalog, etag = model_catalog.get()
+        if catalog is None:
+            # まだ一度も取得できていない場合のみ、取得を待つ
+            await asyncio.to_thread(model_catalog.refresh)
+            catalog, etag = model_catalog.get()
+        if catalog is None:
+            status = model_catalog.status()
+            return jsonify({"error": status['last_error'] or "モデル一覧を取得できません",
+                            "backends": backend_pool.status()}), 500
+        return model_catalog_response(catalog, etag)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def model_catalog_response(catalog, etag):
+    """モデル一覧の応答を作成（ETagが一致すれば304）"""
+    status = model_catalog.status()
+    if request.if_none_match.contains(etag):
+        response = Response("", status=304)
+    else:
+        response = jsonify(catalog)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"private, max-age={model_catalog.max_age}, stale-while-revalidate=300"
+    response.headers['Age'] = str(int(status['age_seconds'] or 0))
+    if status['stale']:
+        response.headers['X-Catalog-Stale'] = 'true'
+    return response
+
+@app.route('/api/models/status', methods=['GET'])
+async def get_models_status():
+    """モデル一覧キャッシュの状態を取得"""
+    return jsonify(model_catalog.status())
+
+@app.route('/api/backends', methods=['GET'])
+async def get_backends():
+    """バックエンドプールの状態を取得"""
+    return jsonify({"backends": backend_pool.status()})
+
+def extract_stream_delta(chunk, api_type):
+    """SSEチャンク（dict）から追加されたテキストを取り出す"""
+    choices = chunk.get('choices') or []
+    if not choices:
+        return ""
+    if api_type == 'chat':
+        return choices[0].get('delta', {}).get('content') or ""
+    return choices[0].get('text') or ""
+
+class UpstreamError(Exception):
+    """上流のエラー応答（ステータスコードと本文）"""
+
+    def __init__(self, status_code, details):
+        super().__init__(f"エラー: {status_code}")
+        self.status_code = status_code
+        self.details = details
+
+    def to_dict(self):
+        return {"error": f"エラー: {self.status_code}", "details": self.details}
+
+async def open_upstream_stream(endpoint, payload, model=None, client_ip=None, priority=None, read_timeout=None):
+    """LM Studioにstream: trueで送信し、(受付, レスポンス, 計測) を返す（受付は admission.release まで確保したまま）
+
+    client_ip・priority を省略すると処理中のリクエストから取得する。read_timeout はチャンク間の待ち時間の上限
+    （省略時は UPSTREAM_TIMEOUT）。
+    """
+    trace = request_trace.current()
+    # 順番が来るまで待ち、ストリームが終わるまでバックエンドを確保する（処理中数に含める）
+    ticket = await admission.acquire_async(client_ip or get_client_ip(), model, priority or get_request_priority())
+    call = metrics.upstream_call(endpoint, model, trace)
+    timeout = httpx.Timeout(read_timeout, connect=5.0) if read_timeout else httpx.USE_CLIENT_DEFAULT
+    try:
+        upstream_request = client.build_request("POST", f"{ticket.backend.url}/{endpoint}",
+                                                json=dict(payload, stream=True), timeout=timeout,
+                                                extensions=connect_timing(trace))
+        response = await client.send(upstream_request, stream=True)
+    except CONNECT_ERRORS as e:
+        admission.release(ticket, failed=True)
+        call.finish(e)
+        raise
+    except BaseException as e:
+        admission.release(ticket)
+        call.finish(e)
+        raise
+
+    if response.status_code != 200:
+        details = (await response.aread()).decode('utf-8', errors='replace')
+        await response.aclose()
+        admission.release(ticket)
+        error = UpstreamError(response.status_code, details)
+        call.finish(error)
+        raise error
+    call.headers()
+    return ticket, response, call
+
+async def iter_sse_data(response):
+    """SSEレスポンスから data: 行の中身を順に返す（[DONE]で終了）"""
+    async for line in response.aiter_lines():
+        if not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if data == '[DONE]':
+            break
+        yield data
+
+async def stream_completion(endpoint, payload, prompt, api_type, client_ip, model=None):
+    """LM Studioにstream: trueで送信し、差分をServer-Sent Eventsとして中継する"""
+    try:
+        ticket, response, call = await open_upstream_stream(endpoint, payload, model)
+    except UpstreamError as e:
+        return jsonify(e.to_dict()), 500
+    except AdmissionRejected as e:
+        return rejected_response(e.to_dict())
+
+    # 内訳はストリームの終了時に記録する
+    trace = request_trace.current()
+    method, path = request.method, request.path
+    if trace is not None:
+        trace.deferred = True
+
+    async def generate():
+        parts = []
+        error = None
+        try:
+            async for data in iter_sse_data(response):
+                call.first_byte()
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                call.usage(chunk.get('usage'))
+                delta = extract_stream_delta(chunk, api_type)
+                if delta:
+                    parts.append(delta)
+                yield f"data: {data}\n\n".encode('utf-8')
+            yield b"data: [DONE]\n\n"
+        except Exception as e:
+            error = e
+            message = json.dumps({"error": str(e)}, ensure_ascii=False)
+            yield f"event: error\ndata: {message}\n\n".encode('utf-8')
+        except BaseException as e:
+            # クライアントの切断（キャンセル）は成功として数えない
+            error = e
+            raise
+        finally:
+            await response.aclose()
+            admission.release(ticket)
+            call.finish(error)
+            # ストリーム終了時（途中切断を含む）に組み立てた全文を履歴に保存
+            response_text = "".join(parts)
+            if response_text:
+                save_prompt_history_async(prompt, response_text, api_type, client_ip)
+            if trace is not None:
+                tracer.finish(trace, method, path, 200 if error is None else 500)
+
+    return sse_response(generate())
+
+async def fetch_completion(endpoint, payload, api_type, model=None, client_ip=None, priority=None):
+    """LM Studioを非ストリーミングで呼び出し、(結果, 応答テキスト) を返す
+
+    client_ip・priority を省略すると処理中のリクエストから取得する。
+    """
+    trace = request_trace.current()
+    # 順番が来るまで待つ（混雑時は AdmissionRejected）。処理中リクエストが最も少ないバックエンドへ送信
+    ticket = await admission.acquire_async(client_ip or get_client_ip(), model, priority or get_request_priority())
+    call = metrics.upstream_call(endpoint, model, trace)
+    failed = False
+    try:
+        # 応答ヘッダーの受信（最初のバイト）と本文の受信を分けて計測する
+        upstream_request = client.build_request("POST", f"{ticket.backend.url}/{endpoint}", json=payload,
+                                                extensions=connect_timing(trace))
+        response = await client.send(upstream_request, stream=True)
+        call.first_byte()
+        try:
+            await response.aread()
+        finally:
+            await response.aclose()
+        received = time.perf_counter()
+    except CONNECT_ERRORS as e:
+        failed = True
+        call.finish(e)
+        raise
+    except BaseException as e:
+        # 切断によるキャンセルも上流の呼び出しの終了として記録する
+        call.finish(e)
+        raise
+    finally:
+        admission.release(ticket, failed)
+    # 本文の解析は自分の処理として数える
+    if response.status_code != 200:
+        error = UpstreamError(response.status_code, response.text)
+        call.finish(error, ended=received)
+        raise error
+
+    try:
+        result = response.json()
+    except ValueError as e:
+        call.finish(e, ended=received)
+        raise
+    call.usage(result.get('usage'))
+    call.finish(ended=received)
+    response_text = ""
+    if 'choices' in result and len(result['choices']) > 0:
+        if api_type == 'chat':
+            response_text = result['choices'][0].get('message', {}).get('content', '')
+        else:
+            response_text = result['choices'][0].get('text', '')
+    return result, response_text
+
+# 相乗りした上流呼び出しの結果が FOLLOWER_TIMEOUT 秒以内に届かなかった場合のエラー
+FLIGHT_TIMEOUT_ERROR = {"error": "相乗りした同一リクエストの応答待ちがタイムアウトしました"}
+
+async def coalesced_completion(endpoint, payload, prompt, api_type, client_ip, model, request_key, cache_key, stream):
+    """同じ内容のリクエストが処理中ならその結果を待ち、なければ自分が上流を呼び出して結果を共有する"""
+    flight, leader = inflight.join(request_key, prompt, client_ip)
+    if leader:
+        priority = get_request_priority()
+        if stream:
+            await start_stream_flight(flight, endpoint, payload, api_type, model, cache_key, client_ip, priority)
+        else:
+            run_flight(flight, endpoint, payload, api_type, model, cache_key, client_ip, priority)
+    else:
+        print(f"🔗 処理中の同一リクエストに相乗り: {client_ip} - {api_type} ({len(flight.subscribers)}件目)")
+    return await flight_response(flight, api_type, stream, leader, cache_key)
+
+def run_flight(flight, endpoint, payload, api_type, model, cache_key, client_ip, priority):
+    """非ストリーミングで上流を呼び出し、結果を相乗りした全員に配るタスクを開始する
+
+    上流の呼び出しは別タスクで行い、先頭のリクエストが切断（キャンセル）されても参加者には結果を届ける。
+    """
+    async def call_upstream():
+        try:
+            result, response_text = await fetch_completion(endpoint, payload, api_type, model, client_ip, priority)
+        except (UpstreamError, AdmissionRejected) as e:
+            await finish_flight(flight, api_type, model, cache_key, error=e.to_dict())
+        except Exception as e:
+            await finish_flight(flight, api_type, model, cache_key, error={"error": str(e)})
+        except BaseException:
+            # タスク自体が取り消された場合（終了時）も、待っている参加者を解放する
+            inflight.complete(flight, error={"error": "cancelled"})
+            raise
+        else:
+            await finish_flight(flight, api_type, model, cache_key, result=result, response_text=response_text)
+
+    flight.task = asyncio.create_task(call_upstream())
+
+async def start_stream_flight(flight, endpoint, payload, api_type, model, cache_key, client_ip, priority):
+    """ストリーミングで上流を呼び出し、受信したチャンクを相乗りした全員に配るタスクを開始する
+
+    上流の呼び出しは別タスクで行い、ここでは応答が返り始める（またはエラーになる）まで待つ。
+    先頭のリクエストが切断（キャンセル）されても、タスクは続けて参加者に最後まで届ける。
+    """
+    opened = asyncio.Event()
+
+    async def pump():
+        try:
+            ticket, response, call = await open_upstream_stream(endpoint, payload, model, client_ip, priority)
+        except (UpstreamError, AdmissionRejected) as e:
+            await finish_flight(flight, api_type, model, cache_key, error=e.to_dict())
+            return
+        except Exception as e:
+            await finish_flight(flight, api_type, model, cache_key, error={"error": str(e)})
+            return
+        except BaseException:
+            inflight.complete(flight, error={"error": "cancelled"})
+            raise
+        finally:
+            opened.set()
+        flight.streaming = True
+
+        error = None
+        try:
+            async for data in iter_sse_data(response):
+                call.first_byte()
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                call.usage(chunk.get('usage'))
+                flight.publish(data, extract_stream_delta(chunk, api_type))
+        except Exception as e:
+            error = {"error": str(e)}
+            call.finish(e)
+        except BaseException as e:
+            # 途中までの回答をキャッシュしないよう、エラーとして締め切る
+            error = {"error": "cancelled"}
+            call.finish(e)
+            raise
+        else:
+            call.finish()
+        finally:
+            await response.aclose()
+            admission.release(ticket)
+            response_text = flight.partial_text()
+            result = build_completion_result(api_type, response_text, model) if error is None else None
+            await finish_flight(flight, api_type, model, cache_key,
+                                result=result, response_text=response_text, error=error)
+
+    flight.task = asyncio.create_task(pump())
+    await asyncio.shield(opened.wait())
+
+async def finish_flight(flight, api_type, model, cache_key, result=None, response_text="", error=None):
+    """相乗りを締め切って結果を配り、参加した全員の履歴をそれぞれのIPアドレスで保存する"""
+    # 締め切った直後の同一リクエストがキャッシュにヒットするよう、先にキャッシュへ保存する
+    if cache_key and error is None and result is not None:
+        await asyncio.to_thread(response_cache.put, cache_key, api_type, model or 'default',
+                                result, response_text)
+    subscribers = inflight.complete(flight, result=result, response_text=response_text, error=error)
+    if response_text:
+        for index, (prompt, client_ip) in enumerate(subscribers):
+            # 上流を呼び出したリクエスト以外は、共有された回答として cached=1 で記録
+            save_prompt_history_async(prompt, response_text, api_type, client_ip, cached=index > 0)
+
+async def flight_response(flight, api_type, stream, leader, cache_key):
+    """相乗りの結果を応答に変換する（ストリーミング要求には受信済みのチャンクから順に中継）"""
+    if flight.done and flight.error is not None and not flight.events:
+        return flight_error_response(flight.error)
+
+    if stream:
+        async def generate():
+            try:
+                async for data in flight.iter_events():
+                    yield f"data: {data}\n\n".encode('utf-8')
+            except asyncio.TimeoutError:
+                inflight.abandon(flight)
+                error = json.dumps(FLIGHT_TIMEOUT_ERROR, ensure_ascii=False)
+                yield f"event: error\ndata: {error}\n\n".encode('utf-8')
+                return
+            if flight.error is not None:
+                error = json.dumps(flight.error, ensure_ascii=False)
+                yield f"event: error\ndata: {error}\n\n".encode('utf-8')
+                return
+            if not flight.streaming:
+                # 上流が非ストリーミングの場合は全文を1チャンクで返す
+                chunk = json.dumps(build_stream_chunk(api_type, flight.response_text), ensure_ascii=False)
+                yield f"data: {chunk}\n\n".encode('utf-8')
+            yield b"data: [DONE]\n\n"
+
+        response = sse_response(generate())
+    else:
+        if not await flight.wait():
+            inflight.abandon(flight)
+            return jsonify(FLIGHT_TIMEOUT_ERROR), 504
+        if flight.error is not None:
+            return flight_error_response(flight.error)
+        response = jsonify(flight.result)
+
+    if not leader:
+        response.headers['X-Coalesced'] = 'true'
+    return with_cache_header(response, cache_key)
+
+def rejected_response(error):
+    """混雑で受け付けなかったリクエストの応答（503 と Retry-After）"""
+    response = jsonify(error)
+    response.status_code = 503
+    response.headers['Retry-After'] = str(error['retry_after'])
+    return response
+
+def flight_error_response(error):
+    """相乗りした上流呼び出しのエラーの応答（順番待ちで断られた場合は 503）"""
+    if 'retry_after' in error:
+        return rejected_response(error)
+    return jsonify(error), 500
+
+def sse_response(generator):
+    """非同期ジェネレーターからServer-Sent Eventsのレスポンスを作成"""
+    result = Response(generator, mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    # 長時間の生成でもQuartのレスポンスタイムアウトで切断しない
+    result.timeout = None
+    return result
+
+def with_cache_header(response, cache_key):
+    """キャッシュ対象のリクエストに X-Cache: MISS を付ける"""
+    if cache_key:
+        response.headers['X-Cache'] = 'MISS'
+    return response
+
+def cached_completion_response(entry, api_type, stream):
+    """キャッシュのエントリから応答を作成（ストリーミング要求の場合は1チャンクのSSEで返す）"""
+    if stream:
+        chunk = json.dumps(build_stream_chunk(api_type, entry['response_text']), ensure_ascii=False)
+
+        async def generate():
+            yield f"data: {chunk}\n\n".encode('utf-8')
+            yield b"data: [DONE]\n\n"
+
+        response = sse_response(generate())
+    else:
+        response = jsonify(dict(entry['result'], cached=True))
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+def lookup_similar(client_ip, **kwargs):
+    """類似プロンプトを検索する（スレッドで実行する）"""
+    with db_pool.connection() as conn:
+        if kwargs.get('history_id') is not None:
+            history_id = kwargs.pop('history_id')
+            signature = similarity_index.signature_for_id(conn, history_id)
+            if signature is None:
+                return None
+            return similarity_index.find_similar(conn, client_ip, signature=signature,
+                                                 exclude_id=history_id, **kwargs)
+        return similarity_index.find_similar(conn, client_ip, **kwargs)
+
+async def reuse_similar_response(prompt, api_type, min_similarity, stream, client_ip):
+    """類似度が min_similarity 以上の過去の回答があれば、それを応答として返す（なければ None）"""
+    try:
+        min_similarity = float(min_similarity)
+    except (TypeError, ValueError):
+        min_similarity = 0.9
+    matches = await asyncio.to_thread(lookup_similar, client_ip, prompt=prompt, limit=5,
+                                      min_similarity=min_similarity, api_type=api_type)
+    match = next((item for item in matches if item['response']), None)
+    if match is None:
+        return None
+
+    print(f"♻️ 類似プロンプトの回答を再利用: {client_ip} - ID:{match['id']} ({match['similarity']:.2f})")
+    metrics.similar_reuse.inc(api_type)
+    save_prompt_history_async(prompt, match['response'], api_type, client_ip, cached=True)
+    entry = {"result": build_completion_result(api_type, match['response']), "response_text": match['response']}
+    response = cached_completion_response(entry, api_type, stream)
+    response.headers['X-Cache'] = 'SIMILAR'
+    response.headers['X-Reused-From'] = str(match['id'])
+    return response
+
+async def completion(endpoint, api_type, payload, prompt, stream, cache_opt_in=None, reuse_similar=None):
+    """LM Studioの完了APIを呼び出し、結果を返す（チャット・テキスト共通）"""
+    client_ip = get_client_ip()
+    model = payload.get('model')
+
+    # 決定的なリクエスト（temperature 0、またはクライアントが cache: true を指定した場合）は
+    # キャッシュと処理中リクエストの相乗りの対象にする
+    request_key = None
+    if is_cacheable(payload['temperature'], cache_opt_in):
+        request_key = make_cache_key(api_type, model or 'default',
+                                     payload['messages'] if api_type == 'chat' else prompt,
+                                     payload['temperature'], payload['max_tokens'])
+    cache_key = request_key if response_cache is not None else None
+    if cache_key:
+        entry = await asyncio.to_thread(response_cache.get, cache_key)
+        if entry is not None:
+            save_prompt_history_async(prompt, entry['response_text'], api_type, client_ip, cached=True)
+            return cached_completion_response(entry, api_type, stream)
+
+    # 類似した過去のプロンプトの回答を再利用（クライアントが reuse_similar に類似度の下限を指定した場合）
+    if reuse_similar:
+        reused = await reuse_similar_response(prompt, api_type, reuse_similar, stream, client_ip)
+        if reused is not None:
+            return reused
+
+    # 同じ内容のリクエストが処理中なら、上流を呼ばずにその結果を共有する
+    if request_key:
+        return await coalesced_completion(endpoint, payload, prompt, api_type, client_ip,
+                                          model, request_key, cache_key, stream)
+
+    if stream:
+        return await stream_completion(endpoint, payload, prompt, api_type, client_ip, model)
+
+    try:
+        result, response_text = await fetch_completion(endpoint, payload, api_type, model)
+    except UpstreamError as e:
+        return jsonify(e.to_dict()), 500
+    except AdmissionRejected as e:
+        return rejected_response(e.to_dict())
+
+    save_prompt_history_async(prompt, response_text, api_type, client_ip)
+    return jsonify(result)
+
+async def read_batch_request():
+    """/api/batch の入力（JSON、アップロードした JSONL、JSONL の本文）を (項目, 同時送信数) に変換する"""
+    files = await request.files
+    if files:
+        upload = files.get('file') or next(iter(files.values()))
+        try:
+            text = upload.read().decode('utf-8-sig')
+        except UnicodeDecodeError:
+            raise BatchError("JSONL ファイルは UTF-8 で保存してください")
+        form = await request.form
+        return parse_batch(parse_jsonl(text), form.to_dict(), batch_settings)
+    if request.mimetype in JSONL_MIMETYPES:
+        text = await request.get_data(as_text=True)
+        return parse_batch(parse_jsonl(text), request.args.to_dict(), batch_settings)
+    data = await request.get_json(silent=True)
+    if data is None:
+        raise BatchError("JSON（items の配列）か JSONL で指定してください")
+    return parse_batch(data, request.args.to_dict(), batch_settings)
+
+async def run_batch_item(item, client_ip, priority):
+    """バッチの1項目を上流に送り、結果の行を返す"""
+    # 項目ごとの上流の時間をバッチのリクエストの内訳に足し込まない
+    request_trace.current_trace.set(None)
+    started = time.perf_counter()
+    cache_key = item.cache_key() if response_cache is not None else None
+    try:
+        if cache_key:
+            entry = await asyncio.to_thread(response_cache.get, cache_key)
+            if entry is not None:
+                history_writer.submit(item.prompt, entry['response_text'], item.api_type, client_ip, cached=True)
+                return item_result(item, started, entry['response_text'], entry['result'].get('usage'), cached=True)
+
+        result, response_text = await fetch_completion(item.endpoint, item.payload(), item.api_type, item.model,
+                                                       client_ip, priority)
+        if cache_key:
+            await asyncio.to_thread(response_cache.put, cache_key, item.api_type, item.model, result, response_text)
+        # 履歴は書き込みスレッドのキューに入れ、他の項目の分とまとめて保存される
+        history_writer.submit(item.prompt, response_text, item.api_type, client_ip)
+        return item_result(item, started, response_text, result.get('usage'))
+    except (UpstreamError, AdmissionRejected) as e:
+        return item_error(item, started, e.to_dict())
+    except Exception as e:
+        return item_error(item, started, {"error": str(e)})
+
+@app.route('/api/batch', methods=['POST'])
+async def batch_completion():
+    """複数のプロンプトを concurrency 件ずつ送信し、終わった順に NDJSON で返す"""
+    try:
+        items, concurrency = await read_batch_request()
+    except BatchError as e:
+        return jsonify({"error": str(e)}), 400
+
+    client_ip = get_client_ip()
+    priority = get_request_priority()
+    print(f"📦 バッチを開始: {client_ip} - {len(items)}件（同時{concurrency}件, {priority}）")
+
+    # 内訳はバッチの終了時に記録する
+    trace = request_trace.current()
+    method, path = request.method, request.path
+    if trace is not None:
+        trace.deferred = True
+
+    async def generate():
+        progress = BatchProgress(items, concurrency)
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run(item):
+            async with slots:
+                return await run_batch_item(item, client_ip, priority)
+
+        tasks = [asyncio.create_task(run(item)) for item in items]
+        try:
+            yield ndjson_line(progress.header()).encode('utf-8')
+            for next_done in asyncio.as_completed(tasks):
+                line = await next_done
+                progress.add(line)
+                yield ndjson_line(line).encode('utf-8')
+            yield ndjson_line(progress.summary()).encode('utf-8')
+        finally:
+            # クライアントが途中で切断した場合は、残りの項目を取り消す
+            for task in tasks:
+                task.cancel()
+            print(f"📦 バッチを終了: {client_ip} - 成功 {progress.succeeded}件, 失敗 {progress.failed}件"
+                  f"（{progress.total}件中）")
+            if trace is not None:
+                tracer.finish(trace, method, path, 200)
+
+    return Response(generate(), mimetype=NDJSON_MIMETYPE,
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def run_job(job):
+    """ジョブを上流にストリーミングで送り、受信した差分を保存しながら最後まで生成する（ジョブのワーカーのタスク）
+
+    取り消されるとワーカーがこのタスクをキャンセルし、順番待ち・上流との接続はそれぞれの finally で片付ける。
+    """
+    try:
+        ticket, response, call = await open_upstream_stream(job.endpoint, job.payload, job.model, job.client_ip,
+                                                            job.priority, job_manager.read_timeout)
+    except AdmissionRejected as e:
+        # 混雑している場合は Retry-After の秒数後に並び直す（試行回数には数えない）
+        await asyncio.to_thread(job_manager.defer, job, e.to_dict(), e.retry_after)
+        return
+    except UpstreamError as e:
+        await asyncio.to_thread(job_manager.fail, job, e.to_dict(), e.status_code >= 500)
+        return
+    except httpx.HTTPError as e:
+        await asyncio.to_thread(job_manager.fail, job, {"error": str(e)}, True)
+        return
+    except Exception as e:
+        await asyncio.to_thread(job_manager.fail, job, {"error": str(e)})
+        return
+
+    usage = None
+    error = None
+    try:
+        async for data in iter_sse_data(response):
+            call.first_byte()
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            call.usage(chunk.get('usage'))
+            usage = chunk.get('usage') or usage
+            delta = extract_stream_delta(chunk, job.api_type)
+            if delta and job_manager.progress(job, delta):
+                await asyncio.to_thread(job_manager.flush, job)
+            if job_manager.is_cancelled(job):
+                break
+    except Exception as e:
+        error = e
+    except BaseException as e:
+        # ワーカーの停止（キャンセル）も上流の呼び出しの終了として記録する
+        error = e
+        raise
+    finally:
+        await response.aclose()
+        admission.release(ticket)
+        call.finish(error)
+
+    if error is None:
+        await asyncio.to_thread(job_manager.complete, job, usage)
+    else:
+        # 読み取りタイムアウト・切断は最初から生成し直す
+        await asyncio.to_thread(job_manager.fail, job, {"error": str(error)}, isinstance(error, httpx.HTTPError))
+
+def jobs_disabled_response():
+    return jsonify({"error": "バックグラウンドジョブは無効です", "enabled": False}), 404
+
+def job_not_found_response():
+    return jsonify({"error": "指定されたジョブが見つからないか、参照権限がありません"}), 404
+
+@app.route('/api/jobs', methods=['POST'])
+async def submit_job():
+    """生成をバックグラウンドのジョブとして登録し、ジョブのIDをすぐに返す（202）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    try:
+        api_type, prompt, model, payload = parse_job(await request.get_json(silent=True))
+        job = await asyncio.to_thread(job_manager.submit, client_ip, get_request_priority(),
+                                      api_type, model, prompt, payload)
+    except JobError as e:
+        return jsonify({"error": str(e)}), 400
+    except TooManyJobs as e:
+        return jsonify({"error": str(e)}), 429
+
+    print(f"🧾 ジョブを登録: {client_ip} - {job.id} ({api_type}, {job.priority})")
+    response = jsonify(job.to_dict(include_text=False))
+    response.status_code = 202
+    response.headers['Location'] = f"/api/jobs/{job.id}"
+    return response
+
+@app.route('/api/jobs', methods=['GET'])
+async def list_jobs():
+    """現在のクライアントIPのジョブを新しい順に取得する（?limit=50。途中の回答は含めない）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    jobs = await asyncio.to_thread(job_manager.list_for_client, client_ip, limit)
+    stats = await asyncio.to_thread(job_manager.stats)
+    return jsonify({"jobs": [job.to_dict(include_text=False) for job in jobs], "stats": stats, "client_ip": client_ip})
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    """ジョブの状態と途中（完了後は最終）の回答を取得する（?wait=秒 で完了まで待つ）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    wait = min(max(request.args.get('wait', 0, type=float), 0), MAX_WAIT_SECONDS)
+    deadline = time.monotonic() + wait
+    while True:
+        version = job_manager.version
+        job = await asyncio.to_thread(job_manager.get, job_id, client_ip)
+        if job is None:
+            return job_not_found_response()
+        remaining = deadline - time.monotonic()
+        if job.finished or remaining <= 0:
+            return jsonify(job.to_dict())
+        await job_manager.wait_for_change_async(version, remaining)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+async def get_job_events(job_id):
+    """ジョブの途中の回答と完了を Server-Sent Events で受け取る（Last-Event-ID・?offset= で続きから）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    if await asyncio.to_thread(job_manager.get, job_id, client_ip) is None:
+        return job_not_found_response()
+    offset = request.headers.get('Last-Event-ID') or request.args.get('offset') or 0
+    try:
+        stream = JobEventStream(int(offset))
+    except ValueError:
+        return jsonify({"error": "offset は整数で指定してください"}), 400
+
+    async def generate():
+        while True:
+            version = job_manager.version
+            job = await asyncio.to_thread(job_manager.get, job_id)
+            if job is None:
+                return
+            for event in stream.events(job):
+                yield event.encode('utf-8')
+            if job.finished:
+                return
+            if await job_manager.wait_for_change_async(version, KEEPALIVE_INTERVAL) == version:
+                yield b": keepalive\n\n"
+
+    return sse_response(generate())
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+async def cancel_job(job_id):
+    """ジョブを取り消す（実行中の場合は途中までの回答を残して生成を止める）"""
+    if job_manager is None:
+        return jobs_disabled_response()
+    client_ip = get_client_ip()
+    job = await asyncio.to_thread(job_manager.cancel, job_id, client_ip)
+    if job is None:
+        return job_not_found_response()
+    print(f"🛑 ジョブを取り消し: {client_ip} - {job_id}")
+    return jsonify(job.to_dict(include_text=False))
+
+@app.route('/api/cache', methods=['GET'])
+async def get_cache_stats():
+    """レスポンスキャッシュの統計情報を取得"""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(response_cache.stats(), enabled=True))
+
+@app.route('/api/inflight', methods=['GET'])
+async def get_inflight_stats():
+    """処理中リクエストの相乗りの統計（省略できた上流呼び出しの数）を取得"""
+    return jsonify(inflight.stats())
+
+@app.route('/api/queue', methods=['GET'])
+async def get_queue_status():
+    """送信の順番待ちの状況（このクライアントの順番と待ち時間の目安を含む）"""
+    return jsonify(admission.queue_status(get_client_ip()))
+
+@app.route('/api/admission', methods=['GET'])
+async def get_admission_stats():
+    """受付制御の統計（優先度のクラスごとの待ち時間・最も長く待っているリクエスト）を取得"""
+    return jsonify(admission.stats())
+
+@app.route('/api/cache', methods=['DELETE'])
+async def clear_cache():
+    """レスポンスキャッシュをすべて削除"""
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    await asyncio.to_thread(response_cache.clear)
+    print("🗑️ レスポンスキャッシュを削除しました")
+    return jsonify({"message": "レスポンスキャッシュを削除しました", "enabled": True})
+
+@app.route('/api/chat', methods=['POST'])
+async def chat_completion():
+    """チャット完了APIにプロンプトを送信"""
+    try:
+        data = await request.get_json()
+
+        prompt = data.get('prompt', '')
+        model = data.get('model', 'default')
+        payload = {
+            "messages": [
+                {"role": "user", "content": prompt}
+            ],
+            "temperature": data.get('temperature', 0.7),
+            "max_tokens": data.get('max_tokens', 4000)
+        }
+        if model != "default":
+            payload["model"] = model
+
+        return await completion('chat/completions', 'chat', payload, prompt,
+                                bool(data.get('stream', False)), data.get('cache'),
+                                data.get('reuse_similar'))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/text', methods=['POST'])
+async def text_completion():
+    """テキスト完了APIにプロンプトを送信"""
+    try:
+        data = await request.get_json()
+
+        prompt = data.get('prompt', '')
+        model = data.get('model', 'default')
+        payload = {
+            "prompt": prompt,
+            "temperature": data.get('temperature', 0.7),
+            "max_tokens": data.get('max_tokens', 1000)
+        }
+        if model != "default":
+            payload["model"] = model
+
+        return await completion('completions', 'text', payload, prompt,
+                                bool(data.get('stream', False)), data.get('cache'),
+                                data.get('reuse_similar'))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    """Prometheus のテキスト形式でメトリクスを返す"""
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@app.route('/api/history-writer', methods=['GET'])
+async def get_history_writer_stats():
+    """履歴書き込みの統計（キューの長さ・バッチの所要時間）を取得"""
+    return jsonify(dict(history_writer.stats(), read_pool=db_pool.stats()))
+
+@app.route('/api/prompt-history', methods=['GET'])
+async def get_prompt_history():
+    """現在のクライアントIPのプロンプト履歴を新しい順に取得する（?before_id=&limit= でさらに古いページ）"""
+    try:
+        client_ip = get_client_ip()
+        limit = min(int(request.args.get('limit', history_db.PAGE_SIZE)), history_db.MAX_PAGE_SIZE)
+        before_id = request.args.get('before_id', type=int)
+
+        history, next_before_id = await run_db(history_db.history_page, client_ip, limit, before_id)
+
+        print(f"📖 履歴取得: {client_ip} - {len(history)}件")
+        return jsonify({"history": history, "next_before_id": next_before_id, "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/similar', methods=['GET', 'POST'])
+async def get_similar_prompts():
+    """類似した過去のプロンプトと回答を取得する（POST: {"prompt": ...} / GET: ?id=履歴ID）"""
+    try:
+        client_ip = get_client_ip()
+        if request.method == 'POST':
+            params = await request.get_json(silent=True) or {}
+        else:
+            params = request.args
+        options = {
+            "limit": min(int(params.get('limit', 5)), 50),
+            "min_similarity": float(params.get('min_similarity', 0.5)),
+            "api_type": params.get('api_type') or None
+        }
+
+        if params.get('id') is not None:
+            similar = await asyncio.to_thread(lookup_similar, client_ip,
+                                              history_id=int(params.get('id')), **options)
+            if similar is None:
+                return jsonify({"error": "指定された履歴は索引に登録されていません"}), 404
+        else:
+            prompt = params.get('prompt', '')
+            if not prompt.strip():
+                return jsonify({"error": "prompt または id を指定してください"}), 400
+            similar = await asyncio.to_thread(lookup_similar, client_ip, prompt=prompt, **options)
+
+        return jsonify({"similar": similar, "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/search', methods=['GET'])
+async def search_prompt_history():
+    """プロンプトと回答を全文検索する（?q=検索語&limit=20&api_type=chat）"""
+    try:
+        client_ip = get_client_ip()
+        query = request.args.get('q', '')
+        if not query.strip():
+            return jsonify({"error": "q を指定してください"}), 400
+        limit = min(int(request.args.get('limit', 20)), 50)
+        api_type = request.args.get('api_type') or None
+
+        started = time.perf_counter()
+        results = await run_db(history_search.search, client_ip, query, limit, api_type)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        print(f"🔍 履歴検索: {client_ip} - \"{query}\" {len(results)}件 ({elapsed_ms:.1f}ms)")
+        return jsonify({"results": results, "query": query, "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/archives', methods=['GET'])
+async def get_history_archives():
+    """アーカイブ済みの履歴の月の一覧と、保持設定の統計を取得"""
+    archives = await asyncio.to_thread(list_archives, archive_dir)
+    return jsonify({"archives": archives,
+                    "retention": dict(retention.stats(), enabled=True) if retention is not None else {"enabled": False}})
+
+@app.route('/api/prompt-history/archives/<month>', methods=['GET'])
+async def get_archived_history(month):
+    """アーカイブ（月）の履歴を読み取り専用で新しい順に取得する（?before_id=&limit=）"""
+    try:
+        client_ip = get_client_ip()
+        limit = min(int(request.args.get('limit', history_db.PAGE_SIZE)), history_db.MAX_PAGE_SIZE)
+        before_id = request.args.get('before_id', type=int)
+        page = await asyncio.to_thread(archive_page, archive_dir, month, client_ip, limit, before_id)
+        if page is None:
+            return jsonify({"error": "指定された月のアーカイブはありません"}), 404
+        history, next_before_id = page
+        return jsonify({"history": history, "next_before_id": next_before_id, "month": month, "client_ip": client_ip})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history', methods=['DELETE'])
+async def clear_prompt_history():
+    """現在のクライアントIPのプロンプト履歴をすべて削除する"""
+    try:
+        client_ip = get_client_ip()
+
+        def delete(conn):
+            deleted_count = history_db.clear_history(conn, client_ip)
+            conn.commit()
+            return deleted_count
+
+        deleted_count = await run_db(delete)
+
+        print(f"🗑️ 履歴削除: {client_ip} - {deleted_count}件")
+        return jsonify({"message": f"履歴を削除しました ({deleted_count}件)", "client_ip": client_ip})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/prompt-history/<int:prompt_id>', methods=['DELETE'])
+async def delete_prompt_history(prompt_id):
+    """指定されたIDのプロンプト履歴を削除する（現在のクライアントIPのもののみ）"""
+    try:
+        client_ip = get_client_ip()
+
+        def delete(conn):
+            deleted_count = history_db.delete_history(conn, client_ip, prompt_id)
+            conn.commit()
+            return deleted_count
+
+        deleted_count = await run_db(delete)
+
+        if deleted_count > 0:
+            print(f"🗑️ 個別削除: {client_ip} - ID:{prompt_id}")
+            return jsonify({"message": f"ID: {prompt_id}の履歴を削除しました", "client_ip": client_ip})
+        else:
+            return jsonify({"error": "指定された履歴が見つからないか、削除権限がありません"}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == '__main__':
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    print("=" * 60)
+    print("🚀 LM Studio Web アプリケーション（asyncio版）起動中...")
+    print(f"📱 バージョン: {VERSION}")
+    print(f"📡 API サーバー: {', '.join(API_URLS)}")
+    print("🌐 Web サーバー: http://localhost:8000")
+    print("⚡ 非同期機能:")
+    print("  - httpx.AsyncClient による非ブロッキング通信")
+    print("  - WALモードの接続プールによる履歴アクセス（書き込みはバッチ書き込みスレッド）")
+    print("  - 生成待ちでスレッドを占有しないASGIサーバー（hypercorn）")
+    print("=" * 60)
+
+    config = Config()
+    config.bind = ["0.0.0.0:8000"]
+    # ストリーミング中の長い無通信区間でも接続を維持
+    config.keep_alive_timeout = 130
+
+    try:
+        asyncio.run(serve(app, config))
+    except KeyboardInterrupt:
+        pass